@@ -2,22 +2,38 @@
 import os
 import random
 import string
-from flask import Flask, render_template, redirect, url_for, request, flash, session, send_file, jsonify
+from flask import Flask, render_template, redirect, url_for, request, flash, send_file, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from forms import RegisterForm, LoginForm, UploadForm, SearchForm
+from search_index import UsernameIndex
 from captcha.image import ImageCaptcha
+from rate_limit import RateLimiter, open_counter, client_ip, form_username
+from password_service import PasswordService
+from blob_store import BlobStore
+from session_store import open_backend, ServerSideSessionInterface, ChallengeStore, regenerate_session
 # ----------------------------------------------------------------------------
 # Flask应用程序设置
 app = Flask(__name__)
+# 登录、注册、验证码和上传限流；多进程部署时把 'memory' 换成数据库文件路径
+limiter = RateLimiter(open_counter('memory'))
+# 密码哈希在进程池里计算，不占用请求线程；修改参数后旧哈希会在用户下次登录时自动更新
+passwords = PasswordService()
 app.config['SECRET_KEY'] = 'your_secret_key_here'  # 用于会话的密钥
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///video_share.db'  # 数据库配置
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'static/uploads'  # 上传视频的目录
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 设置最大上传大小为100MB
 app.config['ALLOWED_EXTENSIONS'] = {'mp4', 'avi', 'mov', 'mkv'}  # 允许的视频格式
+# 相同内容的视频只存一份，上传目录里的文件是指向它的硬链接
+blobs = BlobStore('blobs')
+# 会话和验证码保存在服务端，cookie 里只有会话 id；多进程部署时把 'memory' 换成数据库文件路径
+session_backend = open_backend('memory')
+# 验证码和只取过验证码的匿名会话单独存放，不占用已登录会话的 LRU 容量
+captcha_backend = open_backend('memory')
+app.session_interface = ServerSideSessionInterface(session_backend, pending_backend=captcha_backend)
+captcha_store = ChallengeStore(captcha_backend)
 
 # 初始化数据库和登录管理器
 db = SQLAlchemy(app)
@@ -35,11 +51,14 @@ class User(UserMixin, db.Model):
 
     # 设置密码并进行哈希加密
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash(password)
 
     # 验证输入的密码是否正确
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        ok, new_hash = passwords.verify_and_update(self.password_hash, password)
+        if new_hash:
+            self.password_hash = new_hash  # 随本次登录的提交一起写回
+        return ok
 
 # 定义视频模型
 class Video(db.Model):
@@ -63,30 +82,21 @@ def random_captcha_text(length=5):
 # ----------------------------------------------------------------------------
 # 生成并返回验证码图片的路由
 @app.route('/captcha')
+@limiter.limit('30/minute', key=client_ip, methods=None)
 def get_captcha():
     text = random_captcha_text()
-    session['captcha_text'] = text
+    captcha_store.issue(text)
     image = ImageCaptcha(width=160, height=60)
     data = image.generate(text)
     return send_file(data, mimetype='image/png')
 # ----------------------------------------------------------------------------
-# 计算最长公共子序列的长度
-def lcs_length(s1, s2):
-    m, n = len(s1), len(s2)
-    # 初始化二维DP表
-    dp = []
-    for i in range(m + 1):
-        dp.append([0] * (n + 1))
-    
-    # 填充DP表
-    for i in range(m):
-        for j in range(n):
-            if s1[i].lower() == s2[j].lower():
-                dp[i + 1][j + 1] = dp[i][j] + 1
-            else:
-                dp[i + 1][j + 1] = max(dp[i][j + 1], dp[i + 1][j])
-    
-    return dp[m][n]
+# 用户名搜索索引，注册时增量加入，搜索前补齐其他进程新注册的用户
+username_index = UsernameIndex()
+
+def sync_username_index():
+    rows = User.query.with_entities(User.id, User.username) \
+        .filter(User.id > username_index.max_id).order_by(User.id).all()
+    username_index.sync(rows)
 # ----------------------------------------------------------------------------
 # 网站首页
 @app.route('/')
@@ -94,10 +104,11 @@ def index():
     return render_template('index.html')
 # 用户注册
 @app.route('/register', methods=['GET', 'POST'])
+@limiter.limit('10/hour', key=client_ip)
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
-        if form.captcha.data.upper() != session.get('captcha_text', ''):
+        if not captcha_store.verify(form.captcha.data.upper()):
             flash('验证码错误', 'danger')
             return redirect(url_for('register'))
         if User.query.filter_by(username=form.username.data).first():
@@ -107,19 +118,24 @@ def register():
         new_user.set_password(form.password.data)
         db.session.add(new_user)
         db.session.commit()
+        username_index.add(new_user.id, new_user.username)
         flash('注册成功，请登录', 'success')
         return redirect(url_for('login'))
     return render_template('register.html', form=form)
 # 用户登录
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('20/minute', key=client_ip)
+@limiter.limit('5/minute', key=form_username)
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        if form.captcha.data.upper() != session.get('captcha_text', ''):
+        if not captcha_store.verify(form.captcha.data.upper()):
             flash('验证码错误', 'danger')
             return redirect(url_for('login'))
         user = User.query.filter_by(username=form.username.data).first()
         if user and user.check_password(form.password.data):
+            db.session.commit()
+            regenerate_session()
             login_user(user)
             flash('登录成功', 'success')
             return redirect(url_for('index'))
@@ -135,6 +151,7 @@ def logout():
 # -------------------------------------------------------------------------
 # 视频上传功能
 @app.route('/upload', methods=['GET', 'POST'])
+@limiter.limit('60/hour', key=client_ip)
 @login_required
 def upload():
     form = UploadForm()
@@ -147,7 +164,7 @@ def upload():
             # 保存视频时加上用户名以防重复
             save_filename = f"{current_user.username}_{filename}"
             save_path = os.path.join(app.config['UPLOAD_FOLDER'], save_filename)
-            file.save(save_path)
+            blobs.save(file, save_path)
             video = Video(filename=save_path, owner=current_user)
             db.session.add(video)
             db.session.commit()
@@ -172,7 +189,7 @@ def play_video(video_id):
 @login_required
 def delete_video(video_id):
     # 查询要删除的视频
-    video = Video.query.get_or_404(video_id
+    video = Video.query.get_or_404(video_id)
     # 确保当前用户拥有该视频
     if video.user_id != current_user.id:
         flash('您无权删除此视频', 'error')
@@ -181,6 +198,10 @@ def delete_video(video_id):
         # 从数据库中删除视频
         db.session.delete(video)
         db.session.commit()
+        # 同名文件没有其他记录引用时才删除，内容没有其他引用时一并回收
+        shared = Video.query.filter_by(filename=video.filename).first()
+        if not shared and os.path.exists(video.filename):
+            blobs.unlink(video.filename)
         return jsonify({'message': '视频删除成功'}), 200
     except Exception as e:
         # 捕获删除过程中的错误
@@ -194,17 +215,15 @@ def search():
     users = []  # 存储搜索结果的用户列表
     if form.validate_on_submit():
         keyword = form.keyword.data.strip()
-        all_users = User.query.all()  # 查询所有用户
-        scored_users = []  # 用于记录匹配得分的用户
-        for user in all_users:
-            score = lcs_length(keyword, user.username)  # 计算用户名与关键词的匹配程度
-            if score > 0:
-                scored_users.append((score, user))  # 将匹配得分和用户对象存入列表
-        # 按照得分从高到低排序
-        scored_users.sort(key=lambda x: x[0], reverse=True)
-        # 提取前20个高分用户
-        for scored_user in scored_users[:20]:
-            users.append(scored_user[1])
+        sync_username_index()
+        # 通过索引剪枝后只对少量候选计算LCS，返回得分最高的前20个用户
+        ranked = username_index.search(keyword, limit=20)
+        if ranked:
+            found = User.query.filter(User.id.in_([user_id for _, user_id in ranked])).all()
+            by_id = {user.id: user for user in found}
+            for _, user_id in ranked:
+                if user_id in by_id:
+                    users.append(by_id[user_id])
     return render_template('search.html', form=form, users=users)
 # --------------------------------------------------------------------------
 # 应用程序的主入口
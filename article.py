@@ -3,50 +3,64 @@ import sqlite3
 import os
 import random
 import string
+from lcs import lcs_length
+from sqlite_pool import SQLitePool
+from migrations import run_migrations
+from rate_limit import RateLimiter, open_counter, client_ip, form_username
 # ----------------------------------------
 # 初始化 Flask 应用
 # ----------------------------------------
 app = Flask(__name__)
+# 登录、注册、验证码和上传限流；多进程部署时把 'memory' 换成数据库文件路径
+limiter = RateLimiter(open_counter('memory'))
 app.secret_key = 'your_secret_key'
 
 # 确保存储文章的目录存在
 if not os.path.exists('articles'):
     os.makedirs('articles')
 
+# 数据库连接池，连接复用，避免每次查询都重新打开数据库
+db_pool = SQLitePool('users.db')
+
 # ----------------------------------------
 # 初始化数据库
 # ----------------------------------------
-def init_db():
-    """初始化数据库，创建必要的表格"""
-    conn = sqlite3.connect('users.db')
-    cur = conn.cursor()
-    
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL
-    )''')
-    
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS articles (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        title TEXT NOT NULL,
-        filepath TEXT NOT NULL,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )''')
-    
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS progress (
-        user_id INTEGER,
-        article_id INTEGER,
-        page INTEGER,
-        PRIMARY KEY (user_id, article_id)
-    )''')
+# 数据库结构迁移，版本号记录在 PRAGMA user_version 中，新的变更只能追加在末尾
+MIGRATIONS = [
+    # 1: 初始表结构
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL
+        )''',
+        '''
+        CREATE TABLE IF NOT EXISTS articles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            filepath TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )''',
+        '''
+        CREATE TABLE IF NOT EXISTS progress (
+            user_id INTEGER,
+            article_id INTEGER,
+            page INTEGER,
+            PRIMARY KEY (user_id, article_id)
+        )''',
+    ],
+    # 2: 按作者查文章
+    [
+        'CREATE INDEX IF NOT EXISTS idx_articles_user_id ON articles(user_id)',
+    ],
+]
 
-    conn.commit()
-    cur.close()
+def init_db():
+    """初始化数据库：把表结构迁移到最新版本"""
+    conn = db_pool.acquire()
+    run_migrations(conn, MIGRATIONS)
     conn.close()
 
 # ----------------------------------------
@@ -54,7 +68,7 @@ def init_db():
 # ----------------------------------------
 def query_db(query, args=(), one=False):
     """执行数据库查询并返回结果"""
-    conn = sqlite3.connect('users.db')
+    conn = db_pool.acquire()
     cur = conn.cursor()
     cur.execute(query, args)
     rv = cur.fetchall()
@@ -75,22 +89,8 @@ def generate_captcha():
 # 最长公共子序列计算函数
 # ----------------------------------------
 def lcs(X, Y):
-    """计算两个字符串之间的最长公共子序列"""
-    m = len(X)
-    n = len(Y)
-    L = [[0] * (n + 1) for i in range(m + 1)]
-
-    # 填充二维数组进行LCS计算
-    for i in range(m + 1):
-        for j in range(n + 1):
-            if i == 0 or j == 0:
-                L[i] [j] = 0
-            elif X[i-1] == Y[j-1]:
-                L[i] [j] = L[i-1] [j-1] + 1
-            else:
-                L[i] [j] = max(L[i-1] [j], L[i] [j-1])
-
-    return L[m] [n]
+    """计算两个字符串之间的最长公共子序列长度（位并行实现见 lcs.py）"""
+    return lcs_length(X, Y)
 
 # ----------------------------------------
 # 分页函数
@@ -115,6 +115,7 @@ def index():
 # 用户注册
 # ----------------------------------------
 @app.route('/register', methods=['GET', 'POST'])
+@limiter.limit('10/hour', key=client_ip)
 def register():
     """注册新用户"""
     if request.method == 'POST':
@@ -138,6 +139,8 @@ def register():
 # 用户登录
 # ----------------------------------------
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('20/minute', key=client_ip)
+@limiter.limit('5/minute', key=form_username)
 def login():
     """用户登录"""
     if request.method == 'POST':
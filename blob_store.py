@@ -0,0 +1,317 @@
+"""
+按内容寻址、去重的上传文件存储。
+
+上传内容边接收边计算 sha256，写入临时文件后以摘要为名放进 objects/ 目录，
+相同内容只保存一份；用户看到的文件名是指向这份内容的硬链接，
+所以读取、播放、转码等代码仍然按原来的路径访问文件，不需要任何改动。
+
+    blobs = BlobStore('blobs')              # 需要和上传目录在同一个文件系统上
+    digest = blobs.save(request.files['video'], filepath)
+    filename = blobs.save_new(request.files['video'], upload_dir, original_name)  # 新文件，名字不冲突
+    ...
+    blobs.unlink(filepath)                  # 代替 os.remove
+
+- 引用计数保存在 blobs.db 中，unlink 后计数为 0 的内容立即删除
+- 文件系统的硬链接数是真正的依据：目录被整体删除、移动等绕过本模块的操作
+  只会让数据库里的计数暂时不准，后台线程定期按硬链接数修正计数并回收没有引用的内容
+- 硬链接失败（跨文件系统、不支持硬链接）时退回普通复制，这份文件不参与去重
+- 同一内容的所有文件名共享一个 inode，覆盖已有文件必须先写新文件再 os.replace，
+  不能就地写入，save() 就是这样做的
+"""
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+from sqlite_pool import SQLitePool
+from migrations import run_migrations
+from fast_copy import copy_file
+from storage_names import new_storage_file, reserve
+
+logger = logging.getLogger(__name__)
+
+READ_BLOCK = 1024 * 1024
+GC_INTERVAL = 3600             # 秒
+TMP_MAX_AGE = 24 * 3600        # 超过该时间的临时文件视为中断的上传，回收时删除
+
+MIGRATIONS = [
+    [
+        '''CREATE TABLE IF NOT EXISTS blobs (
+            digest TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_blobs_inode ON blobs(inode)',
+        'CREATE INDEX IF NOT EXISTS idx_blobs_refcount ON blobs(refcount)',
+    ],
+]
+
+
+def hash_stream(stream, dest):
+    """把 stream 的内容写入 dest 文件对象，同时计算 sha256，返回 (摘要, 字节数)"""
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        block = stream.read(READ_BLOCK)
+        if not block:
+            break
+        digest.update(block)
+        dest.write(block)
+        size += len(block)
+    return digest.hexdigest(), size
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(READ_BLOCK)
+            if not block:
+                break
+            digest.update(block)
+            size += len(block)
+    return digest.hexdigest(), size
+
+
+class BlobStore:
+    def __init__(self, root, gc_interval=GC_INTERVAL):
+        self.root = os.path.abspath(root)
+        self.objects_dir = os.path.join(self.root, 'objects')
+        self.tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.pool = SQLitePool(os.path.join(self.root, 'blobs.db'), row_factory=sqlite3.Row)
+        with self.pool.connection() as conn:
+            run_migrations(conn, MIGRATIONS)
+        self.gc_interval = gc_interval
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def blob_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _ensure_started(self):
+        if self.gc_interval is None:
+            return
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._gc_loop, name='blob-gc', daemon=True)
+            self._thread.start()
+
+    # -------- 写入 --------
+    def save(self, stream, path):
+        """
+        保存上传内容到 path（已存在时原子替换），返回内容摘要。
+        stream 可以是 werkzeug 的 FileStorage 或任何带 read() 的对象。
+        """
+        self._ensure_started()
+        tmp = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        try:
+            with open(tmp, 'xb') as dest:
+                digest, size = hash_stream(getattr(stream, 'stream', stream), dest)
+            return self._commit(tmp, digest, size, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def save_new(self, stream, directory, filename, keep_name=False):
+        """
+        在 directory 下为上传的 filename 原子地占用一个新名字并存入内容，返回实际使用的文件名。
+        默认用 uuid 存储名；keep_name=True 时尽量保留原名，重名时加随机后缀（见 storage_names）。
+        写入失败时删掉占位文件后抛出原来的异常。
+        """
+        name = reserve(directory, filename) if keep_name else new_storage_file(directory, filename)
+        path = os.path.join(directory, name)
+        try:
+            self.save(stream, path)
+        except BaseException:
+            self.unlink(path, missing_ok=True)
+            raise
+        return name
+
+    def save_file(self, source, path, remove_source=True):
+        """
+        把磁盘上已有的文件（例如分片上传拼好的 .part）存入，返回内容摘要。
+        存储的内容不会和 source 共用 inode，之后再写 source 不会改到已存的内容：
+        remove_source=True 时先把 source 移进临时目录（需要在同一个文件系统上），失败时移回；
+        remove_source=False 时先复制一份，支持 reflink 的文件系统上不占额外空间。
+        """
+        self._ensure_started()
+        tmp = os.path.join(self.tmp_dir, uuid.uuid4().hex)
+        try:
+            if remove_source:
+                os.replace(source, tmp)
+            else:
+                copy_file(source, tmp)
+            digest, size = hash_file(tmp)
+            return self._commit(tmp, digest, size, path)
+        except BaseException:
+            if remove_source and os.path.exists(tmp) and not os.path.exists(source):
+                os.replace(tmp, source)
+            raise
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _commit(self, source, digest, size, path):
+        blob = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        staging = f'{path}.{uuid.uuid4().hex}.tmp'
+        with self.pool.connection() as conn:
+            # 持有写锁，与 collect() 互斥，链接已有内容的同时它不会被回收
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                try:
+                    os.link(source, blob)
+                except FileExistsError:
+                    pass
+                os.link(blob, staging)
+            except OSError:
+                conn.rollback()
+                # 不支持硬链接（跨文件系统等），退回普通复制，这份文件不参与去重
+                shutil.copyfile(source, staging)
+                os.replace(staging, path)
+                return digest
+            conn.execute('''INSERT INTO blobs (digest, size, inode, refcount, created_at) VALUES (?, ?, ?, 1, ?)
+                            ON CONFLICT(digest) DO UPDATE SET refcount = refcount + 1, inode = excluded.inode''',
+                         (digest, size, os.stat(blob).st_ino, time.time()))
+        # 先记录引用再替换，替换失败时 unlink 暂存文件把计数减回去
+        try:
+            self._replace(staging, path)
+        except BaseException:
+            self.unlink(staging)
+            raise
+        return digest
+
+    def _replace(self, staging, path):
+        old = None
+        try:
+            old = os.lstat(path)
+        except FileNotFoundError:
+            pass
+        os.replace(staging, path)
+        if old is not None and old.st_nlink > 1:
+            # 覆盖了一个指向其他内容的文件名
+            self._release(old.st_ino)
+
+    def link(self, digest, path):
+        """给已有的内容再加一个文件名，例如服务器端复制"""
+        blob = self.blob_path(digest)
+        staging = f'{path}.{uuid.uuid4().hex}.tmp'
+        with self.pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            os.link(blob, staging)
+            conn.execute('UPDATE blobs SET refcount = refcount + 1 WHERE digest=?', (digest,))
+        self._replace(staging, path)
+
+    # -------- 删除和回收 --------
+    def digest_of(self, path):
+        """path 对应的内容摘要，不是本存储管理的文件返回 None"""
+        st = os.lstat(path)
+        if st.st_nlink < 2:
+            return None
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT digest FROM blobs WHERE inode=?', (st.st_ino,)).fetchone()
+        return row['digest'] if row else None
+
+    def unlink(self, path, missing_ok=False):
+        """删除一个文件名（代替 os.remove），内容没有其他引用时一并删除；missing_ok 时文件不存在不报错"""
+        try:
+            st = os.lstat(path)
+            os.remove(path)
+        except FileNotFoundError:
+            if missing_ok:
+                return
+            raise
+        if st.st_nlink > 1:
+            self._release(st.st_ino)
+
+    def _release(self, inode):
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT digest FROM blobs WHERE inode=?', (inode,)).fetchone()
+            if row is None:
+                return
+            conn.execute('UPDATE blobs SET refcount = refcount - 1 WHERE digest=?', (row['digest'],))
+        self.collect([row['digest']])
+
+    def collect(self, digests=None):
+        """
+        删除没有引用的内容。以硬链接数为准：计数为 0 但仍有硬链接的内容不会被删除。
+        digests 为 None 时检查所有计数为 0 的内容。
+        """
+        with self.pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if digests is None:
+                digests = [row['digest'] for row in conn.execute('SELECT digest FROM blobs WHERE refcount <= 0')]
+            removed = 0
+            for digest in digests:
+                blob = self.blob_path(digest)
+                try:
+                    st = os.stat(blob)
+                except FileNotFoundError:
+                    conn.execute('DELETE FROM blobs WHERE digest=?', (digest,))
+                    continue
+                if st.st_nlink > 1:
+                    conn.execute('UPDATE blobs SET refcount=? WHERE digest=?', (st.st_nlink - 1, digest))
+                    continue
+                os.remove(blob)
+                conn.execute('DELETE FROM blobs WHERE digest=?', (digest,))
+                removed += 1
+        return removed
+
+    def reconcile(self):
+        """按硬链接数修正所有计数，回收没有引用的内容和中断上传留下的临时文件"""
+        now = time.time()
+        for name in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, name)
+            try:
+                if now - os.path.getmtime(path) > TMP_MAX_AGE:
+                    os.remove(path)
+            except OSError:
+                continue
+        seen = set()
+        with self.pool.connection() as conn:
+            for shard in os.listdir(self.objects_dir):
+                shard_dir = os.path.join(self.objects_dir, shard)
+                if not os.path.isdir(shard_dir):
+                    continue
+                for entry in os.scandir(shard_dir):
+                    st = entry.stat(follow_symlinks=False)
+                    seen.add(entry.name)
+                    conn.execute('''INSERT INTO blobs (digest, size, inode, refcount, created_at) VALUES (?, ?, ?, ?, ?)
+                                    ON CONFLICT(digest) DO UPDATE SET refcount = excluded.refcount,
+                                    inode = excluded.inode''',
+                                 (entry.name, st.st_size, st.st_ino, st.st_nlink - 1, st.st_mtime))
+            for row in conn.execute('SELECT digest FROM blobs').fetchall():
+                if row['digest'] not in seen:
+                    conn.execute('DELETE FROM blobs WHERE digest=?', (row['digest'],))
+        return self.collect()
+
+    def stats(self):
+        """{'blobs': 内容份数, 'bytes': 实际占用, 'references': 文件名数, 'logical_bytes': 去重前的总大小}"""
+        with self.pool.connection() as conn:
+            row = conn.execute('''SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refcount), 0),
+                                  COALESCE(SUM(size * refcount), 0) FROM blobs''').fetchone()
+        return {'blobs': row[0], 'bytes': row[1], 'references': row[2], 'logical_bytes': row[3]}
+
+    def _gc_loop(self):
+        while True:
+            time.sleep(self.gc_interval)
+            try:
+                removed = self.reconcile()
+                if removed:
+                    logger.info('回收了 %d 份没有引用的内容', removed)
+            except Exception:
+                logger.exception('回收内容失败')
@@ -0,0 +1,90 @@
+"""
+预先渲染好的验证码池。
+
+后台线程提前生成 (文本, PNG 字节) 放进队列，/captcha 请求只需取出一个直接返回，
+绘图、滤镜和 PNG 编码都不再占用请求线程。每个验证码只会被取走一次；
+池子被取空时（例如瞬间大量请求）当场渲染一个，不会让请求等待。
+"""
+import collections
+import io
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 64
+
+
+def to_png(image):
+    """把 PIL 图片编码为 PNG 字节"""
+    buf = io.BytesIO()
+    image.save(buf, 'PNG')
+    return buf.getvalue()
+
+
+class CaptchaPool:
+    def __init__(self, make_text, render, size=DEFAULT_POOL_SIZE, low_water=None):
+        """
+        make_text(): 生成验证码文本
+        render(text): 返回该文本的 PNG 字节
+        size: 池中最多保留的验证码数；low_water: 剩余数低于该值时唤醒后台线程补充
+        """
+        self.make_text = make_text
+        self.render = render
+        self.size = size
+        self.low_water = size // 2 if low_water is None else low_water
+        self._items = collections.deque()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _new(self):
+        text = self.make_text()
+        return text, self.render(text)
+
+    def _ensure_thread(self):
+        # 延迟到第一次使用时启动；fork 出的工作进程没有父进程的线程，需要重新启动
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._items.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._refill, name='captcha-refill', daemon=True)
+            self._thread.start()
+
+    def _refill(self):
+        while True:
+            try:
+                while len(self._items) < self.size:
+                    self._items.append(self._new())
+            except Exception:
+                logger.exception('预生成验证码失败')
+                time.sleep(1)
+                continue
+            self._wakeup.clear()
+            # 再检查一次，避免 clear 之前被取走的通知丢失
+            if len(self._items) < self.low_water:
+                continue
+            self._wakeup.wait()
+
+    def get(self):
+        """取出一个 (文本, PNG 字节)，取出后即从池中移除"""
+        self._ensure_thread()
+        try:
+            item = self._items.popleft()
+        except IndexError:
+            item = self._new()
+        if len(self._items) < self.low_water:
+            self._wakeup.set()
+        return item
+
+    def warm_up(self):
+        """同步填满池子，应用启动时调用可以避免首批请求现场渲染"""
+        self._ensure_thread()
+        while len(self._items) < self.size:
+            self._items.append(self._new())
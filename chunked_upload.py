@@ -0,0 +1,316 @@
+"""
+大文件分片、可断点续传的上传协议。
+
+    POST {prefix}/init                    {"filename", "size", "chunk_size"?}
+         -> {"upload_id", "chunk_size", "chunks"}
+    PUT  {prefix}/<upload_id>/<index>     请求体为第 index 片的原始字节
+         头部 X-Chunk-Offset: 该片起始偏移（必须等于 index*chunk_size）
+              X-Chunk-SHA256: 该片内容的 sha256 十六进制摘要
+    GET  {prefix}/<upload_id>             -> {"received": [...], "missing": [...]}
+    POST {prefix}/<upload_id>/finalize    所有分片到齐后，交给应用的 finalize 回调入库；
+                                          同一个上传同时只有一个 finalize 在执行，其余返回 409
+
+分片按偏移直接写进同一个 .part 文件（os.pwrite），请求体按块读取，内存占用固定；
+每片是否到齐记录在 .chunks 位图文件中（每片一个字节），多个工作进程并发写不同分片互不影响。
+断线后客户端 GET 状态，只补传 missing 中的分片即可。
+"""
+import hashlib
+import json
+import os
+import time
+import uuid
+
+from flask import jsonify, request
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024   # 默认每片8MB，需小于 MAX_CONTENT_LENGTH
+MAX_CHUNK_SIZE = 32 * 1024 * 1024
+READ_BLOCK = 64 * 1024                 # 读取请求体的块大小
+EXPIRE_SECONDS = 24 * 3600             # 超过该时间没有新分片的上传会被清理
+CLEANUP_INTERVAL = 3600                # 两次清理之间的最短间隔（秒）
+
+
+class ChunkedUploadError(Exception):
+    def __init__(self, msg, status=400):
+        super().__init__(msg)
+        self.msg = msg
+        self.status = status
+
+
+class ChunkedUploadStore:
+    def __init__(self, upload_folder, max_size=None, allowed_file=None):
+        self.state_dir = os.path.join(upload_folder, '.chunked')
+        self.max_size = max_size
+        self.allowed_file = allowed_file
+        self._last_cleanup = 0
+        os.makedirs(self.state_dir, exist_ok=True)
+
+    def _paths(self, upload_id):
+        # upload_id 只能是 uuid 十六进制，防止路径穿越
+        if len(upload_id) != 32 or not all(c in '0123456789abcdef' for c in upload_id):
+            raise ChunkedUploadError('上传任务不存在', 404)
+        base = os.path.join(self.state_dir, upload_id)
+        return base + '.json', base + '.part', base + '.chunks'
+
+    def load(self, upload_id, owner):
+        meta_path, _, _ = self._paths(upload_id)
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            raise ChunkedUploadError('上传任务不存在', 404)
+        if meta['owner'] != owner:
+            raise ChunkedUploadError('无权访问该上传任务', 403)
+        return meta
+
+    # 创建上传任务，预先分配 .part 和 .chunks 文件
+    def create(self, owner, filename, size, chunk_size=None):
+        if not filename or (self.allowed_file and not self.allowed_file(filename)):
+            raise ChunkedUploadError('不支持的文件格式')
+        if not isinstance(size, int) or size <= 0:
+            raise ChunkedUploadError('文件大小无效')
+        if self.max_size and size > self.max_size:
+            raise ChunkedUploadError('文件过大', 413)
+        chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        if not isinstance(chunk_size, int) or chunk_size <= 0 or chunk_size > MAX_CHUNK_SIZE:
+            raise ChunkedUploadError('分片大小无效')
+        upload_id = uuid.uuid4().hex
+        meta_path, part_path, chunks_path = self._paths(upload_id)
+        chunks = (size + chunk_size - 1) // chunk_size
+        meta = {'upload_id': upload_id, 'owner': owner, 'filename': filename,
+                'size': size, 'chunk_size': chunk_size, 'chunks': chunks,
+                'created_at': time.time()}
+        try:
+            with open(part_path, 'wb') as f:
+                f.truncate(size)
+            with open(chunks_path, 'wb') as f:
+                f.truncate(chunks)
+        except OSError:
+            # 大小超出文件系统限制或磁盘已满
+            self.discard(upload_id)
+            raise ChunkedUploadError('无法分配存储空间', 413)
+        tmp_path = meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+        return meta
+
+    # 把请求体写入第 index 片，校验通过后在位图中标记
+    def write_chunk(self, upload_id, owner, index, offset, checksum, stream):
+        meta = self.load(upload_id, owner)
+        meta_path, part_path, chunks_path = self._paths(upload_id)
+        if index < 0 or index >= meta['chunks']:
+            raise ChunkedUploadError('分片序号越界')
+        if os.path.exists(self._claim_path(upload_id)):
+            raise ChunkedUploadError('该上传正在完成，不能再写入分片', 409)
+        start = index * meta['chunk_size']
+        if offset != start:
+            raise ChunkedUploadError('分片偏移不匹配')
+        expected = min(meta['chunk_size'], meta['size'] - start)
+        # 先清掉位图标记再覆盖数据：重传的分片如果不完整或校验失败，
+        # 这一片会重新算作缺失，而不是带着被覆盖的坏数据被 finalize 拼进文件
+        self._mark(chunks_path, index, b'\x00')
+        digest = hashlib.sha256()
+        written = 0
+        fd = os.open(part_path, os.O_WRONLY)
+        try:
+            while True:
+                block = stream.read(min(READ_BLOCK, expected + 1 - written))
+                if not block:
+                    break
+                written += len(block)
+                if written > expected:
+                    raise ChunkedUploadError('分片长度超出')
+                digest.update(block)
+                os.pwrite(fd, block, start + written - len(block))
+        finally:
+            os.close(fd)
+        if written != expected:
+            raise ChunkedUploadError('分片长度不完整')
+        if checksum and digest.hexdigest() != checksum.lower():
+            raise ChunkedUploadError('分片校验失败')
+        self._mark(chunks_path, index, b'\x01')
+        # 元数据文件的 mtime 记录最后一次活动时间，cleanup 按它判断是否已废弃
+        os.utime(meta_path)
+        return meta
+
+    @staticmethod
+    def _mark(chunks_path, index, flag):
+        fd = os.open(chunks_path, os.O_WRONLY)
+        try:
+            os.pwrite(fd, flag, index)
+        finally:
+            os.close(fd)
+
+    def received(self, upload_id):
+        _, _, chunks_path = self._paths(upload_id)
+        with open(chunks_path, 'rb') as f:
+            bitmap = f.read()
+        return [i for i, flag in enumerate(bitmap) if flag]
+
+    def status(self, upload_id, owner):
+        meta = self.load(upload_id, owner)
+        received = self.received(upload_id)
+        got = set(received)
+        missing = [i for i in range(meta['chunks']) if i not in got]
+        return meta, received, missing
+
+    # 全部分片到齐后返回 (meta, .part 路径)，由调用方移动到最终位置
+    def complete(self, upload_id, owner):
+        meta, _, missing = self.status(upload_id, owner)
+        if missing:
+            raise ChunkedUploadError(f'还有 {len(missing)} 个分片未上传', 409)
+        _, part_path, _ = self._paths(upload_id)
+        return meta, part_path
+
+    def claim(self, upload_id, owner):
+        """
+        用 O_EXCL 创建 .finalizing 标记，同一个上传同时只有一个 finalize 能继续，
+        其余的得到 409；finalize 失败时调用 unclaim() 以便客户端重试
+        """
+        self.load(upload_id, owner)
+        try:
+            fd = os.open(self._claim_path(upload_id), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            raise ChunkedUploadError('该上传正在完成，请勿重复提交', 409)
+        os.close(fd)
+
+    def unclaim(self, upload_id):
+        try:
+            os.remove(self._claim_path(upload_id))
+        except FileNotFoundError:
+            pass
+
+    def _claim_path(self, upload_id):
+        return os.path.splitext(self._paths(upload_id)[0])[0] + '.finalizing'
+
+    def discard(self, upload_id):
+        for path in self._paths(upload_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.unclaim(upload_id)
+
+    # 清理长时间没有活动的上传，正在传输的大文件不受创建时间影响
+    def cleanup(self, max_age=EXPIRE_SECONDS):
+        now = time.time()
+        for name in os.listdir(self.state_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.state_dir, name)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    self.discard(name[:-5])
+            except (OSError, ChunkedUploadError):
+                continue
+
+    def maybe_cleanup(self):
+        """距上次清理超过 CLEANUP_INTERVAL 时清理一次，长期运行的进程也能回收废弃的 .part"""
+        now = time.time()
+        if now - self._last_cleanup < CLEANUP_INTERVAL:
+            return
+        self._last_cleanup = now
+        self.cleanup()
+
+
+def _to_int(value):
+    """JSON 里的数字或表单里的数字字符串转为 int，None 保持不变，其他类型视为无效"""
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f'无效的整数：{value!r}')
+    return int(value)
+
+
+def register_chunked_upload(app, store, get_owner, finalize, url_prefix='/upload/chunked',
+                            decorator=None):
+    """
+    在 app 上注册分片上传路由。
+    get_owner(): 返回当前登录用户的标识（未登录返回 None）
+    finalize(meta, part_path): 把 .part 文件移动到最终位置并在同一事务中写入数据库，
+        返回 Flask 响应；失败时不移动 .part 文件，客户端可以重试 finalize。
+    decorator: 可选的视图装饰器，例如各应用自己的 login_required
+    """
+    store.maybe_cleanup()
+
+    def wrap(view, endpoint):
+        view.__name__ = endpoint
+        return decorator(view) if decorator else view
+
+    def error(e):
+        return jsonify({'success': False, 'msg': e.msg}), e.status
+
+    def owner_or_error():
+        owner = get_owner()
+        if owner is None:
+            raise ChunkedUploadError('请先登录', 401)
+        return owner
+
+    def init():
+        store.maybe_cleanup()
+        try:
+            data = request.get_json(silent=True) or request.form
+            if not hasattr(data, 'get'):
+                raise ValueError('请求体不是对象')
+            filename = data.get('filename', '')
+            size = _to_int(data.get('size'))
+            chunk_size = _to_int(data.get('chunk_size')) or None
+            if not isinstance(filename, str):
+                raise ValueError('文件名无效')
+            meta = store.create(owner_or_error(), filename.strip(), size, chunk_size)
+        except ValueError:
+            return jsonify({'success': False, 'msg': '参数无效'}), 400
+        except ChunkedUploadError as e:
+            return error(e)
+        return jsonify({'success': True, 'upload_id': meta['upload_id'],
+                        'chunk_size': meta['chunk_size'], 'chunks': meta['chunks']})
+
+    def put_chunk(upload_id, index):
+        try:
+            offset = int(request.headers.get('X-Chunk-Offset', ''))
+            store.write_chunk(upload_id, owner_or_error(), index, offset,
+                              request.headers.get('X-Chunk-SHA256'), request.stream)
+        except ValueError:
+            return jsonify({'success': False, 'msg': '分片偏移无效'}), 400
+        except ChunkedUploadError as e:
+            return error(e)
+        return jsonify({'success': True, 'received': index})
+
+    def status(upload_id):
+        try:
+            meta, received, missing = store.status(upload_id, owner_or_error())
+        except ChunkedUploadError as e:
+            return error(e)
+        return jsonify({'success': True, 'size': meta['size'], 'chunk_size': meta['chunk_size'],
+                        'chunks': meta['chunks'], 'received': received, 'missing': missing})
+
+    def finish(upload_id):
+        try:
+            owner = owner_or_error()
+            store.claim(upload_id, owner)
+        except ChunkedUploadError as e:
+            return error(e)
+        try:
+            meta, part_path = store.complete(upload_id, owner)
+            response = finalize(meta, part_path)
+        except ChunkedUploadError as e:
+            store.unclaim(upload_id)
+            return error(e)
+        except BaseException:
+            store.unclaim(upload_id)
+            raise
+        # finalize 已把 .part 移走才算完成，否则保留状态以便重试
+        if not os.path.exists(part_path):
+            store.discard(upload_id)
+        else:
+            store.unclaim(upload_id)
+        return response
+
+    app.add_url_rule(url_prefix + '/init', 'chunked_upload_init',
+                     wrap(init, 'chunked_upload_init'), methods=['POST'])
+    app.add_url_rule(url_prefix + '/<upload_id>/<int:index>', 'chunked_upload_chunk',
+                     wrap(put_chunk, 'chunked_upload_chunk'), methods=['PUT'])
+    app.add_url_rule(url_prefix + '/<upload_id>', 'chunked_upload_status',
+                     wrap(status, 'chunked_upload_status'), methods=['GET'])
+    app.add_url_rule(url_prefix + '/<upload_id>/finalize', 'chunked_upload_finalize',
+                     wrap(finish, 'chunked_upload_finalize'), methods=['POST'])
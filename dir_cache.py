@@ -0,0 +1,220 @@
+"""
+目录列表缓存。
+
+os.listdir 之后再对每一项 os.path.isdir 会多出一次 stat，网络文件系统上目录一大就很慢。
+这里用 os.scandir 一次拿到文件名和类型（DirEntry 自带 d_type，通常不需要额外 stat），
+结果按目录缓存在内存里，热路径上直接返回缓存。
+
+缓存失效有三种途径：
+- 应用自己上传、删除、建目录、移动之后调用 invalidate()
+- Linux 上用 inotify 监视已缓存的目录，其他进程或手工修改也能及时失效
+- 没有 inotify 的平台退回比较目录的 mtime，每次读取只多一次 stat
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+from collections import OrderedDict
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """最小的 inotify 封装，只用到添加/删除监视和读取事件"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add = libc.inotify_add_watch
+        self._add.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm = libc.inotify_rm_watch
+        self._rm.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 失败')
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'无法监视目录 {path}')
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm(self.fd, wd)
+
+    def read_events(self, timeout=None):
+        """等待并读取一批事件，返回 [(wd, mask), ...]"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            events.append((wd, mask))
+            offset += EVENT_HEADER.size + length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def inotify_supported():
+    return sys.platform.startswith('linux') and ctypes.util.find_library('c') is not None
+
+
+class DirCache:
+    def __init__(self, max_dirs=1024, watch=True):
+        """max_dirs: 最多缓存的目录数，超出时淘汰最久未使用的；watch: 可用时启用 inotify"""
+        self.max_dirs = max_dirs
+        self._entries = OrderedDict()      # 规范化路径 -> (mtime_ns 或 None, [(name, is_dir), ...])
+        self._watches = {}                 # 路径 -> wd
+        self._paths = {}                   # wd -> 路径
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._inotify = None
+        self._pid = None
+        self.watch = watch and inotify_supported()
+
+    def _ensure_watcher(self):
+        # 延迟到第一次使用时启动；fork 出的子进程需要自己的 inotify 实例
+        if not self.watch or (self._inotify is not None and self._pid == os.getpid()):
+            return
+        self._entries.clear()
+        self._watches.clear()
+        self._paths.clear()
+        try:
+            self._inotify = Inotify()
+        except OSError:
+            self.watch = False
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._watch_loop, args=(self._inotify,), name='dir-cache-inotify',
+                         daemon=True).start()
+
+    def _watch_loop(self, inotify):
+        while self._inotify is inotify:
+            try:
+                events = inotify.read_events(1.0)
+            except (OSError, ValueError):
+                return
+            if not events:
+                continue
+            with self._lock:
+                for wd, mask in events:
+                    if wd == -1 or mask & IN_Q_OVERFLOW:
+                        # 事件队列溢出，丢失的事件无从得知，整个缓存作废
+                        self._generation += 1
+                        self._entries.clear()
+                        continue
+                    path = self._paths.get(wd)
+                    if path is None:
+                        continue
+                    self._drop(path)
+                    if mask & IN_IGNORED:
+                        # 目录被删除或监视被移除
+                        self._paths.pop(wd, None)
+                        if self._watches.get(path) == wd:
+                            del self._watches[path]
+
+    def _drop(self, path):
+        self._generation += 1
+        self._entries.pop(path, None)
+
+    def _unwatch(self, path):
+        wd = self._watches.pop(path, None)
+        if wd is not None:
+            self._paths.pop(wd, None)
+            try:
+                self._inotify.rm_watch(wd)
+            except OSError:
+                pass
+
+    def entries(self, path):
+        """返回目录下的 [(名称, 是否目录), ...]，按名称排序；目录不存在时抛出 OSError"""
+        path = os.path.abspath(path)
+        with self._lock:
+            self._ensure_watcher()
+            cached = self._entries.get(path)
+            generation = self._generation
+        if cached is not None:
+            mtime, items = cached
+            # 未启用 inotify 时用目录 mtime 判断是否变化
+            if mtime is None or os.stat(path).st_mtime_ns == mtime:
+                with self._lock:
+                    if path in self._entries:
+                        self._entries.move_to_end(path)
+                return items
+
+        # 先建立监视再读目录，读的过程中发生的变化也会让这份结果失效
+        if self.watch and path not in self._watches:
+            try:
+                wd = self._inotify.add_watch(path)
+            except OSError:
+                wd = None
+            if wd is not None:
+                with self._lock:
+                    self._watches[path] = wd
+                    self._paths[wd] = path
+        mtime = None if path in self._watches else os.stat(path).st_mtime_ns
+        with os.scandir(path) as it:
+            items = sorted((entry.name, entry.is_dir()) for entry in it)
+        with self._lock:
+            if self._generation == generation:
+                self._entries[path] = (mtime, items)
+                self._entries.move_to_end(path)
+                while len(self._entries) > self.max_dirs:
+                    old, _ = self._entries.popitem(last=False)
+                    self._unwatch(old)
+        return items
+
+    def names(self, path):
+        """只返回文件名（不含子目录），目录不存在时返回空列表"""
+        try:
+            return [name for name, is_dir in self.entries(path) if not is_dir]
+        except FileNotFoundError:
+            return []
+
+    def invalidate(self, *paths, recursive=False):
+        """
+        使目录缓存失效。修改某个目录的内容后传入该目录；
+        删除或移动目录时传入它本身和父目录，并设 recursive=True 让子目录一并失效。
+        """
+        with self._lock:
+            for path in paths:
+                path = os.path.abspath(path)
+                self._drop(path)
+                if recursive:
+                    prefix = path.rstrip(os.sep) + os.sep
+                    for key in [k for k in self._entries if k.startswith(prefix)]:
+                        self._drop(key)
+                    for key in [k for k in self._watches if k == path or k.startswith(prefix)]:
+                        self._unwatch(key)
+
+    def close(self):
+        with self._lock:
+            inotify, self._inotify = self._inotify, None
+            self._entries.clear()
+            self._watches.clear()
+            self._paths.clear()
+        if inotify is not None and self._pid == os.getpid():
+            inotify.close()
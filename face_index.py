@@ -0,0 +1,256 @@
+"""
+持久化的人脸特征索引。
+
+目录结构：
+- vectors.f32   float32 特征矩阵，按行存放，用 np.memmap 映射，容量不够时翻倍扩展
+- clusters.i32  每行所属的 IVF 分区编号，未建分区索引时为 -1
+- centroids.npy IVF 分区中心（可选）
+- meta.db       SQLite，记录每行来自哪张图片的第几张脸、标签等；行数以它为准。
+                另有 indexed_images 表记录处理过的图片，没有人脸或读取失败的图片也在其中，
+                重新扫描目录时不会再处理一遍
+
+查询默认是向量化的暴力搜索：|q|^2 + |x|^2 - 2qx 一次矩阵乘法算出全部距离，
+再用 argpartition 取前 k 个，几十万条 128 维特征也只需要毫秒级。
+图库很大时可以调用 build_ivf() 建立分区索引，查询时只扫描离查询最近的 nprobe 个分区。
+"""
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from sqlite_pool import SQLitePool
+from migrations import run_migrations
+
+DEFAULT_DIM = 128
+INITIAL_CAPACITY = 1024
+ASSIGN_CHUNK = 8192
+
+MIGRATIONS = [
+    [
+        '''CREATE TABLE IF NOT EXISTS faces (
+            id INTEGER PRIMARY KEY,
+            image_path TEXT NOT NULL,
+            face_index INTEGER NOT NULL,
+            label TEXT,
+            created_at REAL NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_faces_image_path ON faces(image_path)',
+    ],
+    [
+        '''CREATE TABLE IF NOT EXISTS indexed_images (
+            image_path TEXT PRIMARY KEY,
+            faces INTEGER NOT NULL,
+            indexed_at REAL NOT NULL
+        )''',
+        # 已有索引里有人脸的图片都已处理过
+        '''INSERT OR IGNORE INTO indexed_images (image_path, faces, indexed_at)
+           SELECT image_path, COUNT(*), MAX(created_at) FROM faces GROUP BY image_path''',
+    ],
+]
+
+
+def squared_distances(queries, vectors, vector_sqnorms):
+    """queries (q, d) 与 vectors (n, d) 之间的欧氏距离平方，返回 (q, n)"""
+    sq = (queries * queries).sum(axis=1)[:, None] + vector_sqnorms[None, :] - 2.0 * (queries @ vectors.T)
+    np.maximum(sq, 0.0, out=sq)
+    return sq
+
+
+def top_k_rows(sq, k):
+    """每行取最小的 k 个，返回 (距离, 列下标)，按距离升序"""
+    k = min(k, sq.shape[1])
+    if k == 0:
+        return np.empty((sq.shape[0], 0), dtype=np.float32), np.empty((sq.shape[0], 0), dtype=np.int64)
+    part = np.argpartition(sq, k - 1, axis=1)[:, :k]
+    part_sq = np.take_along_axis(sq, part, axis=1)
+    order = np.argsort(part_sq, axis=1)
+    return np.sqrt(np.take_along_axis(part_sq, order, axis=1)), np.take_along_axis(part, order, axis=1)
+
+
+def kmeans(data, nlist, iters=10, seed=0):
+    """简单的 Lloyd k-means，返回 (nlist, d) 的中心"""
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(len(data), nlist, replace=False)].copy()
+    for _ in range(iters):
+        labels = assign_clusters(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, data)
+        counts = np.bincount(labels, minlength=nlist)
+        # 空分区保留原中心
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+    return centroids
+
+
+def assign_clusters(data, centroids):
+    """分块计算每行最近的中心，避免一次生成 n x nlist 的大矩阵"""
+    norms = (centroids * centroids).sum(axis=1)
+    labels = np.empty(len(data), dtype=np.int32)
+    for start in range(0, len(data), ASSIGN_CHUNK):
+        chunk = np.asarray(data[start:start + ASSIGN_CHUNK], dtype=np.float32)
+        labels[start:start + len(chunk)] = squared_distances(chunk, centroids, norms).argmin(axis=1)
+    return labels
+
+
+class FaceIndex:
+    def __init__(self, directory, dim=DEFAULT_DIM):
+        self.directory = directory
+        self.dim = dim
+        os.makedirs(directory, exist_ok=True)
+        self.pool = SQLitePool(os.path.join(directory, 'meta.db'), row_factory=sqlite3.Row)
+        with self.pool.connection() as conn:
+            run_migrations(conn, MIGRATIONS)
+            row = conn.execute('SELECT MAX(id) FROM faces').fetchone()
+        # 写入特征后、提交元数据前崩溃的行不算数，下次插入时会被覆盖
+        self.count = 0 if row[0] is None else row[0] + 1
+        self._vectors_path = os.path.join(directory, 'vectors.f32')
+        self._clusters_path = os.path.join(directory, 'clusters.i32')
+        self._centroids_path = os.path.join(directory, 'centroids.npy')
+        capacity = INITIAL_CAPACITY
+        if os.path.exists(self._vectors_path):
+            capacity = max(capacity, os.path.getsize(self._vectors_path) // (4 * dim))
+        self._sqnorms = np.zeros(0, dtype=np.float32)
+        self._open(max(capacity, self.count))
+        self.centroids = np.load(self._centroids_path) if os.path.exists(self._centroids_path) else None
+        existing = self.vectors[:self.count]
+        self._sqnorms[:self.count] = np.einsum('ij,ij->i', existing, existing)
+
+    def _open(self, capacity):
+        for path, itemsize in ((self._vectors_path, 4 * self.dim), (self._clusters_path, 4)):
+            size = capacity * itemsize
+            if not os.path.exists(path) or os.path.getsize(path) < size:
+                existed = os.path.exists(path)
+                with open(path, 'r+b' if existed else 'wb') as f:
+                    old = f.seek(0, os.SEEK_END)
+                    f.truncate(size)
+                    if path == self._clusters_path:
+                        # 新增部分标记为未分区
+                        f.seek(old)
+                        f.write(np.full((size - old) // 4, -1, dtype=np.int32).tobytes())
+        self.capacity = capacity
+        self.vectors = np.memmap(self._vectors_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        self.clusters = np.memmap(self._clusters_path, dtype=np.int32, mode='r+', shape=(capacity,))
+        # 各行的 |x|^2，与特征矩阵同样按容量分配，追加时不用复制整个数组
+        sqnorms = np.zeros(capacity, dtype=np.float32)
+        sqnorms[:len(self._sqnorms)] = self._sqnorms
+        self._sqnorms = sqnorms
+
+    def _grow(self, needed):
+        capacity = self.capacity
+        while capacity < needed:
+            capacity *= 2
+        self.flush()
+        del self.vectors, self.clusters
+        self._open(capacity)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, encodings, image_path, face_indexes=None, label=None):
+        """
+        追加一张图片里的若干人脸特征，返回分配的 id 列表；没有人脸时只记录这张图片已处理。
+        特征只写入映射内存，不逐次 msync；批量写入结束后调用 flush() 或 close() 落盘。
+        """
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        if not len(encodings):
+            with self.pool.connection() as conn:
+                self._record_image(conn, image_path, 0, time.time())
+            return []
+        if face_indexes is None:
+            face_indexes = range(len(encodings))
+        start, end = self.count, self.count + len(encodings)
+        if end > self.capacity:
+            self._grow(end)
+        self.vectors[start:end] = encodings
+        if self.centroids is not None:
+            self.clusters[start:end] = assign_clusters(encodings, self.centroids)
+        now = time.time()
+        with self.pool.connection() as conn:
+            conn.executemany('INSERT INTO faces (id, image_path, face_index, label, created_at) VALUES (?, ?, ?, ?, ?)',
+                             [(start + i, image_path, int(face_index), label, now)
+                              for i, face_index in enumerate(face_indexes)])
+            self._record_image(conn, image_path, len(encodings), now)
+        self._sqnorms[start:end] = np.einsum('ij,ij->i', encodings, encodings)
+        self.count = end
+        return list(range(start, end))
+
+    def _record_image(self, conn, image_path, faces, now):
+        conn.execute('''INSERT INTO indexed_images (image_path, faces, indexed_at) VALUES (?, ?, ?)
+                        ON CONFLICT(image_path) DO UPDATE SET faces = faces + excluded.faces,
+                        indexed_at = excluded.indexed_at''', (image_path, faces, now))
+
+    def has_image(self, image_path):
+        """图片是否处理过，包括没有检测到人脸的图片"""
+        with self.pool.connection() as conn:
+            return conn.execute('SELECT 1 FROM indexed_images WHERE image_path=?', (image_path,)).fetchone() is not None
+
+    def metadata(self, ids):
+        """按 id 取元数据，顺序与 ids 一致，不存在的 id 返回 None"""
+        ids = [int(i) for i in ids]
+        if not ids:
+            return []
+        with self.pool.connection() as conn:
+            rows = conn.execute(f'SELECT * FROM faces WHERE id IN ({",".join("?" * len(ids))})', ids).fetchall()
+        by_id = {row['id']: dict(row) for row in rows}
+        return [by_id.get(i) for i in ids]
+
+    def search(self, queries, k=5, nprobe=None):
+        """
+        k 近邻查询，queries 为 (q, dim) 或单个 (dim,) 特征。
+        返回 (距离, id)，每行按距离升序。
+        已建 IVF 索引时只扫描最近的 nprobe 个分区（默认 8 个），候选不足 k 个时用 inf / -1 补齐；
+        否则暴力搜索全部特征，索引里不足 k 条时只返回现有的条数。
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        vectors = self.vectors[:self.count]
+        if self.centroids is None or not self.count:
+            return top_k_rows(squared_distances(queries, vectors, self._sqnorms[:self.count]), k)
+        nprobe = min(nprobe or 8, len(self.centroids))
+        centroid_sq = squared_distances(queries, self.centroids, (self.centroids ** 2).sum(axis=1))
+        probes = np.argpartition(centroid_sq, nprobe - 1, axis=1)[:, :nprobe]
+        clusters = self.clusters[:self.count]
+        distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for qi in range(len(queries)):
+            candidates = np.flatnonzero(np.isin(clusters, probes[qi]))
+            if not len(candidates):
+                continue
+            sq = squared_distances(queries[qi:qi + 1], vectors[candidates], self._sqnorms[candidates])
+            d, cols = top_k_rows(sq, k)
+            distances[qi, :d.shape[1]] = d[0]
+            ids[qi, :d.shape[1]] = candidates[cols[0]]
+        return distances, ids
+
+    def build_ivf(self, nlist=None, iters=10, sample=50000, seed=0):
+        """
+        用 k-means 把现有特征划分为 nlist 个分区（默认约 4*sqrt(n)），
+        之后新加入的特征会自动归入最近的分区。
+        """
+        if not self.count:
+            raise ValueError('索引为空，无法建立分区')
+        nlist = min(nlist or max(1, int(4 * np.sqrt(self.count))), self.count)
+        vectors = self.vectors[:self.count]
+        rng = np.random.default_rng(seed)
+        rows = np.sort(rng.choice(self.count, min(sample, self.count), replace=False))
+        centroids = kmeans(np.asarray(vectors[rows]), max(1, min(nlist, len(rows))), iters, seed)
+        self.clusters[:self.count] = assign_clusters(vectors, centroids)
+        self.flush()
+        np.save(self._centroids_path, centroids)
+        self.centroids = centroids
+
+    def drop_ivf(self):
+        """删除分区索引，回到暴力搜索"""
+        self.centroids = None
+        self.clusters[:] = -1
+        self.flush()
+        if os.path.exists(self._centroids_path):
+            os.remove(self._centroids_path)
+
+    def flush(self):
+        self.vectors.flush()
+        self.clusters.flush()
+
+    def close(self):
+        self.flush()
+        self.pool.close_all()
@@ -0,0 +1,389 @@
+"""
+视频人脸识别后台任务。
+
+上传的视频按固定采样率抽帧，检测人脸并计算 128 维特征，把同一个人在相邻帧中的出现
+合并成一条"人脸轨迹"写入数据库，之后可以用一张照片查询"哪些视频里出现过这个人"。
+
+- 视频按时间切成若干段，每段在进程池里独立解码、检测、编码，只把人脸框和特征
+  传回主进程；同时在途的段数有上限，内存占用与视频长度无关
+- 主进程按时间顺序合并各段结果做轨迹关联：与仍在持续的轨迹比较平均特征，
+  距离小于 TRACK_THRESHOLD 的归入该轨迹，否则新建轨迹
+- 每处理完一段，就在同一个事务里写入轨迹和处理进度（resume_at），
+  进程崩溃后 resume_pending() 从上次提交的位置继续，不会重复或遗漏
+
+cv2 / face_recognition 只在工作进程里导入，Web 进程不安装它们也能启动，
+available() 为 False 时调用方应跳过提交。
+"""
+import importlib.util
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from jobs import JobQueue, process_context
+from sqlite_pool import SQLitePool
+from migrations import run_migrations, add_column
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_FPS = 1.0            # 每秒抽取的帧数
+SEGMENT_SECONDS = 60        # 每个进程池任务处理的视频时长
+DETECT_MAX_SIDE = 960       # 检测前把帧缩小到的最长边
+TRACK_THRESHOLD = 0.5       # 与轨迹平均特征的距离小于该值视为同一个人
+TRACK_GAP = 3.0             # 超过该秒数没再出现，轨迹结束
+MATCH_THRESHOLD = 0.6       # 按人脸查视频时的距离阈值
+
+MIGRATIONS = [
+    [
+        '''CREATE TABLE IF NOT EXISTS face_jobs (
+            video_key TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            resume_at REAL NOT NULL DEFAULT 0,
+            duration REAL,
+            error TEXT,
+            updated_at REAL NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS face_tracks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            video_key TEXT NOT NULL,
+            start_time REAL NOT NULL,
+            end_time REAL NOT NULL,
+            frames INTEGER NOT NULL,
+            encoding BLOB NOT NULL,
+            blurriness REAL NOT NULL,
+            box TEXT NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_face_tracks_video ON face_tracks(video_key, end_time)',
+        "CREATE INDEX IF NOT EXISTS idx_face_jobs_status ON face_jobs(status)",
+    ],
+    # 2: 每次提交的任务编号。同一个 video_key 重新提交（或被删除后复用）时，
+    #    旧任务按编号更新不到行，就不会把旧视频的轨迹写到新任务名下
+    add_column('face_jobs', 'job_id', "TEXT NOT NULL DEFAULT ''"),
+]
+
+
+# ---------------- 工作进程中执行的函数 ----------------
+
+def probe_video(path):
+    """返回 (帧率, 时长秒数)"""
+    import cv2
+    cap = cv2.VideoCapture(path)
+    try:
+        if not cap.isOpened():
+            raise OSError(f'无法打开视频: {path}')
+        fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+        frames = cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0
+        return fps, frames / fps
+    finally:
+        cap.release()
+
+
+def _encode_frame(bgr, detect_max_side):
+    import cv2
+    import face_recognition
+    from 人脸对比 import detect_faces, estimate_blurriness
+    rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+    locations = detect_faces(rgb, detect_max_side)
+    if not locations:
+        return []
+    faces = []
+    for loc, encoding in zip(locations, face_recognition.face_encodings(rgb, locations)):
+        top, right, bottom, left = loc
+        crop = bgr[top:bottom, left:right]
+        blur = float(estimate_blurriness(cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY))) if crop.size else 0.0
+        faces.append((loc, encoding.astype(np.float32), blur))
+    return faces
+
+
+def sample_segment(path, start, end, sample_fps, detect_max_side):
+    """
+    解码 [start, end) 秒之间的视频，按 sample_fps 抽帧做检测和编码。
+    抽样帧号按全片对齐（帧号是 step 的倍数），分段处理和整段处理抽到的帧相同。
+    返回 [(时间, [(人脸框, 特征, 清晰度), ...]), ...]，只包含检测到人脸的帧。
+    """
+    import cv2
+    cap = cv2.VideoCapture(path)
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+        step = max(1, round(fps / sample_fps))
+        frame_no = math.ceil(start * fps / step) * step
+        end_frame = math.ceil(end * fps)
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_no)
+        results = []
+        while frame_no < end_frame:
+            # 跳过的帧只 grab 不解码成图像
+            if not cap.grab():
+                break
+            if frame_no % step == 0:
+                ok, bgr = cap.retrieve()
+                if ok:
+                    faces = _encode_frame(bgr, detect_max_side)
+                    if faces:
+                        results.append((frame_no / fps, faces))
+            frame_no += 1
+        return results
+    finally:
+        cap.release()
+
+
+def encode_image_bytes(data, detect_max_side=None):
+    """解码上传的图片并返回其中每张脸的特征"""
+    import cv2
+    bgr = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if bgr is None:
+        raise ValueError('无法识别的图片')
+    return [encoding for _, encoding, _ in _encode_frame(bgr, detect_max_side)]
+
+
+# ---------------- 主进程：轨迹关联与持久化 ----------------
+
+class Track:
+    def __init__(self, id_, start, end, frames, encoding, blurriness, box):
+        self.id = id_
+        self.start = start
+        self.end = end
+        self.frames = frames
+        self.encoding = encoding          # 平均特征，float32
+        self.blurriness = blurriness      # 最清晰一帧的清晰度
+        self.box = box                    # 最清晰一帧的人脸框
+        self.dirty = False
+
+    def add(self, t, box, encoding, blur):
+        self.frames += 1
+        self.encoding = self.encoding + (encoding - self.encoding) / self.frames
+        self.end = t
+        if blur > self.blurriness:
+            self.blurriness, self.box = blur, box
+        self.dirty = True
+
+
+def associate(tracks, t, faces, threshold=TRACK_THRESHOLD):
+    """把一帧中的人脸分配给仍在持续的轨迹，距离由小到大贪心匹配；返回新建的轨迹"""
+    created = []
+    unmatched = list(range(len(faces)))
+    if tracks:
+        means = np.stack([track.encoding for track in tracks])
+        encodings = np.stack([encoding for _, encoding, _ in faces])
+        distances = np.linalg.norm(encodings[:, None, :] - means[None, :, :], axis=2)
+        used_faces, used_tracks = set(), set()
+        for fi, ti in zip(*np.unravel_index(np.argsort(distances, axis=None), distances.shape)):
+            if distances[fi, ti] > threshold:
+                break
+            if fi in used_faces or ti in used_tracks:
+                continue
+            used_faces.add(fi)
+            used_tracks.add(ti)
+            box, encoding, blur = faces[fi]
+            tracks[ti].add(t, box, encoding, blur)
+        unmatched = [i for i in unmatched if i not in used_faces]
+    for i in unmatched:
+        box, encoding, blur = faces[i]
+        track = Track(None, t, t, 1, encoding, blur, box)
+        track.dirty = True
+        created.append(track)
+    return created
+
+
+class FaceJobService:
+    def __init__(self, database, workers=2, sample_fps=SAMPLE_FPS, segment_seconds=SEGMENT_SECONDS,
+                 detect_max_side=DETECT_MAX_SIDE, max_in_flight=None):
+        """
+        workers: 解码/检测进程数；max_in_flight: 同时在途的视频段数，默认 workers 的 2 倍
+        """
+        self.pool = SQLitePool(database)
+        self.workers = workers
+        self.sample_fps = sample_fps
+        self.segment_seconds = segment_seconds
+        self.detect_max_side = detect_max_side
+        self.max_in_flight = max_in_flight or workers * 2
+        # 一次只处理一个视频，视频内部的各段在进程池里并行
+        self.queue = JobQueue(workers=1, name='faces')
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        with self.pool.connection() as conn:
+            run_migrations(conn, MIGRATIONS)
+
+    def available(self):
+        return all(importlib.util.find_spec(name) is not None for name in ('cv2', 'face_recognition'))
+
+    def _processes(self):
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                         mp_context=process_context())
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _discard(self, executor):
+        # 有工作进程异常退出（OOM、段错误）后整个进程池不可用，下次调用 _processes() 时重建
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    # 登记任务并加入队列，立即返回；重复提交同一个视频会从头重新处理，仍在运行的旧任务随之停止
+    def submit(self, video_key, path):
+        video_key = str(video_key)
+        job_id = uuid.uuid4().hex
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM face_tracks WHERE video_key=?', (video_key,))
+            conn.execute('''INSERT OR REPLACE INTO face_jobs (video_key, job_id, path, status, resume_at, updated_at)
+                            VALUES (?, ?, ?, 'pending', 0, ?)''',
+                         (video_key, job_id, os.path.abspath(path), time.time()))
+        self.queue.submit(self.process, video_key, job_id)
+
+    def resume_pending(self):
+        """启动时调用：把上次未完成的任务重新加入队列，从已提交的进度继续"""
+        with self.pool.connection() as conn:
+            jobs = conn.execute("SELECT video_key, job_id FROM face_jobs WHERE status IN ('pending', 'running') "
+                                'ORDER BY updated_at').fetchall()
+        for key, job_id in jobs:
+            self.queue.submit(self.process, key, job_id)
+        return len(jobs)
+
+    def remove(self, video_key):
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM face_tracks WHERE video_key=?', (str(video_key),))
+            conn.execute('DELETE FROM face_jobs WHERE video_key=?', (str(video_key),))
+
+    def status(self, video_key):
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT status, resume_at, duration FROM face_jobs WHERE video_key=?',
+                               (str(video_key),)).fetchone()
+        return None if row is None else {'status': row[0], 'resume_at': row[1], 'duration': row[2]}
+
+    def _set_status(self, video_key, job_id, status, error=None):
+        with self.pool.connection() as conn:
+            conn.execute('UPDATE face_jobs SET status=?, error=?, updated_at=? WHERE video_key=? AND job_id=?',
+                         (status, error, time.time(), video_key, job_id))
+
+    def _load_open_tracks(self, conn, video_key, resume_at):
+        rows = conn.execute('''SELECT id, start_time, end_time, frames, encoding, blurriness, box
+                               FROM face_tracks WHERE video_key=? AND end_time>=?''',
+                            (video_key, resume_at - TRACK_GAP)).fetchall()
+        return [Track(row[0], row[1], row[2], row[3], np.frombuffer(row[4], dtype=np.float32).copy(),
+                      row[5], tuple(int(v) for v in row[6].split(','))) for row in rows]
+
+    def _save(self, conn, video_key, tracks):
+        for track in tracks:
+            if not track.dirty:
+                continue
+            values = (track.start, track.end, track.frames, track.encoding.astype(np.float32).tobytes(),
+                      track.blurriness, ','.join(str(int(v)) for v in track.box))
+            if track.id is None:
+                track.id = conn.execute('''INSERT INTO face_tracks
+                    (video_key, start_time, end_time, frames, encoding, blurriness, box)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)''', (video_key,) + values).lastrowid
+            else:
+                conn.execute('''UPDATE face_tracks SET start_time=?, end_time=?, frames=?, encoding=?,
+                                blurriness=?, box=? WHERE id=?''', values + (track.id,))
+            track.dirty = False
+
+    def process(self, video_key, job_id):
+        for retry in (True, False):
+            executor = self._processes()
+            try:
+                self._process(video_key, job_id, executor)
+            except BrokenProcessPool as e:
+                self._discard(executor)
+                if retry:
+                    # 已提交的进度不受影响，换一个进程池后从 resume_at 继续
+                    logger.warning('人脸识别进程池异常退出，重建后继续处理视频 %s', video_key)
+                    continue
+                logger.exception('视频 %s 人脸识别失败', video_key)
+                self._set_status(video_key, job_id, 'failed', str(e)[-2000:])
+            except Exception as e:
+                logger.exception('视频 %s 人脸识别失败', video_key)
+                self._set_status(video_key, job_id, 'failed', str(e)[-2000:])
+            return
+
+    def _process(self, video_key, job_id, executor):
+        with self.pool.connection() as conn:
+            job = conn.execute('SELECT path, status, resume_at FROM face_jobs WHERE video_key=? AND job_id=?',
+                               (video_key, job_id)).fetchone()
+        # 任务已被删除或重新提交（由新的 job_id 处理），或者已经结束
+        if job is None or job[1] in ('done', 'failed'):
+            return
+        path, _, resume_at = job
+        _, duration = executor.submit(probe_video, path).result()
+        with self.pool.connection() as conn:
+            cursor = conn.execute("UPDATE face_jobs SET status='running', duration=?, updated_at=? "
+                                  'WHERE video_key=? AND job_id=?', (duration, time.time(), video_key, job_id))
+            if cursor.rowcount == 0:
+                return
+            tracks = self._load_open_tracks(conn, video_key, resume_at)
+        segments = deque()
+        t = resume_at
+        while t < duration:
+            segments.append((t, min(t + self.segment_seconds, duration)))
+            t += self.segment_seconds
+        in_flight = deque()
+        while segments or in_flight:
+            # 在途段数有上限，结果按时间顺序取回
+            while segments and len(in_flight) < self.max_in_flight:
+                start, end = segments.popleft()
+                in_flight.append((end, executor.submit(sample_segment, path, start, end,
+                                                       self.sample_fps, self.detect_max_side)))
+            end, future = in_flight.popleft()
+            for frame_time, faces in future.result():
+                active = [track for track in tracks if frame_time - track.end <= TRACK_GAP]
+                tracks.extend(associate(active, frame_time, faces))
+            with self.pool.connection() as conn:
+                cursor = conn.execute('UPDATE face_jobs SET resume_at=?, updated_at=? WHERE video_key=? AND job_id=?',
+                                      (end, time.time(), video_key, job_id))
+                if cursor.rowcount == 0:
+                    # 处理期间任务被 remove() 删除或重新提交，不再写入轨迹
+                    for _, pending in in_flight:
+                        pending.cancel()
+                    logger.info('视频 %s 的人脸识别任务已删除或重新提交，停止处理', video_key)
+                    return
+                self._save(conn, video_key, tracks)
+            # 已结束的轨迹不再参与关联
+            tracks = [track for track in tracks if end - track.end <= TRACK_GAP]
+        self._set_status(video_key, job_id, 'done')
+
+    def encode_image(self, data):
+        """在进程池里计算图片中每张脸的特征"""
+        executor = self._processes()
+        try:
+            return executor.submit(encode_image_bytes, data).result()
+        except BrokenProcessPool:
+            self._discard(executor)
+            return self._processes().submit(encode_image_bytes, data).result()
+
+    def tracks(self, video_key):
+        with self.pool.connection() as conn:
+            rows = conn.execute('''SELECT id, start_time, end_time, frames, blurriness, box FROM face_tracks
+                                   WHERE video_key=? ORDER BY start_time''', (str(video_key),)).fetchall()
+        return [{'id': r[0], 'start_time': r[1], 'end_time': r[2], 'frames': r[3],
+                 'blurriness': r[4], 'box': [int(v) for v in r[5].split(',')]} for r in rows]
+
+    def videos_with_face(self, encoding, threshold=MATCH_THRESHOLD, limit=50):
+        """
+        查找出现过该人脸的视频，返回 [(video_key, 最小距离, 首次出现的时间), ...]，按距离升序。
+        所有轨迹的平均特征一次向量化比较。
+        """
+        with self.pool.connection() as conn:
+            rows = conn.execute('SELECT video_key, start_time, encoding FROM face_tracks').fetchall()
+        if not rows:
+            return []
+        means = np.frombuffer(b''.join(row[2] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+        query = np.asarray(encoding, dtype=np.float32)
+        distances = np.sqrt(((means - query) ** 2).sum(axis=1))
+        best = {}
+        for i in np.flatnonzero(distances <= threshold):
+            key, start, d = rows[i][0], rows[i][1], float(distances[i])
+            if key not in best or d < best[key][0]:
+                best[key] = (d, start)
+        ranked = sorted(((key, d, start) for key, (d, start) in best.items()), key=lambda item: item[1])
+        return ranked[:limit]
@@ -0,0 +1,129 @@
+"""
+字体注册表：按 (字体族, 字号) 缓存已加载的 PIL 字体。
+
+每个字体族是一组按优先级排列的候选字体（文件名、去掉扩展名的名字或完整路径），
+第一次用到时在系统字体目录里按顺序查找，找到的第一个就是该族的字体；
+全部找不到时退回 Pillow 自带的默认字体。查找结果和加载好的字体对象都会缓存，
+之后每次取字体只是一次字典查询，不再访问文件系统，也不需要 matplotlib。
+应用启动时调用 warm_up() 预先加载，并通过 chosen() 查看实际选中的字体。
+"""
+import logging
+import os
+import sys
+import threading
+
+from PIL import ImageFont
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FONT = '<pillow-default>'
+
+
+def system_font_dirs():
+    """当前平台常见的字体目录，按优先级排列"""
+    home = os.path.expanduser('~')
+    if sys.platform.startswith('win'):
+        windir = os.environ.get('WINDIR', r'C:\Windows')
+        dirs = [os.path.join(windir, 'Fonts'),
+                os.path.join(os.environ.get('LOCALAPPDATA', ''), 'Microsoft', 'Windows', 'Fonts')]
+    elif sys.platform == 'darwin':
+        dirs = ['/System/Library/Fonts', '/Library/Fonts', os.path.join(home, 'Library', 'Fonts')]
+    else:
+        data_dirs = os.environ.get('XDG_DATA_DIRS') or '/usr/local/share:/usr/share'
+        dirs = [os.path.join(home, '.fonts'), os.path.join(home, '.local', 'share', 'fonts')]
+        dirs += [os.path.join(d, 'fonts') for d in data_dirs.split(':') if d]
+    return [d for d in dirs if os.path.isdir(d)]
+
+
+def scan_fonts(dirs):
+    """扫描字体目录，返回 {小写文件名或小写主文件名: 路径}；同名时先扫描到的优先"""
+    index = {}
+    for root_dir in dirs:
+        for root, subdirs, files in os.walk(root_dir):
+            subdirs.sort()
+            for name in sorted(files):
+                stem, ext = os.path.splitext(name)
+                if ext.lower() not in ('.ttf', '.ttc', '.otf'):
+                    continue
+                path = os.path.join(root, name)
+                index.setdefault(name.lower(), path)
+                index.setdefault(stem.lower(), path)
+    return index
+
+
+class FontRegistry:
+    def __init__(self, font_dirs=None):
+        self.font_dirs = font_dirs
+        self._families = {}
+        self._paths = {}
+        self._fonts = {}
+        self._index = None
+        self._lock = threading.Lock()
+
+    def register(self, family, candidates):
+        """登记字体族的候选字体列表，顺序即优先级"""
+        with self._lock:
+            self._families[family] = list(candidates)
+            self._paths.pop(family, None)
+            for key in [k for k in self._fonts if k[0] == family]:
+                del self._fonts[key]
+
+    def _lookup(self, name):
+        if os.path.isabs(name):
+            return name if os.path.isfile(name) else None
+        if self._index is None:
+            dirs = self.font_dirs if self.font_dirs is not None else system_font_dirs()
+            self._index = scan_fonts(dirs)
+        key = name.lower()
+        return self._index.get(key) or self._index.get(os.path.splitext(key)[0])
+
+    def _resolve(self, family):
+        # 未登记的字体族把名字本身当作唯一候选
+        for name in self._families.get(family, [family]):
+            path = self._lookup(name)
+            if path is None:
+                continue
+            try:
+                ImageFont.truetype(path, 12)
+            except OSError:
+                logger.warning('字体 %s 无法加载，跳过', path)
+                continue
+            return path
+        return None
+
+    def get(self, family, size):
+        """返回 (family, size) 对应的字体对象，第一次调用后缓存"""
+        key = (family, size)
+        font = self._fonts.get(key)
+        if font is not None:
+            return font
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is None:
+                if family not in self._paths:
+                    self._paths[family] = self._resolve(family)
+                path = self._paths[family]
+                if path is not None:
+                    font = ImageFont.truetype(path, size)
+                else:
+                    try:
+                        font = ImageFont.load_default(size)
+                    except TypeError:
+                        # Pillow 10.1 之前的默认字体不能指定字号
+                        font = ImageFont.load_default()
+                self._fonts[key] = font
+            return font
+
+    def chosen(self, family):
+        """字体族实际使用的字体文件路径，退回默认字体时为 DEFAULT_FONT"""
+        if family not in self._paths:
+            with self._lock:
+                if family not in self._paths:
+                    self._paths[family] = self._resolve(family)
+        return self._paths[family] or DEFAULT_FONT
+
+    def warm_up(self, *specs):
+        """预先加载 (family, size) 列表中的字体，并记录选中的字体文件"""
+        for family, size in specs:
+            self.get(family, size)
+            logger.info('字体 %s (%s) 使用 %s', family, size, self.chosen(family))
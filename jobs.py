@@ -0,0 +1,87 @@
+"""
+简单的后台任务队列：固定数量的守护线程从队列中取任务执行。
+适合转码、截图这类主要时间花在外部进程（ffmpeg）上的任务。
+CPU 密集的任务放进进程池，进程池用 process_context() 创建。
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def process_context():
+    """
+    进程池使用的 multiprocessing 上下文。Web 进程里已经有其他线程，fork 会把它们持有的锁
+    原样复制进子进程，子进程可能永远卡住，所以用 forkserver，不支持时（Windows）用 spawn。
+    这两种方式下工作进程会以 __mp_main__ 的名字重新导入主模块，app.run() 要放在 __main__ 判断里。
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def on_first_request(app, func):
+    """
+    在每个进程处理第一个请求之前调用一次 func（已有应用上下文），用于把上次未完成的后台任务重新排队。
+    不依赖 app.run()：gunicorn、waitress 或关闭重载器时同样会执行；重载器的父进程和
+    进程池重新导入主模块的工作进程不处理请求，也就不会重复排队。
+    """
+    lock = threading.Lock()
+    state = {'pid': None}
+
+    @app.before_request
+    def run_startup_tasks():
+        if state['pid'] == os.getpid():
+            return
+        with lock:
+            if state['pid'] == os.getpid():
+                return
+            # 先记下再执行，失败时不在后续每个请求里反复重试
+            state['pid'] = os.getpid()
+            try:
+                func()
+            except Exception:
+                logger.exception('启动任务 %s 执行失败', getattr(func, '__name__', func))
+
+
+class JobQueue:
+    def __init__(self, workers=2, maxsize=0, name='jobs'):
+        self.workers = workers
+        self.name = name
+        self._queue = queue.Queue(maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f'{self.name}-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    # 提交任务，队列满时阻塞（maxsize 为 0 表示不限）
+    def submit(self, func, *args, **kwargs):
+        self._start()
+        self._queue.put((func, args, kwargs))
+
+    def pending(self):
+        return self._queue.qsize()
+
+    # 等待队列中所有任务执行完
+    def join(self):
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            func, args, kwargs = self._queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                logger.exception('后台任务 %s 执行失败', getattr(func, '__name__', func))
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,88 @@
+"""
+最长公共子序列（LCS）长度的位并行计算，所有搜索路由共用。
+
+采用 Allison-Dix / Hyyrö 的位向量算法：先为查询串每个字符预先计算一次
+匹配掩码，之后每个候选串只需逐字符做几次整数位运算，
+不再为每次比较分配 (m+1)x(n+1) 的二维表。
+"""
+import heapq
+
+
+class LcsPattern:
+    """预处理好的查询串，可对大量候选串重复打分"""
+
+    def __init__(self, query, ignore_case=False):
+        self.ignore_case = ignore_case
+        if ignore_case:
+            query = query.lower()
+        self.query = query
+        self.length = len(query)
+        self._all_ones = (1 << self.length) - 1
+        # 字符 -> 该字符在查询串中出现位置的位掩码
+        masks = {}
+        for i, ch in enumerate(query):
+            masks[ch] = masks.get(ch, 0) | (1 << i)
+        self._masks = masks
+
+    # 计算查询串与 text 的 LCS 长度
+    def score(self, text):
+        if self.ignore_case:
+            text = text.lower()
+        masks = self._masks
+        all_ones = self._all_ones
+        v = all_ones
+        for ch in text:
+            m = masks.get(ch)
+            if m is None:
+                continue
+            u = v & m
+            v = ((v + u) | (v - u)) & all_ones
+        # V 中被清零的位数即为 LCS 长度
+        return self.length - bin(v).count('1')
+
+    # 批量打分，返回与 texts 一一对应的得分列表
+    def score_many(self, texts):
+        score = self.score
+        return [score(text) for text in texts]
+
+
+def lcs_length(a, b, ignore_case=False):
+    """计算两个字符串的 LCS 长度"""
+    if len(a) > len(b):
+        a, b = b, a
+    return LcsPattern(a, ignore_case).score(b)
+
+
+def lcs_batch(query, candidates, ignore_case=False):
+    """用同一个查询串给一批候选串打分"""
+    return LcsPattern(query, ignore_case).score_many(candidates)
+
+
+def top_k(query, items, k, key=None, ignore_case=False, min_score=1, skip=None):
+    """
+    流式选出与 query 的 LCS 得分最高的 k 个元素，返回 [(得分, 元素), ...]。
+    排序为得分降序、同分保持输入顺序，与"全部打分再稳定排序后切片"的结果一致。
+    只维护大小为 k 的最小堆；当 min(len(query), len(候选)) 已不可能超过
+    当前第 k 名的得分时直接跳过该候选，不再计算 LCS。
+    skip(得分, 元素) 返回 True 的候选不参与排名，用于游标分页时跳过前几页已出现的结果。
+    """
+    if k <= 0:
+        return []
+    pattern = LcsPattern(query, ignore_case)
+    heap = []  # (得分, -序号, 元素)，堆顶是当前最差的一名
+    for index, item in enumerate(items):
+        text = item if key is None else key(item)
+        bound = min(pattern.length, len(text))
+        if bound < min_score:
+            continue
+        if len(heap) == k and bound <= heap[0][0]:
+            continue
+        score = pattern.score(text)
+        if score < min_score or (skip is not None and skip(score, item)):
+            continue
+        if len(heap) < k:
+            heapq.heappush(heap, (score, -index, item))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, (score, -index, item))
+    heap.sort(key=lambda entry: (-entry[0], -entry[1]))
+    return [(score, item) for score, _, item in heap]
@@ -0,0 +1,56 @@
+"""
+按版本号执行的 SQLite 数据库迁移，版本号保存在 PRAGMA user_version 中。
+
+每个应用定义自己的 MIGRATIONS 列表，第 i 项把数据库从版本 i 升到 i+1，
+可以是 SQL 语句列表，也可以是接收连接的函数。第 1 项一般就是原来 init_db
+里的 CREATE TABLE IF NOT EXISTS 语句，所以已有的旧数据库也能直接升级。
+
+所有待执行的步骤放在同一个 BEGIN IMMEDIATE 事务里：
+多个进程同时启动时只有一个真正执行，其余的拿到锁后看到版本已是最新，什么也不做；
+任何一步失败都会整体回滚，版本号不变。
+"""
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def run_migrations(conn, migrations):
+    """把数据库升级到最新版本，返回升级后的版本号"""
+    isolation_level = conn.isolation_level
+    if conn.in_transaction:
+        conn.commit()
+    # 改为手动控制事务，防止 sqlite3 模块在 DDL 前后自动提交
+    conn.isolation_level = None
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = schema_version(conn)
+            for target in range(version + 1, len(migrations) + 1):
+                step = migrations[target - 1]
+                if callable(step):
+                    step(conn)
+                else:
+                    for sql in step:
+                        conn.execute(sql)
+                conn.execute(f'PRAGMA user_version = {target}')
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return schema_version(conn)
+    finally:
+        conn.isolation_level = isolation_level
+
+
+def column_names(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def add_column(table, column, definition):
+    """生成一个迁移步骤：列不存在时才添加，兼容手工改过表结构的旧库"""
+    def step(conn):
+        if column not in column_names(conn, table):
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    step.__name__ = f'add_{table}_{column}'
+    return step
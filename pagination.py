@@ -0,0 +1,27 @@
+"""
+基于游标（keyset）的分页：?after=<上一页最后一条的 id>&limit=N
+
+查询写成 WHERE id < ? ORDER BY id DESC LIMIT N+1，配合 (user_id, id) 索引，
+翻到第几页都只读 N+1 行，不像 OFFSET 那样越往后越慢。
+多取的一行只用来判断是否还有下一页。
+"""
+from flask import request
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+def page_args(default_limit=DEFAULT_LIMIT):
+    """从查询参数读取 (after, limit)；after 缺省或无效时为 None，表示第一页"""
+    after = request.args.get('after', type=int)
+    limit = request.args.get('limit', default_limit, type=int)
+    return after, max(1, min(limit, MAX_LIMIT))
+
+
+def split_page(rows, limit, key=lambda row: row['id']):
+    """rows 为按 limit+1 取出的结果，返回 (本页数据, 下一页游标或 None)"""
+    rows = list(rows)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, key(rows[-1])
+    return rows, None
@@ -0,0 +1,100 @@
+"""
+在进程池里计算密码哈希。
+
+PBKDF2/scrypt 故意设计得很慢，直接在请求线程里计算会占住 GIL，
+登录高峰时同一进程里发送视频数据的线程也跟着卡住。这里把哈希计算交给
+有上限的进程池，请求线程只是等待结果（等待期间不持有 GIL）。
+
+- method / salt_length 可配置，即 werkzeug generate_password_hash 的参数，
+  例如 'pbkdf2:sha256:600000'、'scrypt:32768:8:1'；None 表示 werkzeug 默认值
+- verify_and_update()：登录校验成功后，如果库里的哈希是按旧参数生成的，
+  顺便用当前参数重新计算，调用方写回数据库即可，用户无感知
+- workers=0 时在当前线程内计算，便于调试或不支持多进程的环境
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from jobs import process_context
+
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+
+def _hash(password, method, salt_length):
+    if method is None:
+        return generate_password_hash(password, salt_length=salt_length)
+    return generate_password_hash(password, method=method, salt_length=salt_length)
+
+
+class PasswordService:
+    def __init__(self, method=None, salt_length=16, workers=DEFAULT_WORKERS, max_pending=None):
+        """max_pending: 同时排队的哈希任务上限，超出时请求线程阻塞等待，默认 workers 的 4 倍"""
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max_pending or max(1, workers) * 4)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._current_method = None
+
+    def _pool(self):
+        # 延迟创建；fork 出的子进程不能使用父进程的进程池
+        if self._executor is None or self._pid != os.getpid():
+            with self._lock:
+                if self._executor is None or self._pid != os.getpid():
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                         mp_context=process_context())
+                    self._pid = os.getpid()
+        return self._executor
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+        with self._slots:
+            executor = self._pool()
+            try:
+                return executor.submit(func, *args).result()
+            except BrokenProcessPool:
+                # 有工作进程异常退出（OOM、段错误）后整个进程池不可用，换一个新的再试一次
+                self._discard(executor)
+                return self._pool().submit(func, *args).result()
+
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method, self.salt_length)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run(check_password_hash, pwhash, password)
+
+    def current_method(self):
+        """当前参数生成的哈希里记录的方法串（werkzeug 会补全默认的迭代次数等参数）"""
+        if self._current_method is None:
+            self._current_method = self._run(_hash, '', self.method, 1).split('$', 1)[0]
+        return self._current_method
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self.current_method()
+
+    def verify_and_update(self, pwhash, password):
+        """返回 (是否正确, 新哈希或 None)；新哈希不为 None 时调用方应写回数据库"""
+        if not self.verify(pwhash, password):
+            return False, None
+        if self.needs_rehash(pwhash):
+            return True, self.hash(password)
+        return True, None
+
+    def shutdown(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=False)
+        self._executor = None
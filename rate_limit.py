@@ -0,0 +1,153 @@
+"""
+滑动窗口限流。
+
+登录、注册、验证码和上传都是昂贵操作（PBKDF2 校验、绘图、写磁盘），
+撞库或刷接口时会把 CPU 和磁盘占满。用法：
+
+    limiter = RateLimiter(open_counter('memory'))
+
+    @app.route('/login', methods=['GET', 'POST'])
+    @limiter.limit('20/minute', key=client_ip)
+    @limiter.limit('5/minute', key=form_username)
+    def login(): ...
+
+超过限制的请求在进入视图之前直接返回 429，不会执行任何哈希或绘图。
+
+计数采用近似滑动窗口：每个键只保存当前和上一个固定窗口的计数，
+估计值 = 上一窗口计数 × 上一窗口仍在滑动窗口内的比例 + 当前窗口计数，
+每个键 O(1) 空间，不需要记录每次请求的时间戳。
+- MemoryCounter：进程内计数，单进程运行时使用
+- SQLiteCounter：计数放在 SQLite 表里，多个 worker 进程共享同一份限额
+"""
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, Response
+
+from sqlite_pool import SQLitePool
+from migrations import run_migrations
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_rate(rate):
+    """'5/minute' -> (5, 60)"""
+    count, _, period = rate.partition('/')
+    return int(count), PERIODS[period.strip().rstrip('s')]
+
+
+def client_ip():
+    return request.remote_addr or ''
+
+
+def form_username():
+    """按表单中的用户名限流；没有填写用户名时不计数"""
+    return request.form.get('username', '').strip().lower() or None
+
+
+def estimate(prev, curr, window_start, period, now):
+    return prev * (1 - (now - window_start) / period) + curr
+
+
+class MemoryCounter:
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, period, now):
+        """计一次请求，返回滑动窗口内的估计请求数"""
+        window_start = now - now % period
+        with self._lock:
+            start, prev, curr = self._windows.get(key, (window_start, 0, 0))
+            if start != window_start:
+                prev = curr if start == window_start - period else 0
+                curr = 0
+            curr += 1
+            self._windows[key] = (window_start, prev, curr)
+            self._windows.move_to_end(key)
+            # 超出容量时淘汰最久没有请求的键，正在被限流的键不会因此清零
+            while len(self._windows) > self.max_keys:
+                self._windows.popitem(last=False)
+        return estimate(prev, curr, window_start, period, now)
+
+
+SQLITE_MIGRATIONS = [
+    [
+        '''CREATE TABLE IF NOT EXISTS rate_counters (
+            key TEXT NOT NULL,
+            window_start REAL NOT NULL,
+            count INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (key, window_start)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_rate_counters_expires_at ON rate_counters(expires_at)',
+    ],
+]
+
+
+class SQLiteCounter:
+    def __init__(self, database, purge_every=1000):
+        """database: 独立的数据库文件；purge_every: 每计数多少次清理一次过期窗口"""
+        self.pool = SQLitePool(database)
+        self.purge_every = purge_every
+        self._hits = 0
+        with self.pool.connection() as conn:
+            run_migrations(conn, SQLITE_MIGRATIONS)
+
+    def hit(self, key, period, now):
+        window_start = now - now % period
+        with self.pool.connection() as conn:
+            # 先累加再读取，多个进程同时计数也不会丢失
+            conn.execute('''INSERT INTO rate_counters (key, window_start, count, expires_at) VALUES (?, ?, 1, ?)
+                            ON CONFLICT(key, window_start) DO UPDATE SET count = count + 1''',
+                         (key, window_start, window_start + 2 * period))
+            counts = dict(conn.execute('SELECT window_start, count FROM rate_counters '
+                                       'WHERE key=? AND window_start IN (?, ?)',
+                                       (key, window_start - period, window_start)).fetchall())
+            self._hits += 1
+            if self._hits % self.purge_every == 0:
+                conn.execute('DELETE FROM rate_counters WHERE expires_at<?', (now,))
+        return estimate(counts.get(window_start - period, 0), counts.get(window_start, 0),
+                        window_start, period, now)
+
+
+def open_counter(target):
+    """'memory' 返回进程内计数器，否则把 target 当作 SQLite 数据库文件路径"""
+    if target == 'memory':
+        return MemoryCounter()
+    return SQLiteCounter(target)
+
+
+def too_many_requests(retry_after):
+    return Response('请求过于频繁，请稍后再试', status=429, mimetype='text/plain',
+                    headers={'Retry-After': str(max(1, int(retry_after)))})
+
+
+class RateLimiter:
+    def __init__(self, counter):
+        self.counter = counter
+
+    def limit(self, rate, key=client_ip, methods=('POST',)):
+        """
+        视图装饰器：同一个键在滑动窗口内超过 rate 次请求时返回 429。
+        key(): 返回限流键，返回 None 表示本次请求不限流；methods: 只对这些方法计数，None 表示全部
+        """
+        count, period = parse_rate(rate)
+
+        def decorator(view):
+            scope = f'{view.__module__}.{view.__name__}:{key.__name__}:{rate}'
+
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if methods is None or request.method in methods:
+                    value = key()
+                    if value is not None:
+                        now = time.time()
+                        if self.counter.hit(f'{scope}:{value}', period, now) > count:
+                            return too_many_requests(period - now % period)
+                return view(*args, **kwargs)
+            return wrapper
+        return decorator
@@ -0,0 +1,95 @@
+"""
+用户名模糊搜索索引
+
+按字符建立倒排索引（字符 -> 出现次数 >= k 的用户集合），搜索时先用
+sum(min(查询中字符次数, 用户名中字符次数)) 作为 LCS 长度的上界筛出候选，
+再按上界从高到低只对可能进入前 N 名的候选计算精确的 LCS。
+排序规则与原来的全表扫描一致：得分降序，同分按用户 id 升序。
+"""
+import threading
+from collections import Counter
+
+from lcs import LcsPattern
+
+
+class UsernameIndex:
+    def __init__(self):
+        self._levels = {}             # 字符 -> [出现>=1次的id集合, 出现>=2次的id集合, ...]
+        self._names = {}              # 用户id -> 用户名（已小写）
+        self._lock = threading.Lock()
+        self.max_id = 0               # 已同步的最大用户id，用于增量加载
+
+    def __len__(self):
+        return len(self._names)
+
+    # 加入（或更新）一个用户名
+    def add(self, user_id, username):
+        with self._lock:
+            if user_id in self._names:
+                self._discard(user_id)
+            name = username.lower()
+            self._names[user_id] = name
+            for ch, cnt in Counter(name).items():
+                levels = self._levels.setdefault(ch, [])
+                while len(levels) < cnt:
+                    levels.append(set())
+                for k in range(cnt):
+                    levels[k].add(user_id)
+            if user_id > self.max_id:
+                self.max_id = user_id
+
+    # 从索引中移除一个用户
+    def remove(self, user_id):
+        with self._lock:
+            self._discard(user_id)
+
+    def _discard(self, user_id):
+        name = self._names.pop(user_id, None)
+        if name is None:
+            return
+        for ch, cnt in Counter(name).items():
+            levels = self._levels.get(ch, [])
+            for k in range(min(cnt, len(levels))):
+                levels[k].discard(user_id)
+
+    # 批量同步 (id, username) 行，一般传入 id > max_id 的新用户
+    def sync(self, rows):
+        for user_id, username in rows:
+            self.add(user_id, username)
+
+    # 返回 [(得分, 用户id), ...]，最多 limit 条，得分均大于0
+    def search(self, query, limit=20):
+        query = query.lower()
+        if not query or limit <= 0:
+            return []
+        with self._lock:
+            # 1. 累加每个候选的上界，Counter.update 在C层完成计数
+            bounds = Counter()
+            for ch, qcnt in Counter(query).items():
+                for level in self._levels.get(ch, [])[:qcnt]:
+                    bounds.update(level)
+            if not bounds:
+                return []
+            # 2. 按上界分桶，桶内按id升序
+            buckets = {}
+            for user_id, bound in bounds.items():
+                bound = min(bound, len(self._names[user_id]))
+                buckets.setdefault(bound, []).append(user_id)
+            # 3. 上界从高到低精确打分，无法超过当前第 limit 名时停止
+            pattern = LcsPattern(query)
+            results = []
+            for bound in sorted(buckets, reverse=True):
+                if len(results) >= limit and bound < results[-1][0]:
+                    break
+                for user_id in sorted(buckets[bound]):
+                    if len(results) >= limit:
+                        worst_score, worst_id = results[-1]
+                        if bound < worst_score or (bound == worst_score and user_id > worst_id):
+                            break
+                    score = pattern.score(self._names[user_id])
+                    if score <= 0:
+                        continue
+                    results.append((score, user_id))
+                    results.sort(key=lambda item: (-item[0], item[1]))
+                    del results[limit:]
+            return results
@@ -0,0 +1,260 @@
+"""
+服务端会话与验证码挑战存储。
+
+Flask 默认把整个 session 序列化后签名写进 cookie，每次取验证码都要重写、重签 cookie，
+也没法让验证码过期或在多个进程之间限制尝试次数。这里把数据放在服务端：
+
+- MemoryBackend：进程内 LRU，条目带过期时间，适合单进程运行
+- SQLiteBackend：SQLite 表，多个 worker 进程共享同一份数据
+- ServerSideSessionInterface：替换 app.session_interface，cookie 里只剩随机会话 id，
+  会话内容没变时不再写存储、也不再下发 cookie；登录时 regenerate() 换新 id，防止会话固定。
+  只为取验证码而分配的空会话可以记在单独的 pending_backend 里，
+  大量匿名请求不会把已登录用户的会话挤出 LRU
+- ChallengeStore：按会话 id 保存验证码答案，带有效期和尝试次数上限，
+  校验时先从存储里原子地取走答案再比较，答对后立即作废，不能重复使用，并发请求也无法绕过次数上限
+"""
+import copy
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, session
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from sqlite_pool import SQLitePool
+from migrations import run_migrations
+
+DEFAULT_SESSION_TTL = 31 * 24 * 3600    # 秒，与 Flask 默认的永久会话有效期一致
+CHALLENGE_TTL = 300                     # 验证码 5 分钟内有效
+MAX_ATTEMPTS = 5                        # 同一个验证码最多尝试 5 次
+
+
+class MemoryBackend:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at <= time.time():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            # 返回副本，避免请求里修改嵌套的列表时直接改到存储中的数据
+            return copy.deepcopy(value)
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._items[key] = (copy.deepcopy(value), time.time() + ttl)
+            self._items.move_to_end(key)
+            # 超出容量时淘汰最久未使用的条目
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def add(self, key, value, ttl):
+        """key 不存在（或已过期）时才写入"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[1] > time.time():
+                return
+            self._items[key] = (copy.deepcopy(value), time.time() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        """取出并删除，同一个条目只有一个调用方能拿到"""
+        with self._lock:
+            item = self._items.pop(key, None)
+        if item is None or item[1] <= time.time():
+            return None
+        return item[0]
+
+
+SQLITE_MIGRATIONS = [
+    [
+        '''CREATE TABLE IF NOT EXISTS kv_store (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_kv_store_expires_at ON kv_store(expires_at)',
+    ],
+]
+
+
+class SQLiteBackend:
+    def __init__(self, database, purge_every=500):
+        """database: 独立的数据库文件，不与业务库混用；purge_every: 每写入多少次清理一次过期条目"""
+        self.pool = SQLitePool(database)
+        self.serializer = TaggedJSONSerializer()
+        self.purge_every = purge_every
+        self._writes = 0
+        with self.pool.connection() as conn:
+            run_migrations(conn, SQLITE_MIGRATIONS)
+
+    def get(self, key):
+        with self.pool.connection() as conn:
+            row = conn.execute('SELECT value FROM kv_store WHERE key=? AND expires_at>?',
+                               (key, time.time())).fetchone()
+        return self.serializer.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self.pool.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO kv_store (key, value, expires_at) VALUES (?, ?, ?)',
+                         (key, self.serializer.dumps(value), now + ttl))
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                conn.execute('DELETE FROM kv_store WHERE expires_at<=?', (now,))
+
+    def delete(self, key):
+        with self.pool.connection() as conn:
+            conn.execute('DELETE FROM kv_store WHERE key=?', (key,))
+
+    def add(self, key, value, ttl):
+        """key 不存在（或已过期）时才写入"""
+        now = time.time()
+        with self.pool.connection() as conn:
+            conn.execute('''INSERT INTO kv_store (key, value, expires_at) VALUES (?, ?, ?)
+                            ON CONFLICT(key) DO UPDATE SET value=excluded.value, expires_at=excluded.expires_at
+                            WHERE kv_store.expires_at<=?''',
+                         (key, self.serializer.dumps(value), now + ttl, now))
+
+    def pop(self, key):
+        """取出并删除，同一个条目只有一个进程能拿到"""
+        with self.pool.connection() as conn:
+            # 先拿写锁再读，读和删之间不会有其他连接插进来
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT value, expires_at FROM kv_store WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute('DELETE FROM kv_store WHERE key=?', (key,))
+        return self.serializer.loads(row[0]) if row[1] > time.time() else None
+
+
+def open_backend(target):
+    """'memory' 返回进程内 LRU，否则把 target 当作 SQLite 数据库文件路径"""
+    if target == 'memory':
+        return MemoryBackend()
+    return SQLiteBackend(target)
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # 会话内容为空但 id 已被使用（例如绑定了验证码）时，也需要下发 cookie
+        self.sid_used = False
+
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self, backend, prefix='session:', pending_backend=None, pending_ttl=CHALLENGE_TTL):
+        """pending_backend: 内容为空、只分配了 id 的会话存放处，默认与 backend 相同"""
+        self.backend = backend
+        self.prefix = prefix
+        self.pending_backend = pending_backend or backend
+        self.pending_ttl = pending_ttl
+
+    def _ttl(self, app):
+        return int(app.permanent_session_lifetime.total_seconds()) or DEFAULT_SESSION_TTL
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.config['SESSION_COOKIE_NAME'])
+        if sid:
+            data = self.backend.get(self.prefix + sid)
+            if data is None and self.pending_backend is not self.backend:
+                data = self.pending_backend.get(self.prefix + sid)
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def regenerate(self, session):
+        """换一个新的会话 id 并作废旧 id，内容保留；登录成功后、写入用户身份前调用"""
+        self.backend.delete(self.prefix + session.sid)
+        if self.pending_backend is not self.backend:
+            self.pending_backend.delete(self.prefix + session.sid)
+        session.sid = secrets.token_urlsafe(32)
+        session.new = True
+
+    def save_session(self, app, session, response):
+        name = app.config['SESSION_COOKIE_NAME']
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session and not session.sid_used:
+            if session.modified and not session.new:
+                self.backend.delete(self.prefix + session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if session:
+            if session.new or session.modified:
+                self.backend.set(self.prefix + session.sid, dict(session), self._ttl(app))
+        else:
+            if session.modified and not session.new:
+                self.backend.delete(self.prefix + session.sid)
+            # 空会话只靠这条记录保留 id；每次使用（例如再取验证码）都重新计时，
+            # 否则 pending_ttl 到期后 id 失效，刚取的验证码也跟着无法校验
+            self.pending_backend.set(self.prefix + session.sid, {}, self.pending_ttl)
+        if session.new or session.modified:
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+
+def current_session_id():
+    """当前请求的会话 id，新会话会因此在响应里下发 cookie"""
+    session.sid_used = True
+    return session.sid
+
+
+def regenerate_session():
+    """登录成功后调用，当前请求的会话换用新 id"""
+    current_app.session_interface.regenerate(session)
+
+
+class ChallengeStore:
+    def __init__(self, backend, ttl=CHALLENGE_TTL, max_attempts=MAX_ATTEMPTS, prefix='captcha:'):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.prefix = prefix
+
+    def issue(self, answer):
+        """为当前会话登记新的答案，覆盖之前未使用的验证码"""
+        self.backend.set(self.prefix + current_session_id(), {'answer': answer, 'attempts': 0,
+                                                              'expires_at': time.time() + self.ttl}, self.ttl)
+
+    def verify(self, guess):
+        """
+        校验当前会话的答案；答对或尝试次数用完后验证码作废。
+        先从存储里原子地取走验证码再比较，同一个验证码同时只有一个请求能校验，
+        并发的其他请求取不到、直接失败，多个进程之间也不会绕过次数上限或重复通过。
+        """
+        key = self.prefix + current_session_id()
+        challenge = self.backend.pop(key)
+        if challenge is None:
+            return False
+        if guess and secrets.compare_digest(guess.encode(), challenge['answer'].encode()):
+            return True
+        challenge['attempts'] += 1
+        remaining = challenge['expires_at'] - time.time()
+        if challenge['attempts'] < self.max_attempts and remaining > 0:
+            # 放回前如果已经签发了新的验证码，不覆盖它
+            self.backend.add(key, challenge, remaining)
+        return False
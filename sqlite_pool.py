@@ -0,0 +1,165 @@
+"""
+各个 sqlite3 应用共用的连接池。
+
+- 连接数有上限，空闲连接后进先出复用，长期存活的连接让 sqlite3 的语句缓存
+  （cached_statements）真正起作用，不必每次请求重新编译 SQL
+- 每个连接打开时设置 WAL、synchronous=NORMAL、mmap 和 busy_timeout，
+  读写可以并发，减少 "database is locked"
+- 借出的连接对象的 close() 被改为归还连接池，原来 "connect ... close()" 写法的代码不用改结构；
+  每次借出都是一个新的包装对象，重复 close() 不会把别人正在用的连接放回池里
+- fork 出的子进程会丢弃从父进程继承的连接，重新建立
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_POOL_SIZE = 8
+BUSY_TIMEOUT = 30.0                  # 秒，等待写锁的时间
+MMAP_SIZE = 256 * 1024 * 1024        # 256MB 内存映射读
+CACHED_STATEMENTS = 256
+
+
+class PooledConnection:
+    """
+    一次借出的连接，属性和方法都转发给底层的 sqlite3 连接。
+    close() 时把底层连接归还连接池，之后这个对象就不能再用了；重复 close() 什么也不做，
+    即使底层连接已经借给了别的线程，也不会被第二次放回连接池。
+    """
+    __slots__ = ('_conn', '_pool')
+
+    def __init__(self, conn, pool):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_pool', pool)
+
+    def _connection(self):
+        conn = self._conn
+        if conn is None:
+            raise sqlite3.ProgrammingError('Cannot operate on a closed database.')
+        return conn
+
+    def __getattr__(self, name):
+        return getattr(self._connection(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._connection(), name, value)
+
+    def __enter__(self):
+        self._connection().__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._connection().__exit__(*exc_info)
+
+    def close(self):
+        conn, pool = self._conn, self._pool
+        if conn is None:
+            return
+        object.__setattr__(self, '_conn', None)
+        pool.release(conn)
+
+    def __del__(self):
+        # 出异常等原因没有 close() 的连接被回收时，底层连接归还连接池
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class SQLitePool:
+    def __init__(self, database, size=DEFAULT_POOL_SIZE, timeout=BUSY_TIMEOUT, row_factory=None,
+                 mmap_size=MMAP_SIZE, cached_statements=CACHED_STATEMENTS):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.row_factory = row_factory
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+        self._idle = []
+        self._created = 0
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, timeout=self.timeout,
+                               check_same_thread=False, cached_statements=self.cached_statements)
+        conn.row_factory = self.row_factory
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        conn.execute(f'PRAGMA busy_timeout={int(self.timeout * 1000)}')
+        return conn
+
+    def _check_fork(self):
+        # 子进程不能使用父进程的连接，直接丢弃重新计数
+        if self._pid != os.getpid():
+            self._idle = []
+            self._created = 0
+            self._pid = os.getpid()
+
+    # 取一个连接，池满时最多等待 timeout 秒
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            self._check_fork()
+            while True:
+                if self._idle:
+                    return PooledConnection(self._idle.pop(), self)
+                if self._created < self.size:
+                    self._created += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    raise sqlite3.OperationalError('数据库连接池已耗尽')
+        try:
+            return PooledConnection(self._connect(), self)
+        except Exception:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+
+    # 归还底层连接，未提交的事务回滚（与直接关闭连接的效果一致）；由 PooledConnection.close() 调用
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = self.row_factory
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        with self._cond:
+            if self._pid != os.getpid() or conn in self._idle:
+                return
+            self._idle.append(conn)
+            self._cond.notify()
+
+    def _forget(self):
+        with self._cond:
+            self._created = max(self._created - 1, 0)
+            self._cond.notify()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        self._forget()
+
+    @contextmanager
+    def connection(self):
+        """用法同 with sqlite3.connect(...) as conn：正常结束提交，出错回滚，最后归还连接"""
+        conn = self.acquire()
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+        for conn in idle:
+            conn.close()
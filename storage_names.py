@@ -0,0 +1,52 @@
+"""
+上传文件的存储名。
+
+原来的做法是 while os.path.exists(...) 依次尝试 name_1、name_2……，
+同名文件越多 stat 次数越多，并发上传时两个请求还可能拿到同一个名字。
+这里把磁盘上的存储名和页面上显示的名字分开：
+
+- storage_key()：uuid4 十六进制 + 原扩展名，不依赖已有文件，不会冲突
+- reserve()：用 O_CREAT | O_EXCL 原子地创建占位文件，名字被占用时加随机后缀重试，
+  正常情况下只需要一次系统调用
+- display_name()：用户上传时的原始文件名（去掉路径），只用于显示，存进数据库
+
+旧记录的存储名就是原来的文件名，显示名为空时回退到存储名，原有 URL 不受影响。
+"""
+import os
+import uuid
+
+RESERVE_RETRIES = 8
+MAX_DISPLAY_NAME = 255
+
+
+def storage_key(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    # 扩展名只保留字母数字，避免奇怪的字符进入路径
+    if not ext[1:].isalnum():
+        ext = ''
+    return uuid.uuid4().hex + ext
+
+
+def display_name(filename):
+    name = filename.replace('\\', '/').rsplit('/', 1)[-1].replace('\0', '').strip()
+    return name[:MAX_DISPLAY_NAME] or 'file'
+
+
+def reserve(directory, filename):
+    """在 directory 下原子地占用 filename，已被占用时改为 name_随机后缀.ext，返回实际占用的名字"""
+    base, ext = os.path.splitext(filename)
+    candidate = filename
+    for _ in range(RESERVE_RETRIES):
+        try:
+            fd = os.open(os.path.join(directory, candidate), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            candidate = f'{base}_{uuid.uuid4().hex[:8]}{ext}'
+            continue
+        os.close(fd)
+        return candidate
+    raise FileExistsError(f'无法在 {directory} 中创建文件 {filename}')
+
+
+def new_storage_file(directory, filename):
+    """为上传的 filename 分配一个存储名并创建占位文件，调用方随后覆盖写入"""
+    return reserve(directory, storage_key(filename))
@@ -0,0 +1,151 @@
+"""
+视频封面图和拖动预览雪碧图，上传后在后台用 ffmpeg 生成。
+
+生成的文件放在视频所在目录的 .thumbs 子目录下：
+    <目录>/.thumbs/<文件名>.poster.jpg    封面（一帧，宽 480）
+    <目录>/.thumbs/<文件名>.sprite.jpg    预览雪碧图（最多 10x10 个 160x90 的小图）
+    <目录>/.thumbs/<文件名>.sprite.vtt    WebVTT 缩略图轨道，cue 内容为 雪碧图#xywh=x,y,w,h
+
+列表页只需加载几 KB 的封面 JPEG，而不是为每个视频打开一个 <video> 去取元数据。
+缩略图 URL 带上文件修改时间作为版本号，响应使用一年的 immutable 缓存。
+"""
+import logging
+import os
+import subprocess
+
+from flask import send_from_directory
+
+from jobs import JobQueue
+
+logger = logging.getLogger(__name__)
+
+THUMB_DIR = '.thumbs'
+POSTER_WIDTH = 480
+TILE_WIDTH, TILE_HEIGHT = 160, 90
+SPRITE_COLUMNS, SPRITE_ROWS = 10, 10
+CACHE_MAX_AGE = 365 * 24 * 3600
+
+SUFFIXES = {
+    'poster': '.poster.jpg',
+    'sprite': '.sprite.jpg',
+    'vtt': '.sprite.vtt',
+}
+
+
+def thumbnail_name(filename, kind='poster'):
+    return filename + SUFFIXES[kind]
+
+
+def thumbnail_path(directory, filename, kind='poster'):
+    return os.path.join(directory, THUMB_DIR, thumbnail_name(filename, kind))
+
+
+def probe_duration(source, ffprobe='ffprobe'):
+    out = subprocess.run(
+        [ffprobe, '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', source],
+        check=True, capture_output=True, text=True,
+    ).stdout.strip()
+    try:
+        return float(out)
+    except ValueError:
+        return 0.0
+
+
+def _vtt_time(seconds):
+    ms = int(round(seconds * 1000))
+    h, ms = divmod(ms, 3600000)
+    m, ms = divmod(ms, 60000)
+    s, ms = divmod(ms, 1000)
+    return f'{h:02d}:{m:02d}:{s:02d}.{ms:03d}'
+
+
+def sprite_vtt(duration, interval, sprite_name):
+    """生成雪碧图对应的 WebVTT，sprite_name 为相对于 vtt 文件的雪碧图地址"""
+    lines = ['WEBVTT', '']
+    count = min(int(duration // interval) + 1, SPRITE_COLUMNS * SPRITE_ROWS)
+    for i in range(count):
+        start = i * interval
+        end = min((i + 1) * interval, duration)
+        if end <= start:
+            break
+        x = (i % SPRITE_COLUMNS) * TILE_WIDTH
+        y = (i // SPRITE_COLUMNS) * TILE_HEIGHT
+        lines.append(f'{_vtt_time(start)} --> {_vtt_time(end)}')
+        lines.append(f'{sprite_name}#xywh={x},{y},{TILE_WIDTH},{TILE_HEIGHT}')
+        lines.append('')
+    return '\n'.join(lines)
+
+
+class ThumbnailService:
+    def __init__(self, workers=1, ffmpeg='ffmpeg', ffprobe='ffprobe'):
+        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
+        self.queue = JobQueue(workers=workers, name='thumbnails')
+
+    # 加入生成队列，立即返回
+    def submit(self, directory, filename):
+        self.queue.submit(self.generate, os.path.abspath(directory), filename)
+
+    def backfill(self, directory, filenames):
+        """为还没有封面的已有视频补生成缩略图，返回加入队列的个数；启动时调用"""
+        queued = 0
+        for filename in filenames:
+            if self.version(directory, filename) is None and os.path.isfile(os.path.join(directory, filename)):
+                self.submit(directory, filename)
+                queued += 1
+        return queued
+
+    def remove(self, directory, filename):
+        for kind in SUFFIXES:
+            try:
+                os.remove(thumbnail_path(directory, filename, kind))
+            except FileNotFoundError:
+                pass
+
+    def version(self, directory, filename, kind='poster'):
+        """缩略图的版本号（修改时间），尚未生成时返回 None"""
+        try:
+            return format(os.stat(thumbnail_path(directory, filename, kind)).st_mtime_ns, 'x')
+        except OSError:
+            return None
+
+    def _run(self, cmd, dest):
+        # 先写临时文件再改名，避免读到生成一半的图片
+        tmp = dest + '.tmp.jpg'
+        subprocess.run(cmd + [tmp], check=True, capture_output=True)
+        os.replace(tmp, dest)
+
+    def generate(self, directory, filename):
+        source = os.path.join(directory, filename)
+        os.makedirs(os.path.join(directory, THUMB_DIR), exist_ok=True)
+        try:
+            duration = probe_duration(source, self.ffprobe)
+            # 封面取第 10% 处的一帧（最多第 10 秒），-ss 放在 -i 前走关键帧快速定位
+            at = min(duration * 0.1, 10.0)
+            self._run([self.ffmpeg, '-y', '-v', 'error', '-ss', f'{at:.3f}', '-i', source,
+                       '-frames:v', '1', '-vf', f'scale={POSTER_WIDTH}:-2', '-q:v', '4'],
+                      thumbnail_path(directory, filename, 'poster'))
+            if duration <= 0:
+                return
+            interval = max(duration / (SPRITE_COLUMNS * SPRITE_ROWS), 1.0)
+            vf = (f'fps=1/{interval:.3f},'
+                  f'scale={TILE_WIDTH}:{TILE_HEIGHT}:force_original_aspect_ratio=decrease,'
+                  f'pad={TILE_WIDTH}:{TILE_HEIGHT}:(ow-iw)/2:(oh-ih)/2,'
+                  f'tile={SPRITE_COLUMNS}x{SPRITE_ROWS}')
+            self._run([self.ffmpeg, '-y', '-v', 'error', '-i', source, '-vf', vf,
+                       '-frames:v', '1', '-q:v', '5'],
+                      thumbnail_path(directory, filename, 'sprite'))
+            vtt_path = thumbnail_path(directory, filename, 'vtt')
+            with open(vtt_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(sprite_vtt(duration, interval, thumbnail_name(filename, 'sprite')))
+            os.replace(vtt_path + '.tmp', vtt_path)
+        except (OSError, subprocess.CalledProcessError) as e:
+            stderr = getattr(e, 'stderr', b'') or b''
+            logger.error('生成 %s 的缩略图失败: %s %s', source, e, stderr.decode(errors='replace')[-2000:])
+
+
+def send_thumbnail(directory, name):
+    """发送 directory/.thumbs 下的缩略图，URL 带版本号，可长期缓存"""
+    resp = send_from_directory(os.path.join(directory, THUMB_DIR), name, max_age=CACHE_MAX_AGE)
+    resp.headers['Cache-Control'] = f'public, max-age={CACHE_MAX_AGE}, immutable'
+    return resp
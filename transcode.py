@@ -0,0 +1,171 @@
+"""
+上传后的后台转码：调用本机 ffmpeg 把原始视频切成多码率 HLS（可选 DASH）。
+
+输出目录结构：
+    <output_root>/<video_id>/master.m3u8
+    <output_root>/<video_id>/<n>/index.m3u8, seg_00000.ts ...
+    <output_root>/<video_id>/manifest.mpd        （启用 DASH 时）
+
+转码先写到临时目录，成功后整体改名，播放端不会读到半成品。
+状态依次为 pending -> processing -> ready / failed，通过 on_status(video_id, status, source) 回调写回数据库。
+remove() 会取消该 id 上仍在排队或运行的任务，之后它不再改名输出目录、也不再回调状态；
+回调带上源文件路径，id 被新视频复用时调用方可以据此忽略旧任务的状态。
+"""
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import uuid
+
+from jobs import JobQueue
+
+logger = logging.getLogger(__name__)
+
+# (名称, 高度, 视频码率, 最大码率, 缓冲区, 音频码率)
+RENDITIONS = [
+    ('1080p', 1080, '5000k', '5350k', '7500k', '192k'),
+    ('720p', 720, '2800k', '2996k', '4200k', '128k'),
+    ('480p', 480, '1400k', '1498k', '2100k', '128k'),
+    ('360p', 360, '800k', '856k', '1200k', '96k'),
+]
+SEGMENT_SECONDS = 6
+
+
+def probe(source, ffprobe='ffprobe'):
+    """返回 (视频高度, 是否有音轨)"""
+    out = subprocess.run(
+        [ffprobe, '-v', 'error', '-show_entries', 'stream=codec_type,height',
+         '-of', 'json', source],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    streams = json.loads(out).get('streams', [])
+    height = max((s.get('height') or 0 for s in streams if s.get('codec_type') == 'video'), default=0)
+    has_audio = any(s.get('codec_type') == 'audio' for s in streams)
+    return height, has_audio
+
+
+def pick_renditions(height, renditions=RENDITIONS):
+    # 不向上放大；源视频比最低档还小时只保留最低档
+    picked = [r for r in renditions if r[1] <= height]
+    return picked or [renditions[-1]]
+
+
+def hls_command(source, out_dir, renditions, has_audio, ffmpeg='ffmpeg'):
+    n = len(renditions)
+    split = f"[0:v]split={n}" + ''.join(f'[v{i}]' for i in range(n))
+    scales = ''.join(f';[v{i}]scale=-2:{r[1]}[v{i}o]' for i, r in enumerate(renditions))
+    cmd = [ffmpeg, '-y', '-v', 'error', '-i', source, '-filter_complex', split + scales]
+    stream_map = []
+    for i, (_, _, bitrate, maxrate, bufsize, audio_bitrate) in enumerate(renditions):
+        cmd += ['-map', f'[v{i}o]', f'-c:v:{i}', 'libx264', '-preset', 'veryfast',
+                f'-b:v:{i}', bitrate, f'-maxrate:v:{i}', maxrate, f'-bufsize:v:{i}', bufsize]
+        if has_audio:
+            cmd += ['-map', '0:a:0', f'-c:a:{i}', 'aac', f'-b:a:{i}', audio_bitrate, '-ac', '2']
+            stream_map.append(f'v:{i},a:{i}')
+        else:
+            stream_map.append(f'v:{i}')
+    # 固定关键帧间隔，保证各码率的分片边界对齐，便于播放器切换
+    cmd += ['-force_key_frames', f'expr:gte(t,n_forced*{SEGMENT_SECONDS})', '-sc_threshold', '0']
+    cmd += ['-f', 'hls', '-hls_time', str(SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(out_dir, '%v', 'seg_%05d.ts'),
+            '-master_pl_name', 'master.m3u8',
+            '-var_stream_map', ' '.join(stream_map),
+            os.path.join(out_dir, '%v', 'index.m3u8')]
+    return cmd
+
+
+def dash_command(source, out_dir, renditions, has_audio, ffmpeg='ffmpeg'):
+    cmd = [ffmpeg, '-y', '-v', 'error', '-i', source]
+    for i, (_, height, bitrate, maxrate, bufsize, _) in enumerate(renditions):
+        cmd += ['-map', '0:v:0', f'-c:v:{i}', 'libx264', '-preset', 'veryfast',
+                f'-filter:v:{i}', f'scale=-2:{height}',
+                f'-b:v:{i}', bitrate, f'-maxrate:v:{i}', maxrate, f'-bufsize:v:{i}', bufsize]
+    adaptation = 'id=0,streams=v'
+    if has_audio:
+        cmd += ['-map', '0:a:0', '-c:a', 'aac', '-b:a', renditions[0][5], '-ac', '2']
+        adaptation += ' id=1,streams=a'
+    cmd += ['-f', 'dash', '-seg_duration', str(SEGMENT_SECONDS), '-use_template', '1',
+            '-use_timeline', '1', '-adaptation_sets', adaptation,
+            os.path.join(out_dir, 'manifest.mpd')]
+    return cmd
+
+
+class Transcoder:
+    def __init__(self, output_root, on_status=None, workers=1, dash=False,
+                 ffmpeg='ffmpeg', ffprobe='ffprobe', renditions=RENDITIONS):
+        self.output_root = output_root
+        self.on_status = on_status
+        self.dash = dash
+        self.ffmpeg = ffmpeg
+        self.ffprobe = ffprobe
+        self.renditions = renditions
+        self.queue = JobQueue(workers=workers, name='transcode')
+        # video_id -> 当前有效的任务编号；remove() 或重新提交后旧任务的编号失效
+        self._jobs = {}
+        self._lock = threading.Lock()
+        os.makedirs(output_root, exist_ok=True)
+
+    def output_dir(self, video_id):
+        return os.path.join(self.output_root, str(video_id))
+
+    def available(self):
+        return shutil.which(self.ffmpeg) is not None and shutil.which(self.ffprobe) is not None
+
+    # 加入转码队列，立即返回
+    def submit(self, video_id, source):
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._jobs[str(video_id)] = token
+        self._set_status(video_id, token, source, 'pending')
+        self.queue.submit(self._transcode, video_id, source, token)
+
+    # 取消该视频仍在进行的转码并删除输出；持锁进行，不会和任务最后的改名交错
+    def remove(self, video_id):
+        with self._lock:
+            self._jobs.pop(str(video_id), None)
+            shutil.rmtree(self.output_dir(video_id), ignore_errors=True)
+
+    def _current(self, video_id, token):
+        return self._jobs.get(str(video_id)) == token
+
+    def _set_status(self, video_id, token, source, status):
+        # 回调也在锁内，任务被取消后不会再把状态写回去
+        with self._lock:
+            if not self._current(video_id, token):
+                return
+            if status in ('ready', 'failed'):
+                del self._jobs[str(video_id)]
+            if self.on_status:
+                self.on_status(video_id, status, source)
+
+    def _transcode(self, video_id, source, token):
+        self._set_status(video_id, token, source, 'processing')
+        final_dir = self.output_dir(video_id)
+        tmp_dir = final_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        try:
+            height, has_audio = probe(source, self.ffprobe)
+            renditions = pick_renditions(height, self.renditions)
+            for i in range(len(renditions)):
+                os.makedirs(os.path.join(tmp_dir, str(i)), exist_ok=True)
+            subprocess.run(hls_command(source, tmp_dir, renditions, has_audio, self.ffmpeg),
+                           check=True, capture_output=True)
+            if self.dash:
+                subprocess.run(dash_command(source, tmp_dir, renditions, has_audio, self.ffmpeg),
+                               check=True, capture_output=True)
+            with self._lock:
+                if not self._current(video_id, token):
+                    logger.info('视频 %s 的转码任务已取消，丢弃输出', video_id)
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    return
+                shutil.rmtree(final_dir, ignore_errors=True)
+                os.rename(tmp_dir, final_dir)
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            stderr = getattr(e, 'stderr', b'') or b''
+            logger.error('视频 %s 转码失败: %s %s', video_id, e, stderr.decode(errors='replace')[-2000:])
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            self._set_status(video_id, token, source, 'failed')
+            return
+        self._set_status(video_id, token, source, 'ready')
@@ -0,0 +1,409 @@
+"""
+增量维护的磁盘用量账本和配额检查。
+
+每次请求都遍历目录树统计大小太慢，这里在内存里保存一棵目录树，
+每个节点记录整棵子树的字节数、文件数和目录数。上传、删除、移动时
+只沿着路径更新各级祖先节点，代价与目录深度成正比，和文件数量无关；
+查询用量、检查配额也只需按路径找到对应节点。
+
+    ledger = UsageLedger(root, user_quota=2 * 1024 ** 3)
+    reservation = ledger.reserve(user_dir, incoming)   # 写入前检查并预留，超出时抛出 QuotaExceeded
+    try:
+        file.save(path)
+        ledger.add_file(path, reservation=reservation)  # 写入后记账，同时结清预留
+    finally:
+        ledger.release(reservation)                     # 写入失败时归还预留，已结清的不受影响
+
+预留的字节在写入完成前就计入用量，同一用户同时上传多个文件时不会一起通过检查后超出配额。
+
+- user_quota：root 下每个一级子目录（即每个用户的目录）的配额
+- total_quota：整个 root 的配额
+- set_quota() 可以单独给某个目录设置配额
+- 后台线程定期用 os.scandir 重新统计，修正其他进程或手工修改造成的偏差；
+  第一次统计完成前 check() / reserve() 会等待（必要时自己统计一次），统计失败时有配额的目录一律拒绝写入
+"""
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL = 3600   # 秒
+RECONCILE_RETRIES = 3
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, path, quota, used, incoming):
+        super().__init__(f'{path} 空间不足：已用 {used} 字节，配额 {quota} 字节，本次写入 {incoming} 字节')
+        self.path = path
+        self.quota = quota
+        self.used = used
+        self.incoming = incoming
+
+
+class Reservation:
+    """reserve() 返回的凭据，记录预留在哪个目录、多少字节"""
+    __slots__ = ('parts', 'size', 'released')
+
+    def __init__(self, parts, size):
+        self.parts = parts
+        self.size = size
+        self.released = False
+
+
+class Node:
+    __slots__ = ('size', 'files', 'dirs', 'children')
+
+    def __init__(self):
+        self.size = 0
+        self.files = 0
+        self.dirs = 0          # 子树里的目录数，不含自身
+        self.children = {}
+
+    def clone(self):
+        node = Node()
+        node.size, node.files, node.dirs = self.size, self.files, self.dirs
+        node.children = {name: child.clone() for name, child in self.children.items()}
+        return node
+
+
+def scan_tree(path):
+    """用 os.scandir 统计一棵目录树，不跟随符号链接"""
+    node = Node()
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        child = scan_tree(entry.path)
+                        node.children[entry.name] = child
+                        node.size += child.size
+                        node.files += child.files
+                        node.dirs += child.dirs + 1
+                    else:
+                        node.size += entry.stat(follow_symlinks=False).st_size
+                        node.files += 1
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return node
+
+
+class UsageLedger:
+    def __init__(self, root, user_quota=None, total_quota=None, reconcile_interval=RECONCILE_INTERVAL):
+        self.root = os.path.abspath(root)
+        self.user_quota = user_quota
+        self.total_quota = total_quota
+        self.reconcile_interval = reconcile_interval
+        self.quotas = {}
+        self.ready = False
+        self._tree = Node()
+        self._versions = {}       # 一级目录名 -> 修改次数，统计期间有修改则重试
+        self._reserved = {}       # 目录路径 parts 元组 -> 已预留未结清的字节数，含子目录
+        self._lock = threading.Lock()
+        self._reconcile_lock = threading.Lock()   # 同一时间只做一次完整统计
+        self._thread = None
+        self._pid = None
+
+    # -------- 路径和树 --------
+    def _parts(self, path):
+        rel = os.path.relpath(os.path.abspath(path), self.root)
+        if rel == '.':
+            return []
+        if rel == '..' or rel.startswith('..' + os.sep):
+            raise ValueError(f'{path} 不在 {self.root} 下')
+        return rel.split(os.sep)
+
+    def _find(self, parts):
+        node = self._tree
+        for name in parts:
+            node = node.children.get(name)
+            if node is None:
+                return None
+        return node
+
+    def _touch(self, parts):
+        key = parts[0] if parts else ''
+        self._versions[key] = self._versions.get(key, 0) + 1
+
+    def _apply(self, parts, size, files, dirs=0):
+        """把增量加到 parts 所指目录及其所有祖先上，账本里缺少的目录会被补上"""
+        self._touch(parts)
+        path = [self._tree]
+        for name in parts:
+            child = path[-1].children.get(name)
+            if child is None:
+                child = path[-1].children[name] = Node()
+                for ancestor in path:
+                    ancestor.dirs += 1
+            path.append(child)
+        for node in path:
+            node.size += size
+            node.files += files
+            node.dirs += dirs
+        return path[-1]
+
+    def _ensure_started(self):
+        if self.reconcile_interval is None:
+            return
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._reconcile_loop, name='usage-ledger', daemon=True)
+            self._thread.start()
+
+    # -------- 记账 --------
+    def add_file(self, path, size=None, replaced=None, reservation=None):
+        """
+        记录写入了一个文件。size 默认取文件实际大小；
+        覆盖已有文件时 replaced 传入原文件大小，只计差值、文件数不变。
+        reservation 为写入前 reserve() 得到的凭据，与记账在同一把锁内结清。
+        """
+        self._ensure_started()
+        if size is None:
+            size = os.stat(path).st_size
+        with self._lock:
+            if replaced is None:
+                self._apply(self._parts(os.path.dirname(path)), size, 1)
+            else:
+                self._apply(self._parts(os.path.dirname(path)), size - replaced, 0)
+            self._release(reservation)
+
+    def remove_file(self, path, size):
+        """记录删除了一个文件，size 为删除前的大小"""
+        self._ensure_started()
+        with self._lock:
+            self._apply(self._parts(os.path.dirname(path)), -size, -1)
+
+    def add_dir(self, path):
+        self._ensure_started()
+        parts = self._parts(path)
+        with self._lock:
+            parent = self._find(parts[:-1])
+            if parent is None or parts[-1] not in parent.children:
+                self._apply(parts, 0, 0)
+
+    def remove_dir(self, path):
+        """记录删除了一个目录（连同子树）"""
+        self._ensure_started()
+        parts = self._parts(path)
+        with self._lock:
+            self._detach(parts)
+
+    def _detach(self, parts):
+        parent = self._find(parts[:-1])
+        node = parent.children.get(parts[-1]) if parent is not None else None
+        if node is None:
+            return None
+        self._touch(parts)
+        self._apply(parts[:-1], -node.size, -node.files, -(node.dirs + 1))
+        del parent.children[parts[-1]]
+        return node
+
+    def move(self, src, dst):
+        """在 os.rename / os.renames 完成之后调用，把 src 的用量转到 dst 名下"""
+        self._ensure_started()
+        src_parts, dst_parts = self._parts(src), self._parts(dst)
+        is_dir = os.path.isdir(dst)
+        size = 0 if is_dir else os.stat(dst).st_size
+        with self._lock:
+            if is_dir:
+                node = self._detach(src_parts)
+                if node is None:
+                    # 账本里没有这个目录（例如刚启动还没统计完），等定期统计修正
+                    return
+                parent = self._apply(dst_parts[:-1], node.size, node.files, node.dirs + 1)
+                parent.children[dst_parts[-1]] = node
+                self._touch(dst_parts)
+            else:
+                self._apply(src_parts[:-1], -size, -1)
+                self._apply(dst_parts[:-1], size, 1)
+
+    def copy(self, src, dst, reservation=None):
+        """在复制完成之后调用，dst 按 src 的用量记账"""
+        self._ensure_started()
+        src_parts, dst_parts = self._parts(src), self._parts(dst)
+        if not os.path.isdir(dst):
+            self.add_file(dst, reservation=reservation)
+            return
+        with self._lock:
+            self._release(reservation)
+            node = self._find(src_parts)
+            if node is None:
+                return
+            node = node.clone()
+            parent = self._apply(dst_parts[:-1], node.size, node.files, node.dirs + 1)
+            parent.children[dst_parts[-1]] = node
+            self._touch(dst_parts)
+
+    # -------- 查询和配额 --------
+    def set_quota(self, path, limit):
+        """给某个目录单独设置配额，limit 为 None 表示取消"""
+        path = os.path.abspath(path)
+        if limit is None:
+            self.quotas.pop(path, None)
+        else:
+            self.quotas[path] = limit
+
+    def quota(self, path):
+        path = os.path.abspath(path)
+        if path in self.quotas:
+            return self.quotas[path]
+        parts = self._parts(path)
+        if not parts:
+            return self.total_quota
+        if len(parts) == 1:
+            return self.user_quota
+        return None
+
+    def usage(self, path):
+        """返回 {'bytes', 'files', 'dirs', 'quota'}，账本里没有的目录按空目录处理"""
+        self._ensure_started()
+        parts = self._parts(path)
+        with self._lock:
+            node = self._find(parts)
+            used = (node.size, node.files, node.dirs) if node is not None else (0, 0, 0)
+        return {'bytes': used[0], 'files': used[1], 'dirs': used[2], 'quota': self.quota(path)}
+
+    def check(self, path, incoming):
+        """
+        写入前检查 path 目录及其各级上层目录的配额，已预留未结清的字节也算作已用，
+        加上 incoming 字节后超出任意一个配额就抛出 QuotaExceeded。
+        只检查不预留；检查之后要写入的调用方用 reserve()。
+        """
+        parts = self._prepare_check(path)
+        with self._lock:
+            self._check(parts, incoming)
+
+    def reserve(self, path, incoming):
+        """
+        与 check() 相同的检查，通过后在同一把锁内预留 incoming 字节，返回 Reservation。
+        写入成功后把它传给 add_file() / copy() 结清，失败时调用 release() 归还。
+        incoming 小于 0（用更小的文件覆盖）时按 0 预留，腾出的空间由 add_file(replaced=...) 记账。
+        """
+        incoming = max(0, incoming)
+        parts = self._prepare_check(path)
+        reservation = Reservation(tuple(parts), incoming)
+        with self._lock:
+            self._check(parts, incoming)
+            for depth in range(len(parts) + 1):
+                key = reservation.parts[:depth]
+                self._reserved[key] = self._reserved.get(key, 0) + incoming
+        return reservation
+
+    def release(self, reservation):
+        """归还预留的字节；None 或已经结清的凭据什么也不做"""
+        with self._lock:
+            self._release(reservation)
+
+    def _release(self, reservation):
+        if reservation is None or reservation.released:
+            return
+        reservation.released = True
+        for depth in range(len(reservation.parts) + 1):
+            key = reservation.parts[:depth]
+            remaining = self._reserved.get(key, 0) - reservation.size
+            if remaining > 0:
+                self._reserved[key] = remaining
+            else:
+                self._reserved.pop(key, None)
+
+    def _prepare_check(self, path):
+        self._ensure_started()
+        if not self.ready:
+            # 账本为空时无法判断，先完成第一次统计；后台线程正在统计时等它完成
+            self._reconcile_once()
+        return self._parts(path)
+
+    def _check(self, parts, incoming):
+        node = self._tree
+        for depth in range(len(parts) + 1):
+            if depth:
+                node = node.children.get(parts[depth - 1]) if node is not None else None
+            directory = os.path.join(self.root, *parts[:depth])
+            limit = self.quota(directory)
+            if limit is None:
+                continue
+            # 账本里还没有的目录按空目录处理，但可能已有其他请求在里面预留了空间
+            used = (node.size if node is not None else 0) + self._reserved.get(tuple(parts[:depth]), 0)
+            if not self.ready or used + incoming > limit:
+                raise QuotaExceeded(directory, limit, used, incoming)
+
+    # -------- 定期统计 --------
+    def _reconcile_once(self):
+        with self._reconcile_lock:
+            if not self.ready:
+                self.reconcile()
+
+    def reconcile(self):
+        """重新统计整棵树，按一级目录逐个替换，统计期间被修改过的一级目录会重试"""
+        try:
+            with os.scandir(self.root) as it:
+                entries = list(it)
+        except OSError:
+            return
+        names = set()
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if not is_dir:
+                continue
+            names.add(entry.name)
+            for _ in range(RECONCILE_RETRIES):
+                version = self._versions.get(entry.name)
+                fresh = scan_tree(entry.path)
+                with self._lock:
+                    if self._versions.get(entry.name) != version:
+                        continue
+                    old = self._tree.children.get(entry.name)
+                    self._tree.children[entry.name] = fresh
+                    old_totals = (old.size, old.files, old.dirs + 1) if old is not None else (0, 0, 0)
+                    self._tree.size += fresh.size - old_totals[0]
+                    self._tree.files += fresh.files - old_totals[1]
+                    self._tree.dirs += fresh.dirs + 1 - old_totals[2]
+                    break
+        self._reconcile_root_files(names)
+        self.ready = True
+
+    def _reconcile_root_files(self, names):
+        """root 目录下直接存放的文件，以及已经不存在的一级目录"""
+        for _ in range(RECONCILE_RETRIES):
+            version = self._versions.get('')
+            size = files = 0
+            try:
+                with os.scandir(self.root) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            continue
+                        size += entry.stat(follow_symlinks=False).st_size
+                        files += 1
+            except OSError:
+                return
+            with self._lock:
+                if self._versions.get('') != version:
+                    continue
+                for name in [n for n in self._tree.children if n not in names]:
+                    self._detach([name])
+                children = self._tree.children.values()
+                self._tree.size = size + sum(child.size for child in children)
+                self._tree.files = files + sum(child.files for child in children)
+                self._tree.dirs = sum(child.dirs + 1 for child in children)
+                return
+
+    def _reconcile_loop(self):
+        while True:
+            started = time.time()
+            try:
+                with self._reconcile_lock:
+                    self.reconcile()
+                logger.info('磁盘用量统计完成，用时 %.1f 秒', time.time() - started)
+            except Exception:
+                logger.exception('磁盘用量统计失败')
+            time.sleep(self.reconcile_interval)
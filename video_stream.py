@@ -0,0 +1,192 @@
+"""
+视频文件流式输出，支持 HTTP Range 断点/拖动播放。
+
+- 单区间、多区间（multipart/byteranges）和后缀区间（bytes=-500）
+- If-Range / If-None-Match 基于 ETag 和 Last-Modified 校验
+- 整个文件交给 WSGI 服务器的 wsgi.file_wrapper，gunicorn 等支持 sendfile 的服务器可以零拷贝发送；
+  区间响应按块读出指定范围，不依赖服务器按 Content-Length 截断
+"""
+import mimetypes
+import os
+import uuid
+
+from flask import Response, abort, current_app, request
+from werkzeug.http import http_date, parse_date
+from werkzeug.utils import safe_join
+from werkzeug.wsgi import wrap_file
+
+CHUNK_SIZE = 256 * 1024  # 每次从磁盘读取的字节数
+MAX_RANGES = 16          # 单个请求允许的最大区间数，防止恶意切碎
+
+VIDEO_MIMETYPES = {
+    'mp4': 'video/mp4',
+    'mov': 'video/quicktime',
+    'mkv': 'video/x-matroska',
+    'avi': 'video/x-msvideo',
+    'm3u8': 'application/vnd.apple.mpegurl',
+    'ts': 'video/mp2t',
+    'mpd': 'application/dash+xml',
+    'm4s': 'video/iso.segment',
+}
+
+
+def guess_mimetype(filename):
+    ext = filename.rsplit('.', 1)[-1].lower()
+    if ext in VIDEO_MIMETYPES:
+        return VIDEO_MIMETYPES[ext]
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def parse_range_header(header, size):
+    """
+    解析 Range 请求头，返回 [(start, end), ...]，end 为开区间。
+    语法错误或非 bytes 单位时返回 None（按规范忽略该头，返回整个文件）；
+    全部区间都不可满足时返回空列表（应答 416）。
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            # 后缀区间：最后 N 个字节
+            if not last:
+                return None
+            length = int(last)
+            if length == 0 or size == 0:
+                continue
+            ranges.append((max(size - length, 0), size))
+            continue
+        start = int(first)
+        end = int(last) + 1 if last else size
+        if last and end <= start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    # 排序并合并重叠或相邻的区间
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _if_range_matches(etag, last_modified):
+    # If-Range 只能是强 ETag 或一个日期，不匹配时忽略 Range 返回整个文件
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    value = value.strip()
+    if value.startswith('"') or value.startswith('W/'):
+        return value == etag
+    date = parse_date(value)
+    return date is not None and int(date.timestamp()) == int(last_modified)
+
+
+def _read_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = f.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def _read_multipart(path, ranges, part_headers, closing):
+    with open(path, 'rb') as f:
+        for (start, end), headers in zip(ranges, part_headers):
+            yield headers
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+    yield closing
+
+
+def send_video(directory, filename):
+    """以支持 Range 的方式发送 directory 下的视频文件，用法同 send_from_directory"""
+    path = safe_join(directory, filename)
+    if path is None:
+        abort(404)
+    path = os.path.join(current_app.root_path, path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        abort(404)
+    if not os.path.isfile(path):
+        abort(404)
+
+    size = st.st_size
+    mimetype = guess_mimetype(filename)
+    etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Last-Modified': http_date(st.st_mtime),
+    }
+
+    if request.if_none_match.contains(etag.strip('"')):
+        return Response(status=304, headers=headers)
+
+    ranges = None
+    if _if_range_matches(etag, st.st_mtime):
+        ranges = parse_range_header(request.headers.get('Range'), size)
+
+    if ranges is None:
+        # 整个文件
+        f = open(path, 'rb')
+        resp = Response(wrap_file(request.environ, f, CHUNK_SIZE), status=200,
+                        mimetype=mimetype, headers=headers, direct_passthrough=True)
+        resp.content_length = size
+        return resp
+
+    if not ranges:
+        headers['Content-Range'] = f'bytes */{size}'
+        return Response(status=416, headers=headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        # 不用 wsgi.file_wrapper：通用的 FileWrapper 会一直读到文件末尾，
+        # 只有部分服务器（gunicorn、waitress）按 Content-Length 截断
+        resp = Response(_read_range(path, start, end), status=206, mimetype=mimetype, headers=headers,
+                        direct_passthrough=True)
+        resp.content_length = end - start
+        return resp
+
+    # 多区间：multipart/byteranges
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (f'\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n'
+         f'Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n').encode('ascii')
+        for start, end in ranges
+    ]
+    closing = f'\r\n--{boundary}--\r\n'.encode('ascii')
+    length = sum(len(h) for h in part_headers) + len(closing) + sum(end - start for start, end in ranges)
+    resp = Response(_read_multipart(path, ranges, part_headers, closing), status=206,
+                    content_type=f'multipart/byteranges; boundary={boundary}',
+                    headers=headers, direct_passthrough=True)
+    resp.content_length = length
+    return resp
@@ -3,55 +3,94 @@ import re
 import sqlite3
 import random
 import string
-import io
 from functools import wraps
 from flask import (
     Flask, request, redirect, url_for, flash, session,
     send_from_directory, g, abort, make_response, render_template, render_template_string
 )
 from flask_bootstrap import Bootstrap
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from PIL import Image, ImageDraw, ImageFilter
+from lcs import top_k
+from video_stream import send_video
+from sqlite_pool import SQLitePool
+from migrations import run_migrations, add_column
+from storage_names import display_name
+from captcha_pool import CaptchaPool, to_png
+from fonts import FontRegistry
+from session_store import open_backend, ServerSideSessionInterface, ChallengeStore, regenerate_session
+from thumbnails import ThumbnailService, send_thumbnail, thumbnail_name
+from jobs import on_first_request
+from rate_limit import RateLimiter, open_counter, client_ip, form_username
+from usage_ledger import UsageLedger, QuotaExceeded
+from blob_store import BlobStore
 
 app = Flask(__name__)
+# 登录、注册、验证码和上传限流；多进程部署时把 'memory' 换成数据库文件路径
+limiter = RateLimiter(open_counter('memory'))
 app.config['SECRET_KEY'] = 'your_secret_key_change_me'
 app.config['UPLOAD_FOLDER'] = 'user_videos'
 app.config['DATABASE'] = 'app.db'
+app.config['USER_QUOTA'] = 2 * 1024 * 1024 * 1024  # 每个用户2GB
+# 数据库连接池，请求结束时 close() 把连接归还池中
+db_pool = SQLitePool(app.config['DATABASE'])
+# 会话和验证码保存在服务端，cookie 里只有会话 id；多进程部署时把 'memory' 换成数据库文件路径
+session_backend = open_backend('memory')
+# 验证码和只取过验证码的匿名会话单独存放，不占用已登录会话的 LRU 容量
+captcha_backend = open_backend('memory')
+app.session_interface = ServerSideSessionInterface(session_backend, pending_backend=captcha_backend)
+captcha_store = ChallengeStore(captcha_backend)
 Bootstrap(app)
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# 上传后在后台生成封面，列表页不再为每个视频加载 <video>
+thumbnails = ThumbnailService()
+# 每个用户目录的磁盘用量，上传前按配额检查
+usage_ledger = UsageLedger(app.config['UPLOAD_FOLDER'], user_quota=app.config['USER_QUOTA'])
+# 相同内容的视频只存一份，用户目录里的文件是指向它的硬链接
+blobs = BlobStore('blobs')
 
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        # 连接SQLite数据库文件
-        db = g._database = sqlite3.connect(app.config['DATABASE'])
+        # 从连接池取一个连接
+        db = g._database = db_pool.acquire()
         # 设置行结果为字典形式，方便通过列名访问
         db.row_factory = sqlite3.Row
     return db
 
-def init_db():
-    db = get_db()
-    db.executescript('''
-        CREATE TABLE IF NOT EXISTS users (
+# 数据库结构迁移，版本号记录在 PRAGMA user_version 中，新的变更只能追加在末尾
+MIGRATIONS = [
+    # 1: 初始表结构
+    [
+        '''CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT, -- 用户唯一ID，自增
             username TEXT UNIQUE NOT NULL,        -- 用户名唯一且非空
             password TEXT NOT NULL                 -- 密码字段，存储明文（示例，生产环境应加密）
-        );
-        CREATE TABLE IF NOT EXISTS videos (
+        )''',
+        '''CREATE TABLE IF NOT EXISTS videos (
             id INTEGER PRIMARY KEY AUTOINCREMENT,   -- 视频唯一ID，自增
             user_id INTEGER NOT NULL,                -- 关联的用户ID（外键）
             filename TEXT NOT NULL,                   -- 视频文件名
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- 视频上传时间，默认当前时间
             FOREIGN KEY(user_id) REFERENCES users(id)       -- 建立外键约束，保证关联完整性
-        );
-    ''')
-    db.commit()  # 提交建表事务
+        )''',
+    ],
+    # 2: 个人空间和用户主页按 user_id 倒序列出视频
+    [
+        'CREATE INDEX IF NOT EXISTS idx_videos_user_id ON videos(user_id, id DESC)',
+    ],
+    # 3: 上传时的文件名单独保存用于显示，磁盘上用不会冲突的存储名；旧记录为空，显示存储名
+    add_column('videos', 'display_name', 'TEXT'),
+]
+
+def init_db():
+    run_migrations(get_db(), MIGRATIONS)
 
 @app.teardown_appcontext
 def close_connection(exception):
     db = getattr(g, '_database', None)
     if db:
-        db.close()  # 关闭数据库连接，释放资源
+        db.close()  # 归还数据库连接
 
 def valid_username(username):
     # 校验用户名是否只包含中文、英文、数字或下划线，长度限制1-20
@@ -94,43 +133,28 @@ def login_required(f):
         return f(*args, **kwargs)
     return wrapped
 
-def lcs_length(s1,s2):
-    n,m = len(s1),len(s2)
-    dp=[[0]*(m+1) for _ in range(n+1)]
-    for i in range(n):
-        for j in range(m):
-            if s1[i]==s2[j]:
-                dp[i+1][j+1]=dp[i][j]+1
-            else:
-                dp[i+1][j+1]=max(dp[i][j+1],dp[i+1][j])
-    return dp[n][m]
-
 def search_username_lcs(db, query, limit=5):
     if not query:
         return []
-    # 查询所有用户名
-    users = [row['username'] for row in db.execute('SELECT username FROM users').fetchall()]
-    # 计算每个用户名和搜索query的最长公共子序列长度
-    scored = [(lcs_length(query,u), u) for u in users]
-    # 以匹配度降序，用户名字母序升序排序
-    scored.sort(key=lambda x:(-x[0], x[1]))
-    # 返回匹配度靠前的用户名列表
-    return [u for _,u in scored[:limit]]
+    # 按用户名顺序逐行读取，同分时自然按用户名字母序排列
+    cursor = db.execute('SELECT username FROM users ORDER BY username')
+    # 有界堆只保留匹配度最高的 limit 个用户名
+    ranked = top_k(query, cursor, limit, key=lambda row: row['username'], min_score=0)
+    return [row['username'] for _, row in ranked]
+
+# 启动时查找并加载一次字体，找不到 arial 时使用 Pillow 默认字体
+font_registry = FontRegistry()
+font_registry.register('captcha', ['arial.ttf'])
+font_registry.warm_up(('captcha', 28))
 
 def random_captcha_text(length=5):
     return ''.join(random.choices(string.ascii_letters, k=length))
 
-@app.route('/captcha')
-def captcha():
-    text = random_captcha_text()
-    session['captcha_text'] = text  # 将验证码字符串存入Session，后续验证用
+def create_captcha_image(text):
     width, height = 120, 40
     image = Image.new('RGB', (width, height), 'white')
     draw = ImageDraw.Draw(image)
-    try:
-        font = ImageFont.truetype('arial.ttf', 28)  # 尝试加载系统字体
-    except:
-        font = ImageFont.load_default()
+    font = font_registry.get('captcha', 28)
     for _ in range(5):  # 画5条随机干扰线
         start=(random.randint(0,width), random.randint(0,height))
         end=(random.randint(0,width), random.randint(0,height))
@@ -140,10 +164,17 @@ def captcha():
         y=5+random.randint(-2,2)
         draw.text((x,y), c, font=font, fill=(0,0,0))
     image = image.filter(ImageFilter.GaussianBlur(1))  # 轻微模糊，防止识别
-    buf=io.BytesIO()
-    image.save(buf, 'png')
-    buf.seek(0)
-    resp=make_response(buf.read())
+    return image
+
+# 后台线程预先渲染验证码，请求时直接取出 PNG
+captcha_pool = CaptchaPool(random_captcha_text, lambda text: to_png(create_captcha_image(text)))
+
+@app.route('/captcha')
+@limiter.limit('30/minute', key=client_ip, methods=None)
+def captcha():
+    text, png = captcha_pool.get()
+    captcha_store.issue(text)  # 答案按会话 id 存在服务端，后续验证用
+    resp=make_response(png)
     resp.headers['Content-Type']='image/png'
     resp.headers['Cache-Control']='no-store,no-cache,must-revalidate,max-age=0'
     return resp
@@ -158,12 +189,13 @@ def home():
 
 # --- 注册 ---
 @app.route('/register', methods=['GET','POST'])
+@limiter.limit('10/hour', key=client_ip)
 def register():
     if request.method=='POST':
         username=request.form['username'].strip()
         password=request.form['password']
         captcha_input=request.form['captcha'].strip()
-        if captcha_input != session.get('captcha_text',''):
+        if not captcha_store.verify(captcha_input):
             flash('验证码错误', 'danger')
             return redirect(url_for('register'))
         if not valid_username(username):
@@ -179,6 +211,7 @@ def register():
         db.execute('INSERT INTO users (username,password) VALUES (?,?)',(username,password))
         db.commit()
         user_id=db.execute('SELECT id FROM users WHERE username=?',(username,)).fetchone()['id']
+        regenerate_session()
         session['user_id']=user_id
         session['username']=username
         flash('注册成功，欢迎！', 'success')
@@ -187,12 +220,14 @@ def register():
 
 # --- 登录 ---
 @app.route('/login', methods=['GET','POST'])
+@limiter.limit('20/minute', key=client_ip)
+@limiter.limit('5/minute', key=form_username)
 def login():
     if request.method=='POST':
         username=request.form['username'].strip()
         password=request.form['password']
         captcha_input=request.form['captcha'].strip()
-        if captcha_input != session.get('captcha_text',''):
+        if not captcha_store.verify(captcha_input):
             flash('验证码错误', 'danger')
             return redirect(url_for('login'))
         db=get_db()
@@ -200,6 +235,7 @@ def login():
         if not user or user['password'] != password:
             flash('用户名或密码错误', 'danger')
             return redirect(url_for('login'))
+        regenerate_session()
         session['user_id']=user['id']
         session['username']=user['username']
         flash('登录成功！', 'success')
@@ -215,6 +251,7 @@ def logout():
 
 # --- 个人空间，上传及视频管理 ---
 @app.route('/dashboard', methods=['GET','POST'])
+@limiter.limit('60/hour', key=client_ip)
 @login_required
 def dashboard():
     db=get_db()
@@ -228,21 +265,32 @@ def dashboard():
         if not file.filename or not allowed_file(file.filename):
             flash('文件类型不支持或文件名为空', 'danger')
             return redirect(url_for('dashboard'))
-        filename=secure_filename(file.filename)
+        # 显示名保留用户上传时的原始文件名，磁盘上用 uuid 存储名
+        name=display_name(file.filename)
         user_dir=current_user_dir()
-        fp=os.path.join(user_dir, filename)
-        counter=1
-        base, ext = os.path.splitext(filename)
-        while os.path.exists(fp):
-            filename = f"{base}_{counter}{ext}"
+        # 分块传输的请求没有 Content-Length，无法在写入前检查配额
+        if request.content_length is None:
+            abort(411)
+        try:
+            reservation=usage_ledger.reserve(user_dir, request.content_length)
+        except QuotaExceeded:
+            flash('存储空间不足，请先删除部分视频', 'danger')
+            return redirect(url_for('dashboard'))
+        # O_EXCL 创建 uuid 存储名，不用逐个探测同名文件
+        try:
+            filename=blobs.save_new(file, user_dir, file.filename)
             fp=os.path.join(user_dir, filename)
-            counter+=1
-        file.save(fp)
-        db.execute('INSERT INTO videos (user_id,filename) VALUES (?,?)', (user_id, filename))
+            usage_ledger.add_file(fp, reservation=reservation)
+        finally:
+            # 写入失败时归还预留的空间，成功时已在 add_file() 里结清
+            usage_ledger.release(reservation)
+        db.execute('INSERT INTO videos (user_id,filename,display_name) VALUES (?,?,?)', (user_id, filename, name))
         db.commit()
-        flash(f'视频“{filename}”上传成功', 'success')
+        thumbnails.submit(user_dir, filename)
+        flash(f'视频“{name}”上传成功', 'success')
         return redirect(url_for('dashboard'))
-    videos=db.execute('SELECT id, filename FROM videos WHERE user_id=? ORDER BY id DESC', (user_id,)).fetchall()
+    videos=db.execute('SELECT id, filename, COALESCE(display_name, filename) AS display_name FROM videos '
+                      'WHERE user_id=? ORDER BY id DESC', (user_id,)).fetchall()
     return render_template('dashboard.html', username=username, videos=videos)
 
 # --- 删除视频 ---
@@ -257,10 +305,13 @@ def delete_video(video_id):
         return redirect(url_for('dashboard'))
     fp=os.path.join(current_user_dir(), video['filename'])
     if os.path.exists(fp):
-        os.remove(fp)
+        size=os.path.getsize(fp)
+        blobs.unlink(fp)
+        usage_ledger.remove_file(fp, size)
+    thumbnails.remove(current_user_dir(), video['filename'])
     db.execute('DELETE FROM videos WHERE id=?', (video_id,))
     db.commit()
-    flash(f'视频“{video["filename"]}”已删除', 'success')
+    flash(f'视频“{video["display_name"] or video["filename"]}”已删除', 'success')
     return redirect(url_for('dashboard'))
 
 # --- 公开用户视频列表 ---
@@ -274,7 +325,8 @@ def user_videos(username):
     if not user:
         flash('用户不存在', 'danger')
         return redirect(url_for('home'))
-    videos=db.execute('SELECT id, filename FROM videos WHERE user_id=? ORDER BY id DESC', (user['id'],)).fetchall()
+    videos=db.execute('SELECT id, filename, COALESCE(display_name, filename) AS display_name FROM videos '
+                      'WHERE user_id=? ORDER BY id DESC', (user['id'],)).fetchall()
     return render_template('user_videos.html', username=username, videos=videos)
 
 # --- 播放视频 ---
@@ -287,11 +339,13 @@ def play_video(username, filename):
     if not user:
         flash('用户不存在', 'danger')
         return redirect(url_for('home'))
+    video=db.execute('SELECT display_name FROM videos WHERE user_id=? AND filename=?', (user['id'], filename)).fetchone()
+    name=(video and video['display_name']) or filename
     video_url=url_for('serve_video', username=username, filename=filename)
     download_url=url_for('download_video', username=username, filename=filename)
     user_url=url_for('user_videos', username=username)
     return render_template('play_video.html', navbar=render_template_string(NAVBAR_HTML, search_query=''),
-                           username=username, filename=filename,
+                           username=username, filename=filename, display_name=name,
                            video_url=video_url, download_url=download_url, user_url=user_url)
 
 # --- 视频资源和下载 ---
@@ -300,14 +354,46 @@ def serve_video(username, filename):
     if not valid_username(username) or not allowed_file(filename):
         abort(404)
     path=os.path.join(app.config['UPLOAD_FOLDER'], username)
-    return send_from_directory(path, filename)
+    return send_video(path, filename)
+
+# 封面缩略图，URL 带版本号，长期缓存
+@app.route('/thumbs/<username>/<name>')
+def thumbnail_file(username, name):
+    if not valid_username(username):
+        abort(404)
+    return send_thumbnail(os.path.join(app.config['UPLOAD_FOLDER'], username), name)
+
+@app.context_processor
+def inject_poster_url():
+    # 缩略图已生成时返回带版本号的 URL，否则返回 None
+    def poster_url(username, filename, kind='poster'):
+        directory = os.path.join(app.config['UPLOAD_FOLDER'], username)
+        version = thumbnails.version(directory, filename, kind)
+        if version is None:
+            return None
+        return url_for('thumbnail_file', username=username, name=thumbnail_name(filename, kind), v=version)
+    return dict(poster_url=poster_url)
+
+def backfill_posters():
+    # 加入缩略图功能之前上传的视频补生成封面
+    rows=get_db().execute('SELECT u.username, v.filename FROM videos v JOIN users u ON u.id=v.user_id').fetchall()
+    for row in rows:
+        thumbnails.backfill(os.path.join(app.config['UPLOAD_FOLDER'], row['username']), [row['filename']])
+
+# 每个服务进程处理第一个请求前执行一次，不依赖 app.run() 和重载器
+on_first_request(app, backfill_posters)
 
 @app.route('/download/<username>/<filename>')
 def download_video(username, filename):
     if not valid_username(username) or not allowed_file(filename):
         abort(404)
     path=os.path.join(app.config['UPLOAD_FOLDER'], username)
-    return send_from_directory(path, filename, as_attachment=True)
+    # 下载时使用上传时的文件名
+    db=get_db()
+    video=db.execute('SELECT v.display_name FROM videos v JOIN users u ON u.id=v.user_id '
+                     'WHERE u.username=? AND v.filename=?', (username, filename)).fetchone()
+    name=(video and video['display_name']) or filename
+    return send_from_directory(path, filename, as_attachment=True, download_name=name)
 
 # --- 初始化数据库命令 ---
 @app.cli.command('initdb')
@@ -317,9 +403,9 @@ def initdb_command():
 
 # --- 主入口 ---
 if __name__ == '__main__':
-    if not os.path.exists(app.config['DATABASE']):
-        with app.app_context():
-            init_db()
+    # 每次启动都执行迁移，已是最新版本时什么也不做
+    with app.app_context():
+        init_db()
     app.run(debug=True)
 
 
@@ -499,15 +585,17 @@ if __name__ == '__main__':
   <div class="col">
     <div class="card shadow-sm h-100">
       <a href="{{ url_for('play_video', username=username, filename=video.filename) }}" class="stretched-link text-decoration-none">
-        <video class="card-img-top" preload="metadata" muted style="height:160px; object-fit:cover;">
-          <source src="{{ url_for('serve_video', username=username, filename=video.filename) }}" type="video/mp4" />
-          您的浏览器不支持视频播放。
-        </video>
+        {% set poster = poster_url(username, video.filename) %}
+        {% if poster %}
+        <img class="card-img-top" src="{{ poster }}" alt="{{ video.display_name }}" loading="lazy" style="height:160px; object-fit:cover; background:#000;" />
+        {% else %}
+        <div class="card-img-top d-flex align-items-center justify-content-center text-white" style="height:160px; background:#000;">封面生成中</div>
+        {% endif %}
       </a>
       <div class="card-body">
-        <h5 class="card-title text-truncate" title="{{ video.filename }}">{{ video.filename }}</h5>
+        <h5 class="card-title text-truncate" title="{{ video.display_name }}">{{ video.display_name }}</h5>
         <a href="{{ url_for('download_video', username=username, filename=video.filename) }}" class="btn btn-sm btn-outline-primary">下载</a>
-        <form action="{{ url_for('delete_video', video_id=video.id) }}" method="post" class="d-inline" onsubmit="return confirm('确定删除视频 {{ video.filename }} 吗？');">
+        <form action="{{ url_for('delete_video', video_id=video.id) }}" method="post" class="d-inline" onsubmit='return confirm({{ ("确定删除视频 " ~ video.display_name ~ " 吗？")|tojson }});'>
           <button class="btn btn-sm btn-outline-danger" type="submit">删除</button>
         </form>
       </div>
@@ -535,13 +623,15 @@ if __name__ == '__main__':
   <div class="col">
     <div class="card shadow-sm h-100">
       <a href="{{ url_for('play_video', username=username, filename=video.filename) }}" class="stretched-link text-decoration-none">
-        <video class="card-img-top" preload="metadata" muted style="height:160px; object-fit:cover;">
-          <source src="{{ url_for('serve_video', username=username, filename=video.filename) }}" type="video/mp4" />
-          您的浏览器不支持视频播放。
-        </video>
+        {% set poster = poster_url(username, video.filename) %}
+        {% if poster %}
+        <img class="card-img-top" src="{{ poster }}" alt="{{ video.display_name }}" loading="lazy" style="height:160px; object-fit:cover; background:#000;" />
+        {% else %}
+        <div class="card-img-top d-flex align-items-center justify-content-center text-white" style="height:160px; background:#000;">封面生成中</div>
+        {% endif %}
       </a>
       <div class="card-body">
-        <h5 class="card-title text-truncate" title="{{ video.filename }}">{{ video.filename }}</h5>
+        <h5 class="card-title text-truncate" title="{{ video.display_name }}">{{ video.display_name }}</h5>
         <a href="{{ url_for('download_video', username=username, filename=video.filename) }}" class="btn btn-sm btn-outline-primary">下载</a>
       </div>
     </div>
@@ -559,12 +649,12 @@ if __name__ == '__main__':
 ## 7. play_video.html
 
 {% extends "base.html" %}
-{% block title %}播放 - {{ filename }}{% endblock %}
+{% block title %}播放 - {{ display_name }}{% endblock %}
 {% block content %}
 <main class="container my-4">
-  <h3>{{ filename }}</h3>
+  <h3>{{ display_name }}</h3>
   <p>上传用户：<a href="{{ url_for('user_videos', username=username) }}">{{ username }}</a></p>
-  <video controls preload="metadata" autoplay style="max-width: 100%; height: auto; display:block; margin-bottom:1rem;">
+  <video controls preload="metadata" autoplay{% if poster_url(username, filename) %} poster="{{ poster_url(username, filename) }}"{% endif %} style="max-width: 100%; height: auto; display:block; margin-bottom:1rem;">
     <source src="{{ video_url }}" type="video/mp4" />
     您的浏览器不支持 HTML5 视频播放。
   </video>
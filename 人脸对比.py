@@ -1,7 +1,16 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
 import cv2
 import face_recognition
 import numpy as np
 
+from face_index import FaceIndex
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+
 # ------------------------------------------------------------------
 # Function: estimate_blurriness
 # Use the variance of the Laplacian to estimate image sharpness.
@@ -12,70 +21,202 @@ import numpy as np
 def estimate_blurriness(gray_image):
     return cv2.Laplacian(gray_image, cv2.CV_64F).var()
 # ------------------------------------------------------------------
+# Function: detect_faces
+# Run face detection on a copy scaled down so its longer side is at
+# most max_side pixels, then map the boxes back to full resolution.
+# Input: rgb_image (numpy array), max_side (int or None = full size),
+#        model ('hog' or 'cnn'), upsample (int)
+# Output: list of (top, right, bottom, left) in full-resolution pixels
+# ------------------------------------------------------------------
+DETECT_MAX_SIDE = 1600
+
+def detect_faces(rgb_image, max_side=DETECT_MAX_SIDE, model='hog', upsample=1):
+    height, width = rgb_image.shape[:2]
+    scale = 1.0
+    if max_side and max(height, width) > max_side:
+        scale = max_side / max(height, width)
+        small = cv2.resize(rgb_image, (round(width * scale), round(height * scale)),
+                           interpolation=cv2.INTER_AREA)
+    else:
+        small = rgb_image
+    locations = face_recognition.face_locations(small, number_of_times_to_upsample=upsample, model=model)
+    if scale == 1.0:
+        return locations
+    return [
+        (max(0, int(top / scale)), min(width, int(round(right / scale))),
+         min(height, int(round(bottom / scale))), max(0, int(left / scale)))
+        for top, right, bottom, left in locations
+    ]
+# ------------------------------------------------------------------
 # Function: process_image
 # Detect faces, landmarks, encode faces, and estimate blurriness.
-# Input: image_path (string)
+# Detection runs on a downscaled copy (see detect_faces); encoding
+# and blurriness use the full-resolution pixels.
+# Input: image_path (string), landmarks (bool, skip to save time),
+#        detect_max_side / model / upsample (passed to detect_faces)
 # Output: list of face_info dictionaries
 #   face_info contains:
 #     - 'index': face index in this image
 #     - 'location': (top, right, bottom, left)
-#     - 'landmarks': dict of facial landmarks
+#     - 'landmarks': dict of facial landmarks ({} when landmarks=False)
 #     - 'encoding': 128-dim list
 #     - 'blurriness': float
 # ------------------------------------------------------------------
-def process_image(image_path):
+def process_image(image_path, landmarks=True, detect_max_side=DETECT_MAX_SIDE, model='hog', upsample=1):
     # Read the image in BGR format
     bgr_image = cv2.imread(image_path)
     if bgr_image is None:
         raise FileNotFoundError(f"Cannot read image: {image_path}")
-    # Convert to RGB for face_recognition, and to grayscale for blurriness
+    # One full-frame conversion to RGB for face_recognition;
+    # grayscale is only computed for the face crops below
     rgb_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB)
-    gray_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2GRAY)
 
     # 1. Face detection (returns list of (top, right, bottom, left))
-    face_locations = face_recognition.face_locations(rgb_image, model='hog')
+    face_locations = detect_faces(rgb_image, detect_max_side, model, upsample)
+    if not face_locations:
+        return []
     # 2. Facial landmarks
-    landmarks_list = face_recognition.face_landmarks(rgb_image, face_locations)
+    if landmarks:
+        landmarks_list = face_recognition.face_landmarks(rgb_image, face_locations)
+    else:
+        landmarks_list = [{} for _ in face_locations]
 
     # 3. Face encodings (128-dim vectors)
     encodings_list = face_recognition.face_encodings(rgb_image, face_locations)
     faces_info = []
-    for idx, (loc, landmarks, encoding) in enumerate(zip(face_locations, landmarks_list, encodings_list)):
+    for idx, (loc, face_landmarks, encoding) in enumerate(zip(face_locations, landmarks_list, encodings_list)):
         top, right, bottom, left = loc
         # Crop the face region in grayscale to estimate blurriness
-        face_gray = gray_image[top:bottom, left:right]
-        blurriness = float(estimate_blurriness(face_gray))
+        face_bgr = bgr_image[top:bottom, left:right]
+        blurriness = float(estimate_blurriness(cv2.cvtColor(face_bgr, cv2.COLOR_BGR2GRAY))) if face_bgr.size else 0.0
         face_info = {
             'index': idx,
             'location': {'top': top, 'right': right, 'bottom': bottom, 'left': left},
-            'landmarks': landmarks,           # dict of lists of (x,y)
+            'landmarks': face_landmarks,      # dict of lists of (x,y)
             'encoding': encoding.tolist(),    # convert numpy array to list
             'blurriness': blurriness
         }
         faces_info.append(face_info)
     return faces_info
 # ------------------------------------------------------------------
+# Function: stack_encodings
+# Stack face encodings into one contiguous float32 matrix.
+# Input: encodings (list of 128-dim lists/arrays, or an (n, 128) array)
+# Output: (n, 128) float32 C-contiguous numpy array
+# ------------------------------------------------------------------
+def stack_encodings(encodings):
+    if len(encodings) == 0:
+        return np.empty((0, 128), dtype=np.float32)
+    return np.ascontiguousarray(np.asarray(encodings, dtype=np.float32).reshape(len(encodings), -1))
+# ------------------------------------------------------------------
+# Function: pairwise_distances
+# Euclidean distances between every row of A and every row of B,
+# computed as |a|^2 + |b|^2 - 2ab with a single matrix product.
+# Input: A (n, 128), B (m, 128) float32 matrices
+# Output: (n, m) float32 numpy array
+# ------------------------------------------------------------------
+def pairwise_distances(A, B):
+    sq = (A * A).sum(axis=1)[:, None] + (B * B).sum(axis=1)[None, :] - 2.0 * (A @ B.T)
+    # Rounding can push near-identical pairs slightly below zero
+    np.maximum(sq, 0.0, out=sq)
+    return np.sqrt(sq, out=sq)
+# ------------------------------------------------------------------
 # Function: compare_faces
-# Compare two lists of 128-dim face encodings.
-# Input: encodings_a, encodings_b (both lists of lists), threshold (float)
-# Output: distance_matrix, match_matrix
+# Compare two sets of 128-dim face encodings in one vectorized step.
+# Input: encodings_a, encodings_b (lists or arrays of encodings), threshold (float)
+# Output: distance_matrix, match_matrix (numpy arrays of shape (len(a), len(b)))
 #   distance_matrix[i][j] = euclidean distance between a_i and b_j
 #   match_matrix[i][j] = True if distance <= threshold else False
 # ------------------------------------------------------------------
 def compare_faces(encodings_a, encodings_b, threshold=0.6):
-    A = [np.array(e) for e in encodings_a]
-    B = [np.array(e) for e in encodings_b]
+    distances = pairwise_distances(stack_encodings(encodings_a), stack_encodings(encodings_b))
+    return distances, distances <= threshold
+# ------------------------------------------------------------------
+# Function: process_directory
+# Run process_image over every image in a directory with a process pool.
+# Unreadable images are reported and skipped.
+# Input: directory (string), workers (int, default: CPU count),
+#        keyword options passed on to process_image
+# Output: list of (image_path, faces_info), sorted by path
+# ------------------------------------------------------------------
+def _process_image_safe(image_path, **options):
+    try:
+        return image_path, process_image(image_path, **options)
+    except Exception as e:
+        print(f"Skipping {image_path}: {e}")
+        return image_path, []
+
+def list_images(directory):
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+    )
+
+def process_paths(paths, workers=None, **options):
+    if not paths:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(partial(_process_image_safe, **options), paths,
+                             chunksize=max(1, len(paths) // 64)))
 
-    distance_matrix = []
-    match_matrix = []
+def process_directory(directory, workers=None, **options):
+    return process_paths(list_images(directory), workers, **options)
+# ------------------------------------------------------------------
+# Function: compare_directories
+# Encode all faces in two directories and compare every face pair.
+# Input: dir_a, dir_b (strings), threshold (float), workers (int)
+# Output: labels_a, labels_b, distance_matrix, match_matrix
+#   labels_x[i] = (image_path, face index) of row/column i
+# ------------------------------------------------------------------
+def compare_directories(dir_a, dir_b, threshold=0.6, workers=None):
+    def flatten(results):
+        labels = [(path, face['index']) for path, faces in results for face in faces]
+        encodings = [face['encoding'] for _, faces in results for face in faces]
+        return labels, stack_encodings(encodings)
 
-    for a in A:
-        distances = face_recognition.face_distance(B, a)
-        matches = distances <= threshold
-        distance_matrix.append([float(d) for d in distances])
-        match_matrix.append([bool(m) for m in matches])
+    labels_a, A = flatten(process_directory(dir_a, workers, landmarks=False))
+    labels_b, B = flatten(process_directory(dir_b, workers, landmarks=False))
+    distances, matches = compare_faces(A, B, threshold)
+    return labels_a, labels_b, distances, matches
 
-    return distance_matrix, match_matrix
+# ------------------------------------------------------------------
+# Function: index_directory
+# Encode the images of a directory into a persistent FaceIndex.
+# Images already processed are skipped, including those with no
+# faces or that could not be read, so re-running only processes
+# new files.
+# Input: index (FaceIndex), directory (string), label (string), workers (int)
+# Output: number of faces added
+# ------------------------------------------------------------------
+def index_directory(index, directory, label=None, workers=None):
+    paths = [path for path in list_images(directory) if not index.has_image(path)]
+    added = 0
+    try:
+        for path, faces in process_paths(paths, workers, landmarks=False):
+            added += len(index.add([f['encoding'] for f in faces], path,
+                                   face_indexes=[f['index'] for f in faces], label=label))
+    finally:
+        # add() does not msync; write the whole batch out once
+        index.flush()
+    return added
+# ------------------------------------------------------------------
+# Function: identify
+# Look up every face of an image in a FaceIndex.
+# Input: index (FaceIndex), image_path (string), k (int), threshold (float)
+# Output: list of (face_info, matches) per detected face
+#   matches = list of (metadata dict, distance) with distance <= threshold
+# ------------------------------------------------------------------
+def identify(index, image_path, k=5, threshold=0.6, nprobe=None):
+    faces = process_image(image_path, landmarks=False)
+    if not faces or not len(index):
+        return [(face, []) for face in faces]
+    distances, ids = index.search(stack_encodings([f['encoding'] for f in faces]), k, nprobe)
+    results = []
+    for face, dist_row, id_row in zip(faces, distances, ids):
+        keep = (id_row >= 0) & (dist_row <= threshold)
+        metas = index.metadata(id_row[keep])
+        results.append((face, [(meta, float(d)) for meta, d in zip(metas, dist_row[keep])]))
+    return results
 
 # ------------------------------------------------------------------
 # Function: annotate_image
@@ -100,6 +241,29 @@ def annotate_image(image_path, faces_info):
 # Main routine
 # ------------------------------------------------------------------
 if __name__ == '__main__':
+    # python 人脸对比.py dir_a dir_b : compare every face in two image directories
+    if len(sys.argv) == 3 and all(os.path.isdir(p) for p in sys.argv[1:]):
+        labels_a, labels_b, distances, matches = compare_directories(sys.argv[1], sys.argv[2])
+        print(f"{len(labels_a)} face(s) in {sys.argv[1]}, {len(labels_b)} face(s) in {sys.argv[2]}")
+        for i, j in zip(*np.nonzero(matches)):
+            (path_a, idx_a), (path_b, idx_b) = labels_a[i], labels_b[j]
+            print(f"{path_a}[{idx_a}] ~ {path_b}[{idx_b}]: Distance = {distances[i, j]:.3f}")
+        sys.exit(0)
+    # python 人脸对比.py index <index_dir> <image_dir> [label] : add a directory to an index
+    # python 人脸对比.py identify <index_dir> <image>          : search an image's faces in an index
+    if len(sys.argv) >= 4 and sys.argv[1] in ('index', 'identify'):
+        index = FaceIndex(sys.argv[2])
+        if sys.argv[1] == 'index':
+            added = index_directory(index, sys.argv[3], label=sys.argv[4] if len(sys.argv) > 4 else None)
+            print(f"Added {added} face(s); index now holds {len(index)}.")
+        else:
+            for face, matches in identify(index, sys.argv[3]):
+                print(f"Face {face['index']} at {face['location']}:")
+                for meta, d in matches:
+                    print(f"  {meta['label'] or ''} {meta['image_path']}[{meta['face_index']}] Distance = {d:.3f}")
+        index.close()
+        sys.exit(0)
+
     img_path1 = 'person1.jpg'
     img_path2 = 'person2.jpg'
 
@@ -1,12 +1,32 @@
 from flask import Flask, request, jsonify, send_file, abort, render_template
 import os
+import shutil
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
+from rate_limit import RateLimiter, open_counter, client_ip
+from dir_cache import DirCache
+from usage_ledger import UsageLedger, QuotaExceeded
+from zip_stream import send_zip
+from fast_copy import copy_file, copy_tree, tree_size
+from blob_store import BlobStore
 
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = int(os.environ.get("STORAGE_MAX_UPLOAD", 2 * 1024 ** 3))  # 单次上传上限，默认2GB
+# 登录、注册、验证码和上传限流；多进程部署时把 'memory' 换成数据库文件路径
+limiter = RateLimiter(open_counter('memory'))
 
 # 后端存储根目录
 BASE_DIR = os.path.abspath("storage")
 os.makedirs(BASE_DIR, exist_ok=True)
+MAX_BATCH_OPS = 5000  # 单次批量操作的最大条数
+# 按内容去重的存储，放在 storage 之外，storage 里的文件是指向它的硬链接
+blobs = BlobStore(os.path.abspath("blobs"))
+# 目录列表缓存；本进程的修改主动失效，其他来源的修改靠 inotify
+dir_cache = DirCache()
+# 磁盘用量账本；STORAGE_QUOTA 为总配额（字节），STORAGE_DIR_QUOTA 为每个一级目录的配额，不设置表示不限
+usage_ledger = UsageLedger(BASE_DIR,
+                           user_quota=int(os.environ.get("STORAGE_DIR_QUOTA", 0)) or None,
+                           total_quota=int(os.environ.get("STORAGE_QUOTA", 0)) or None)
 
 def safe_path(rel_path=""):
     """
@@ -17,6 +37,15 @@ def safe_path(rel_path=""):
         abort(400, description="非法路径访问")
     return target
 
+def invalidate_ancestors(path):
+    """os.renames 会创建或清理中间目录，从 path 的父目录一直失效到根目录"""
+    parent = os.path.dirname(path)
+    while parent.startswith(BASE_DIR):
+        dir_cache.invalidate(parent)
+        if parent == BASE_DIR:
+            break
+        parent = os.path.dirname(parent)
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -25,18 +54,23 @@ def index():
 def list_files():
     rel = request.args.get("path", "")
     dirp = safe_path(rel)
-    if not os.path.isdir(dirp):
+    try:
+        entries = dir_cache.entries(dirp)
+    except (FileNotFoundError, NotADirectoryError):
         abort(404, description="目录不存在")
-    items = []
-    for name in sorted(os.listdir(dirp)):
-        full = os.path.join(dirp, name)
-        items.append({
-            "name": name,
-            "is_dir": os.path.isdir(full)
-        })
+    items = [{"name": name, "is_dir": is_dir} for name, is_dir in entries]
     return jsonify({"current": rel, "items": items})
 
+@app.route("/api/usage", methods=["GET"])
+def usage():
+    rel = request.args.get("path", "")
+    dirp = safe_path(rel)
+    if not os.path.isdir(dirp):
+        abort(404, description="目录不存在")
+    return jsonify({"path": rel, **usage_ledger.usage(dirp)})
+
 @app.route("/api/upload", methods=["POST"])
+@limiter.limit('60/hour', key=client_ip)
 def upload():
     f = request.files.get("file")
     if not f or f.filename == "":
@@ -46,7 +80,21 @@ def upload():
     if not os.path.isdir(dirp):
         abort(404, description="目录不存在")
     filename = secure_filename(f.filename)
-    f.save(os.path.join(dirp, filename))
+    target = os.path.join(dirp, filename)
+    replaced = os.path.getsize(target) if os.path.isfile(target) else None
+    if request.content_length is None:
+        abort(411, description="缺少 Content-Length")
+    try:
+        # 请求体长度略大于文件本身，作为上限检查
+        reservation = usage_ledger.reserve(dirp, request.content_length - (replaced or 0))
+    except QuotaExceeded:
+        abort(413, description="存储空间不足")
+    try:
+        blobs.save(f, target)
+        dir_cache.invalidate(dirp)
+        usage_ledger.add_file(target, replaced=replaced, reservation=reservation)
+    finally:
+        usage_ledger.release(reservation)
     return jsonify({"msg": "上传成功"})
 
 @app.route("/api/download", methods=["GET"])
@@ -59,23 +107,132 @@ def download():
         abort(404, description="文件不存在")
     return send_file(fp, as_attachment=True)
 
-@app.route("/api/delete", methods=["POST"])
-def delete():
-    rel = request.form.get("path")
-    if not rel:
-        abort(400, description="请指定path")
-    target = safe_path(rel)
-    if os.path.isfile(target):
-        os.remove(target)
-        return jsonify({"msg": "文件已删除"})
+@app.route("/api/download_dir", methods=["GET"])
+def download_dir():
+    """整个目录打包成 zip 边生成边下载；compress=1 时压缩，默认只打包"""
+    rel = request.args.get("path", "")
+    dirp = safe_path(rel)
+    if not os.path.isdir(dirp):
+        abort(404, description="目录不存在")
+    compress = request.args.get("compress", "") in ("1", "true", "deflate")
+    name = os.path.basename(dirp) if dirp != BASE_DIR else "storage"
+    return send_zip(dirp, name + ".zip", compress=compress)
+
+# -------- 文件操作，单个接口和批量接口共用，出错时 abort --------
+def delete_path(target, recursive=False):
+    if target == BASE_DIR:
+        abort(400, description="不能删除根目录")
+    if os.path.isfile(target) or os.path.islink(target):
+        size = os.lstat(target).st_size
+        blobs.unlink(target)
+        dir_cache.invalidate(os.path.dirname(target))
+        usage_ledger.remove_file(target, size)
+        return "文件已删除"
     if os.path.isdir(target):
         try:
-            os.rmdir(target)
-            return jsonify({"msg": "目录已删除"})
+            if recursive:
+                shutil.rmtree(target)
+            else:
+                os.rmdir(target)
         except OSError:
             abort(400, description="目录非空或无法删除")
+        finally:
+            # rmtree 中途失败时已经删掉了一部分
+            dir_cache.invalidate(target, os.path.dirname(target), recursive=True)
+        usage_ledger.remove_dir(target)
+        return "目录已删除"
     abort(404, description="目标不存在")
 
+def make_dir(newp, parents=False):
+    if os.path.exists(newp):
+        abort(400, description="目录已存在")
+    parent = os.path.dirname(newp)
+    if not parents and not os.path.isdir(parent):
+        abort(404, description="父目录不存在")
+    try:
+        os.makedirs(newp) if parents else os.mkdir(newp)
+    except FileExistsError:
+        abort(400, description="目录已存在")
+    invalidate_ancestors(newp)
+    usage_ledger.add_dir(newp)
+    return "目录创建成功"
+
+def move_path(psrc, pdst):
+    if not os.path.exists(psrc):
+        abort(404, description="源不存在")
+    if os.path.exists(pdst):
+        abort(400, description="目标已存在")
+    if pdst.startswith(psrc + os.sep):
+        abort(400, description="不能移动到自身的子目录")
+    os.renames(psrc, pdst)
+    dir_cache.invalidate(psrc, recursive=True)
+    invalidate_ancestors(psrc)
+    invalidate_ancestors(pdst)
+    usage_ledger.move(psrc, pdst)
+    return "移动成功"
+
+def remove_partial(path):
+    """复制中途失败时删除已经写入的部分"""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def copy_path(psrc, pdst):
+    """服务器端复制，同一文件系统上用 reflink / copy_file_range，数据不经过本进程"""
+    if not os.path.exists(psrc) or os.path.islink(psrc):
+        abort(404, description="源不存在")
+    if os.path.exists(pdst):
+        abort(400, description="目标已存在")
+    if pdst.startswith(psrc + os.sep):
+        abort(400, description="不能复制到自身的子目录")
+    if not os.path.isdir(os.path.dirname(pdst)):
+        abort(404, description="目标父目录不存在")
+    is_dir = os.path.isdir(psrc)
+    if is_dir:
+        size = usage_ledger.usage(psrc)["bytes"] if usage_ledger.ready else tree_size(psrc)
+    else:
+        size = os.path.getsize(psrc)
+    try:
+        reservation = usage_ledger.reserve(os.path.dirname(pdst), size)
+    except QuotaExceeded:
+        abort(413, description="存储空间不足")
+    try:
+        if is_dir:
+            copy_tree(psrc, pdst)
+        else:
+            digest = blobs.digest_of(psrc)
+            # 去重存储里的文件复制时只需再加一个硬链接
+            if digest:
+                blobs.link(digest, pdst)
+            else:
+                copy_file(psrc, pdst)
+    except OSError as e:
+        if isinstance(e, FileExistsError) and e.filename == pdst:
+            # 检查之后被其他请求抢先创建，不是本次写入的，不能删除
+            abort(400, description="目标已存在")
+        remove_partial(pdst)
+        abort(500, description=f"复制失败：{e.strerror or e}")
+    else:
+        usage_ledger.copy(psrc, pdst, reservation=reservation)
+    finally:
+        # 复制失败时归还预留的空间，成功时已在 copy() 里结清
+        usage_ledger.release(reservation)
+        invalidate_ancestors(pdst)
+        if is_dir:
+            dir_cache.invalidate(pdst, recursive=True)
+    return "复制成功"
+
+@app.route("/api/delete", methods=["POST"])
+def delete():
+    rel = request.form.get("path")
+    if not rel:
+        abort(400, description="请指定path")
+    return jsonify({"msg": delete_path(safe_path(rel))})
+
 @app.route("/api/mkdir", methods=["POST"])
 def mkdir():
     rel = request.form.get("path", "")
@@ -85,12 +242,7 @@ def mkdir():
     parent = safe_path(rel)
     if not os.path.isdir(parent):
         abort(404, description="父目录不存在")
-    newp = os.path.join(parent, secure_filename(name))
-    try:
-        os.mkdir(newp)
-    except FileExistsError:
-        abort(400, description="目录已存在")
-    return jsonify({"msg": "目录创建成功"})
+    return jsonify({"msg": make_dir(os.path.join(parent, secure_filename(name)))})
 
 @app.route("/api/move", methods=["POST"])
 def move():
@@ -99,14 +251,58 @@ def move():
     dst = data.get("dst")
     if not src or not dst:
         abort(400, description="请指定src和dst")
-    psrc = safe_path(src)
-    pdst = safe_path(dst)
-    if not os.path.exists(psrc):
-        abort(404, description="源不存在")
-    if os.path.exists(pdst):
-        abort(400, description="目标已存在")
-    os.renames(psrc, pdst)
-    return jsonify({"msg": "移动成功"})
+    return jsonify({"msg": move_path(safe_path(src), safe_path(dst))})
+
+@app.route("/api/batch", methods=["POST"])
+def batch():
+    """
+    一次请求执行多个操作，按顺序执行，每项单独返回结果：
+    {"ops": [{"op": "move", "src": "a", "dst": "b"},
+             {"op": "copy", "src": "a", "dst": "c"},
+             {"op": "delete", "path": "d", "recursive": true},
+             {"op": "mkdir", "path": "e/f", "parents": true}],
+     "stop_on_error": false}
+    """
+    data = request.get_json(silent=True) or {}
+    ops = data.get("ops")
+    if not isinstance(ops, list) or not ops:
+        abort(400, description="请指定ops")
+    if len(ops) > MAX_BATCH_OPS:
+        abort(400, description=f"单次最多{MAX_BATCH_OPS}个操作")
+    stop_on_error = bool(data.get("stop_on_error"))
+    results = []
+    for item in ops:
+        if not isinstance(item, dict):
+            item = {}
+        op = item.get("op")
+        try:
+            if op in ("move", "copy"):
+                if not item.get("src") or not item.get("dst"):
+                    abort(400, description="请指定src和dst")
+                func = move_path if op == "move" else copy_path
+                msg = func(safe_path(item["src"]), safe_path(item["dst"]))
+            elif op in ("delete", "mkdir"):
+                if not item.get("path"):
+                    abort(400, description="请指定path")
+                target = safe_path(item["path"])
+                if op == "delete":
+                    msg = delete_path(target, recursive=bool(item.get("recursive")))
+                else:
+                    msg = make_dir(target, parents=bool(item.get("parents")))
+            else:
+                abort(400, description="不支持的操作")
+            results.append({"op": op, "ok": True, "msg": msg})
+        except HTTPException as e:
+            results.append({"op": op, "ok": False, "status": e.code, "error": e.description})
+            if stop_on_error:
+                break
+        except OSError as e:
+            # 删除、改名等没有单独处理的文件系统错误，记为这一项失败，继续执行后面的操作
+            results.append({"op": op, "ok": False, "status": 500, "error": e.strerror or str(e)})
+            if stop_on_error:
+                break
+    failed = sum(1 for r in results if not r["ok"])
+    return jsonify({"results": results, "succeeded": len(results) - failed, "failed": failed})
 
 if __name__ == "__main__":
     app.run(debug=True)
@@ -1,16 +1,26 @@
 import sqlite3
 from flask import Flask, g, request, session, redirect, url_for, flash, render_template_string
-from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
 from datetime import datetime
+from lcs import lcs_batch
+from sqlite_pool import SQLitePool
+from migrations import run_migrations
+from pagination import page_args, split_page
+from rate_limit import RateLimiter, open_counter, client_ip, form_username
+from password_service import PasswordService
 
 app = Flask(__name__)
+# 登录、注册、验证码和上传限流；多进程部署时把 'memory' 换成数据库文件路径
+limiter = RateLimiter(open_counter('memory'))
+# 密码哈希在进程池里计算，不占用请求线程；修改参数后旧哈希会在用户下次登录时自动更新
+passwords = PasswordService()
 app.config['SECRET_KEY'] = 'please_change_to_your_own_secret_key'     # 应用密钥
 app.config['DATABASE_PATH'] = 'microblog.db'                          # SQLite 数据库文件路径
+database_pool = SQLitePool(app.config['DATABASE_PATH'])               # 连接池，close() 时归还
 
 def get_database_connection():                                        # 获取数据库连接
     if 'database_connection' not in g:
-        connection = sqlite3.connect(app.config['DATABASE_PATH'])
+        connection = database_pool.acquire()
         connection.row_factory = sqlite3.Row                          # 使查询结果可通过列名访问
         g.database_connection = connection
     return g.database_connection
@@ -21,23 +31,35 @@ def close_database_connection(exception):                             # 关闭
     if connection:
         connection.close()
 
-def initialize_database():                                            # 初始化数据库表
-    connection = get_database_connection()
-    connection.executescript("""
-    CREATE TABLE IF NOT EXISTS user (
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      username TEXT UNIQUE NOT NULL,
-      password_hash TEXT NOT NULL
-    );
-    CREATE TABLE IF NOT EXISTS post (
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      user_id INTEGER NOT NULL,
-      content TEXT NOT NULL,
-      created_at TEXT NOT NULL,
-      FOREIGN KEY(user_id) REFERENCES user(id)
-    );
-    """)                                                           # 创建用户表和帖子表
-    connection.commit()
+# 数据库结构迁移，版本号记录在 PRAGMA user_version 中，新的变更只能追加在末尾
+MIGRATIONS = [
+    [                                                                 # 1: 用户表和帖子表
+        """CREATE TABLE IF NOT EXISTS user (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          username TEXT UNIQUE NOT NULL,
+          password_hash TEXT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS post (
+          id INTEGER PRIMARY KEY AUTOINCREMENT,
+          user_id INTEGER NOT NULL,
+          content TEXT NOT NULL,
+          created_at TEXT NOT NULL,
+          FOREIGN KEY(user_id) REFERENCES user(id)
+        )""",
+    ],
+    [                                                                 # 2: 时间线和个人主页的排序索引
+        "CREATE INDEX IF NOT EXISTS idx_post_user_created ON post(user_id, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_post_created ON post(created_at DESC)",
+    ],
+    [                                                                 # 3: 改为按 id 游标分页
+        "DROP INDEX IF EXISTS idx_post_user_created",
+        "DROP INDEX IF EXISTS idx_post_created",
+        "CREATE INDEX IF NOT EXISTS idx_post_user_id ON post(user_id, id DESC)",
+    ],
+]
+
+def initialize_database():                                            # 把数据库迁移到最新版本
+    run_migrations(get_database_connection(), MIGRATIONS)
 
 def login_required(view_function):                                   # 登录保护装饰器
     @wraps(view_function)
@@ -47,17 +69,6 @@ def login_required(view_function):                                   # 登录保
         return view_function(*args, **kwargs)
     return wrapped_view
 
-def longest_common_subsequence_length(a, b):                         # 计算 LCS 长度
-    length_a, length_b = len(a), len(b)
-    dp = [[0] * (length_b + 1) for _ in range(length_a + 1)]
-    for i in range(length_a - 1, -1, -1):
-        for j in range(length_b - 1, -1, -1):
-            if a[i] == b[j]:
-                dp[i][j] = 1 + dp[i + 1][j + 1]
-            else:
-                dp[i][j] = max(dp[i + 1][j], dp[i][j + 1])
-    return dp[0][0]
-
 TPL_BASE = """
 <!doctype html>
 <html lang="zh-CN">
@@ -135,6 +146,11 @@ TPL_INDEX = """
   {% else %}
   <p class="text-center text-muted">暂无说说。</p>
   {% endfor %}
+  {% if next_after %}
+  <div class="text-center mb-3">
+    <a class="btn btn-outline-primary" href="{{ url_for('index', after=next_after, limit=request.args.get('limit')) }}">更早的说说</a>
+  </div>
+  {% endif %}
 {% endblock %}
 """
 
@@ -204,6 +220,9 @@ TPL_PROFILE = """
 {% else %}
 <p class="text-muted">还没有说说。</p>
 {% endfor %}
+{% if next_after %}
+<a class="btn btn-outline-primary" href="{{ url_for('profile', user_id=user.id, after=next_after, limit=request.args.get('limit')) }}">更早的说说</a>
+{% endif %}
 {% endblock %}
 """
 
@@ -231,14 +250,20 @@ TPL_SEARCH = """
 @app.route('/')
 def index():                                                      # 首页路由
     connection = get_database_connection()
-    posts = connection.execute(
-        "SELECT p.id, p.content, p.created_at, u.username, u.id AS user_id "
-        "FROM post p JOIN user u ON p.user_id = u.id "
-        "ORDER BY p.created_at DESC"                               # 按时间倒序查询所有说说
-    ).fetchall()
-    return render_template_string(TPL_INDEX, posts=posts)
+    after, limit = page_args()                                    # ?after=<上一页最后一条 id>&limit=N
+    sql = ("SELECT p.id, p.content, p.created_at, u.username, u.id AS user_id "
+           "FROM post p JOIN user u ON p.user_id = u.id ")
+    params = []
+    if after is not None:
+        sql += "WHERE p.id < ? "
+        params.append(after)
+    sql += "ORDER BY p.id DESC LIMIT ?"                            # 按发布顺序倒序，每页只取 limit+1 条
+    params.append(limit + 1)
+    posts, next_after = split_page(connection.execute(sql, params).fetchall(), limit)
+    return render_template_string(TPL_INDEX, posts=posts, next_after=next_after)
 
 @app.route('/register', methods=['GET', 'POST'])
+@limiter.limit('10/hour', key=client_ip)
 def register():                                                   # 注册路由
     if request.method == 'POST':
         username = request.form['username'].strip()
@@ -256,7 +281,7 @@ def register():                                                   # 注册路由
         else:
             connection.execute(
                 "INSERT INTO user(username, password_hash) VALUES(?, ?)",  # 插入新用户
-                (username, generate_password_hash(password))
+                (username, passwords.hash(password))
             )
             connection.commit()
             flash('注册成功，请登录')
@@ -264,6 +289,8 @@ def register():                                                   # 注册路由
     return render_template_string(TPL_REGISTER)
 
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('20/minute', key=client_ip)
+@limiter.limit('5/minute', key=form_username)
 def login():                                                      # 登录路由
     if request.method == 'POST':
         username = request.form['username'].strip()
@@ -273,11 +300,19 @@ def login():                                                      # 登录路由
             "SELECT * FROM user WHERE username = ?", (username,)   # 查询用户名
         ).fetchone()
         error_message = None
-        if user_record is None or not check_password_hash(user_record['password_hash'], password):
+        new_hash = None
+        if user_record is None:
             error_message = '用户名或密码错误'
+        else:
+            ok, new_hash = passwords.verify_and_update(user_record['password_hash'], password)
+            if not ok:
+                error_message = '用户名或密码错误'
         if error_message:
             flash(error_message)
         else:
+            if new_hash:
+                connection.execute("UPDATE user SET password_hash = ? WHERE id = ?", (new_hash, user_record['id']))
+                connection.commit()
             session.clear()
             session['user_id'] = user_record['id']
             session['username'] = user_record['username']
@@ -322,11 +357,16 @@ def profile(user_id):                                             # 用户个人
     if user_record is None:
         flash('用户不存在')
         return redirect(url_for('index'))
-    posts = connection.execute(
-        "SELECT id, content, created_at FROM post WHERE user_id = ? ORDER BY created_at DESC",  # 查询该用户说说
-        (user_id,)
-    ).fetchall()
-    return render_template_string(TPL_PROFILE, user=user_record, posts=posts)
+    after, limit = page_args()
+    sql = "SELECT id, content, created_at FROM post WHERE user_id = ? "
+    params = [user_id]
+    if after is not None:
+        sql += "AND id < ? "
+        params.append(after)
+    sql += "ORDER BY id DESC LIMIT ?"                              # 走 (user_id, id) 索引，每页只取 limit+1 条
+    params.append(limit + 1)
+    posts, next_after = split_page(connection.execute(sql, params).fetchall(), limit)
+    return render_template_string(TPL_PROFILE, user=user_record, posts=posts, next_after=next_after)
 
 @app.route('/search', methods=['GET', 'POST'])
 def search():                                                     # 用户搜索路由
@@ -336,11 +376,8 @@ def search():                                                     # 用户搜索
         search_query = request.form['search_query'].strip()
         connection = get_database_connection()
         users = connection.execute("SELECT id, username FROM user").fetchall()  # 获取所有用户
-        scored_list = []
-        for user_item in users:
-            score = longest_common_subsequence_length(search_query.lower(), user_item['username'].lower())
-            if score > 0:
-                scored_list.append((score, user_item))
+        scores = lcs_batch(search_query, [user_item['username'] for user_item in users], ignore_case=True)
+        scored_list = [(score, user_item) for score, user_item in zip(scores, users) if score > 0]
         scored_list.sort(key=lambda x: x[0], reverse=True)         # 按 LCS 长度降序排序
         results = [item for _, item in scored_list]
     return render_template_string(TPL_SEARCH, results=results, search_query=search_query)
@@ -7,8 +7,16 @@ from flask import (
     flash, session, send_from_directory, g, abort
 )
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
+from lcs import top_k
+from video_stream import send_video
+from sqlite_pool import SQLitePool
+from migrations import run_migrations
+from pagination import page_args, split_page
+from rate_limit import RateLimiter, open_counter, client_ip, form_username
+from password_service import PasswordService
+from usage_ledger import UsageLedger, QuotaExceeded
+from blob_store import BlobStore
 
 # -------------- 配置 --------------
 DATABASE = 'app.db'
@@ -16,8 +24,13 @@ VIDEO_FOLDER = 'user_videos'
 ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv'}
 SECRET_KEY = 'your_secret_key_here_please_change_this_to_a_complex_one'
 MAX_CONTENT_LENGTH = 500 * 1024 * 1024  # 最大上传500MB，示范用
+USER_QUOTA = 2 * 1024 * 1024 * 1024  # 每个用户2GB
 
 app = Flask(__name__)
+# 登录、注册、验证码和上传限流；多进程部署时把 'memory' 换成数据库文件路径
+limiter = RateLimiter(open_counter('memory'))
+# 密码哈希在进程池里计算，不占用请求线程；修改参数后旧哈希会在用户下次登录时自动更新
+passwords = PasswordService()
 app.config.update(
     DATABASE=DATABASE,
     SECRET_KEY=SECRET_KEY,
@@ -25,6 +38,9 @@ app.config.update(
     MAX_CONTENT_LENGTH=MAX_CONTENT_LENGTH,
 )
 os.makedirs(VIDEO_FOLDER, exist_ok=True)
+db_pool = SQLitePool(DATABASE)  # 数据库连接池
+usage_ledger = UsageLedger(VIDEO_FOLDER, user_quota=USER_QUOTA)  # 用户目录磁盘用量，上传前按配额检查
+blobs = BlobStore('blobs')  # 相同内容的视频只存一份，用户目录里的文件是指向它的硬链接
 
 # -------------- 模板字符串 --------------
 # base.html 模板
@@ -122,7 +138,7 @@ home_template = '''
 
 {% if query %}
   {% if users %}
-    <h3>搜索结果 (共 {{ total }} 个匹配):</h3>
+    <h3>搜索结果:</h3>
     <ul class="list-group mb-3" role="list">
       {% for u in users %}
         <li class="list-group-item" role="listitem">
@@ -131,15 +147,19 @@ home_template = '''
       {% endfor %}
     </ul>
 
-    {% if total > per_page %}
+    {% if after or next_after %}
     <nav aria-label="分页导航">
       <ul class="pagination">
-        {% set page_count = (total // per_page) + (1 if total % per_page > 0 else 0) %}
-        {% for p in range(1, page_count + 1) %}
-          <li class="page-item {% if p == page %}active{% endif %}">
-            <a class="page-link" href="{{ url_for('home', search=query, page=p) }}">{{ p }}</a>
+        {% if after %}
+          <li class="page-item">
+            <a class="page-link" href="{{ url_for('home', search=query) }}">第一页</a>
           </li>
-        {% endfor %}
+        {% endif %}
+        {% if next_after %}
+          <li class="page-item">
+            <a class="page-link" href="{{ url_for('home', search=query, after=next_after) }}">下一页</a>
+          </li>
+        {% endif %}
       </ul>
     </nav>
     {% endif %}
@@ -238,6 +258,11 @@ dashboard_template = '''
   </div>
   {% endfor %}
 </div>
+{% if next_after %}
+<div class="text-center my-4">
+  <a class="btn btn-outline-primary" href="{{ url_for('dashboard', after=next_after, limit=request.args.get('limit')) }}">下一页</a>
+</div>
+{% endif %}
 {% else %}
 <p>您还没有上传任何视频。</p>
 {% endif %}
@@ -268,6 +293,11 @@ user_videos_template = '''
   </div>
   {% endfor %}
 </div>
+{% if next_after %}
+<div class="text-center my-4">
+  <a class="btn btn-outline-primary" href="{{ url_for('user_videos', username=username, after=next_after, limit=request.args.get('limit')) }}">下一页</a>
+</div>
+{% endif %}
 {% else %}
 <p>该用户暂无视频。</p>
 {% endif %}
@@ -277,39 +307,51 @@ user_videos_template = '''
 # -------------- 工具和DB相关 --------------
 
 def get_db():
-    """打开数据库连接"""
+    """从连接池取数据库连接"""
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(app.config['DATABASE'])
+        db = g._database = db_pool.acquire()
         db.row_factory = sqlite3.Row
     return db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    """关闭数据库连接"""
+    """把数据库连接归还连接池"""
     db = getattr(g, '_database', None)
     if db is not None:
         db.close()
 
+# 数据库结构迁移，版本号记录在 PRAGMA user_version 中，新的变更只能追加在末尾
+MIGRATIONS = [
+    # 1: 初始表结构
+    [
+        '''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS videos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )''',
+    ],
+    # 2: 按用户列出视频（按上传时间倒序）
+    [
+        'CREATE INDEX IF NOT EXISTS idx_videos_user_created ON videos(user_id, created_at DESC)',
+    ],
+    # 3: 视频列表改为按 id 游标分页
+    [
+        'DROP INDEX IF EXISTS idx_videos_user_created',
+        'CREATE INDEX IF NOT EXISTS idx_videos_user_id ON videos(user_id, id DESC)',
+    ],
+]
+
 def init_db():
-    """初始化数据库，创建表"""
-    db = get_db()
-    db.executescript('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL
-    );
-
-    CREATE TABLE IF NOT EXISTS videos (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        filename TEXT NOT NULL,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY(user_id) REFERENCES users(id)
-    );
-    ''')
-    db.commit()
+    """初始化数据库：把表结构迁移到最新版本"""
+    run_migrations(get_db(), MIGRATIONS)
 
 def valid_username(username: str) -> bool:
     """使用正则判断用户名合法，中英文数字下划线1-20字符"""
@@ -338,58 +380,69 @@ def current_user_dir():
     os.makedirs(user_dir, exist_ok=True)
     return user_dir
 
-def lcs_length(s1, s2):
-    """计算两个字符串最长公共子序列长度（搜索时用）"""
-    n, m = len(s1), len(s2)
-    dp = [[0]*(m+1) for _ in range(n+1)]
-    for i in range(n):
-        for j in range(m):
-            if s1[i] == s2[j]:
-                dp[i+1][j+1] = dp[i][j] + 1
-            else:
-                dp[i+1][j+1] = max(dp[i][j+1], dp[i+1][j])
-    return dp[n][m]
-
-def search_username_lcs(db, query, limit=5):
-    """根据LCS算法搜索用户名"""
+def search_username_lcs(db, query, limit=5, after=None):
+    """
+    根据LCS算法搜索用户名，返回 [(得分, 用户名), ...]。
+    排序为得分降序、同分按用户名升序；after 为上一页最后一项的 (得分, 用户名)，
+    排在它之前（含它）的结果会被跳过。
+    """
     query = query.strip()
     if not query:
         return []
-    cur = db.execute("SELECT username FROM users")
-    users = [row['username'] for row in cur.fetchall()]
-    scored = []
-    for user in users:
-        score = lcs_length(query, user)
-        scored.append((score, user))
-    scored.sort(key=lambda x: (-x[0], x[1]))
-    return [u for _, u in scored[:limit]]
+    skip = None
+    if after is not None:
+        after_score, after_name = after
+        skip = lambda score, row: score > after_score or (score == after_score and row['username'] <= after_name)
+    # 按用户名顺序流式读取，同分保持字母序；堆中最多保留 limit 个
+    cur = db.execute("SELECT username FROM users ORDER BY username")
+    ranked = top_k(query, cur, limit, key=lambda row: row['username'], min_score=0, skip=skip)
+    return [(score, row['username']) for score, row in ranked]
+
+
+def parse_score_cursor(value):
+    """解析搜索结果的游标 "得分:用户名"，无效时返回 None"""
+    score, sep, name = (value or '').partition(':')
+    if not sep or not score.isdigit() or not valid_username(name):
+        return None
+    return int(score), name
+
+def user_videos_page(db, user_id):
+    """按 ?after=<id>&limit=N 取某用户的一页视频（新的在前），返回 (视频列表, 下一页游标)"""
+    after, limit = page_args()
+    sql = 'SELECT id, filename, created_at FROM videos WHERE user_id = ?'
+    params = [user_id]
+    if after is not None:
+        sql += ' AND id < ?'
+        params.append(after)
+    sql += ' ORDER BY id DESC LIMIT ?'
+    params.append(limit + 1)
+    return split_page(db.execute(sql, params).fetchall(), limit)
 
 # -------------- 路由 --------------
 
 @app.route('/')
 def home():
     query = request.args.get('search', '').strip()
-    try:
-        page = int(request.args.get('page', 1))
-    except Exception:
-        page = 1
+    # 游标分页：?after=<上一页最后一项的 得分:用户名>，每页只在堆里保留 per_page+1 个
+    after = parse_score_cursor(request.args.get('after'))
     per_page = 5  # 每页显示数
     users = []
-    total = 0
+    next_after = None
     db = get_db()
 
     if query:
-        all_users = search_username_lcs(db, query, limit=100)
-        total = len(all_users)
-        start = (page - 1) * per_page
-        end = start + per_page
-        users = all_users[start:end]
+        ranked, last = split_page(search_username_lcs(db, query, limit=per_page + 1, after=after),
+                                  per_page, key=lambda item: item)
+        users = [name for _, name in ranked]
+        if last is not None:
+            next_after = f'{last[0]}:{last[1]}'
 
     return render_template_string(home_template, base=base_template, query=query,
-                                  users=users, page=page, per_page=per_page, total=total)
+                                  users=users, next_after=next_after, after=after)
 
 
 @app.route('/register', methods=['GET', 'POST'])
+@limiter.limit('10/hour', key=client_ip)
 def register():
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
@@ -405,7 +458,7 @@ def register():
         if db.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone():
             flash('用户名已存在', 'danger')
             return redirect(url_for('register'))
-        password_hash = generate_password_hash(password)
+        password_hash = passwords.hash(password)
         db.execute('INSERT INTO users (username, password) VALUES (?, ?)', (username, password_hash))
         db.commit()
         user_id = db.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()['id']
@@ -418,15 +471,21 @@ def register():
 
 
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('20/minute', key=client_ip)
+@limiter.limit('5/minute', key=form_username)
 def login():
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '')
         db = get_db()
         user = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-        if user is None or not check_password_hash(user['password'], password):
+        ok, new_hash = passwords.verify_and_update(user['password'], password) if user else (False, None)
+        if not ok:
             flash('用户名或密码错误', 'danger')
             return redirect(url_for('login'))
+        if new_hash:
+            db.execute('UPDATE users SET password = ? WHERE id = ?', (new_hash, user['id']))
+            db.commit()
         session['user_id'] = user['id']
         session['username'] = user['username']
         flash('登录成功！', 'success')
@@ -443,6 +502,7 @@ def logout():
 
 
 @app.route('/dashboard', methods=['GET', 'POST'])
+@limiter.limit('60/hour', key=client_ip)
 @login_required
 def dashboard():
     db = get_db()
@@ -464,6 +524,14 @@ def dashboard():
 
         filename = secure_filename(file.filename)
         user_dir = current_user_dir()
+        # 分块传输的请求没有 Content-Length，无法在写入前检查配额
+        if request.content_length is None:
+            abort(411)
+        try:
+            reservation = usage_ledger.reserve(user_dir, request.content_length)
+        except QuotaExceeded:
+            flash('存储空间不足，请先删除部分视频', 'danger')
+            return redirect(url_for('dashboard'))
         filepath = os.path.join(user_dir, filename)
         counter = 1
         base, ext = os.path.splitext(filename)
@@ -473,22 +541,24 @@ def dashboard():
             counter += 1
 
         try:
-            file.save(filepath)
+            blobs.save(file, filepath)
+            usage_ledger.add_file(filepath, reservation=reservation)
         except Exception as e:
             flash(f'保存文件失败: {e}', 'danger')
             return redirect(url_for('dashboard'))
+        finally:
+            # 写入失败时归还预留的空间，成功时已在 add_file() 里结清
+            usage_ledger.release(reservation)
 
         db.execute('INSERT INTO videos (user_id, filename) VALUES (?, ?)', (user_id, filename))
         db.commit()
         flash(f'视频“{filename}”上传成功', 'success')
         return redirect(url_for('dashboard'))
 
-    videos = db.execute(
-        'SELECT id, filename, created_at FROM videos WHERE user_id = ? ORDER BY created_at DESC', (user_id,)
-    ).fetchall()
+    videos, next_after = user_videos_page(db, user_id)
 
     return render_template_string(dashboard_template, base=base_template,
-                                  username=username, videos=videos)
+                                  username=username, videos=videos, next_after=next_after)
 
 
 @app.route('/dashboard/delete/<int:video_id>', methods=['POST'])
@@ -503,7 +573,9 @@ def delete_video(video_id):
     filepath = os.path.join(current_user_dir(), video['filename'])
     try:
         if os.path.exists(filepath):
-            os.remove(filepath)
+            size = os.path.getsize(filepath)
+            blobs.unlink(filepath)
+            usage_ledger.remove_file(filepath, size)
     except Exception as e:
         flash(f'删除文件失败: {e}', 'danger')
         return redirect(url_for('dashboard'))
@@ -523,11 +595,9 @@ def user_videos(username):
     if not user:
         flash('用户不存在', 'danger')
         return redirect(url_for('home'))
-    videos = db.execute(
-        'SELECT id, filename, created_at FROM videos WHERE user_id = ? ORDER BY created_at DESC', (user['id'],)
-    ).fetchall()
+    videos, next_after = user_videos_page(db, user['id'])
     return render_template_string(user_videos_template, base=base_template,
-                                  username=username, videos=videos)
+                                  username=username, videos=videos, next_after=next_after)
 
 
 @app.route('/videos/<username>/<filename>')
@@ -535,7 +605,7 @@ def serve_video(username, filename):
     if not valid_username(username) or not allowed_file(filename):
         abort(404)
     path = os.path.join(app.config['UPLOAD_FOLDER'], username)
-    return send_from_directory(path, filename)
+    return send_video(path, filename)
 
 
 @app.route('/download/<username>/<filename>')
@@ -555,8 +625,7 @@ def initdb_command():
 
 # -------------- 主程序 --------------
 if __name__ == '__main__':
-    if not os.path.exists(DATABASE):
-        print('数据库文件不存在，自动初始化数据库...')
-        with app.app_context():
-            init_db()
+    # 每次启动都执行迁移，已是最新版本时什么也不做
+    with app.app_context():
+        init_db()
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -10,44 +10,69 @@ from flask import (
     Flask, request, redirect, url_for, render_template_string,
     flash, send_from_directory, abort, session, jsonify
 )
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from lcs import lcs_batch
+from video_stream import send_video
+from sqlite_pool import SQLitePool
+from migrations import run_migrations, add_column
+from storage_names import display_name
+from thumbnails import ThumbnailService, send_thumbnail, thumbnail_name
+from blob_store import BlobStore
+from rate_limit import RateLimiter, open_counter, client_ip, form_username
+from password_service import PasswordService
 
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mkv', 'mov'}
 
 app = Flask(__name__)
+# 登录、注册、验证码和上传限流；多进程部署时把 'memory' 换成数据库文件路径
+limiter = RateLimiter(open_counter('memory'))
+# 密码哈希在进程池里计算，不占用请求线程；修改参数后旧哈希会在用户下次登录时自动更新
+passwords = PasswordService()
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.secret_key = 'your_secret_key_here_change_it'
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# 数据库连接池，代替每个路由里单独的 sqlite3.connect
+db_pool = SQLitePool('database.db')
+# 上传后在后台生成封面，管理页只加载封面图片
+thumbnails = ThumbnailService()
+# 相同内容的视频只存一份，上传目录里的文件是指向它的硬链接
+blobs = BlobStore('blobs')
+
+# 数据库结构迁移，版本号记录在 PRAGMA user_version 中，新的变更只能追加在末尾
+MIGRATIONS = [
+    # 1: 初始表结构
+    [
+        '''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS videos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            filename TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            content TEXT NOT NULL
+        )''',
+    ],
+    # 2: 按用户名查视频、笔记的索引
+    [
+        'CREATE INDEX IF NOT EXISTS idx_videos_username ON videos(username)',
+        'CREATE INDEX IF NOT EXISTS idx_notes_username ON notes(username)',
+    ],
+    # 3: 上传时的文件名单独保存用于显示，磁盘上用不会冲突的存储名；旧记录为空，显示存储名
+    add_column('videos', 'display_name', 'TEXT'),
+]
+
 def init_db():
-    with sqlite3.connect('database.db') as conn:
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL
-            )
-        ''')
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS videos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                filename TEXT NOT NULL
-            )
-        ''')
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS notes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                content TEXT NOT NULL
-            )
-        ''')
-        conn.commit()
+    with db_pool.connection() as conn:
+        run_migrations(conn, MIGRATIONS)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -103,6 +128,7 @@ TOP_NAVBAR = '''
 '''
 
 @app.route('/', methods=['GET', 'POST'])
+@limiter.limit('60/hour', key=client_ip)
 @login_required
 def upload():
     username = session['username']
@@ -114,25 +140,20 @@ def upload():
             return redirect(request.url)
         if file and file.filename != '':
             if allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                i = 1
-                base, ext = os.path.splitext(filename)
-                while os.path.exists(save_path):
-                    filename = f"{base}_{i}{ext}"
-                    save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    i += 1
-                file.save(save_path)
-                with sqlite3.connect('database.db') as conn:
+                # O_EXCL 创建 uuid 存储名，不用逐个探测同名文件
+                filename = blobs.save_new(file, app.config['UPLOAD_FOLDER'], file.filename)
+                with db_pool.connection() as conn:
                     c = conn.cursor()
-                    c.execute('INSERT INTO videos (username, filename) VALUES (?, ?)', (username, filename))
+                    c.execute('INSERT INTO videos (username, filename, display_name) VALUES (?, ?, ?)',
+                              (username, filename, display_name(file.filename)))
                     conn.commit()
+                thumbnails.submit(app.config['UPLOAD_FOLDER'], filename)
                 flash('视频上传成功', 'success')
             else:
                 flash('视频格式不支持，仅支持 mp4, avi, mkv, mov', 'danger')
                 return redirect(request.url)
         if text_content:
-            with sqlite3.connect('database.db') as conn:
+            with db_pool.connection() as conn:
                 c = conn.cursor()
                 c.execute('INSERT INTO notes (username, content) VALUES (?, ?)', (username, text_content))
                 conn.commit()
@@ -141,6 +162,7 @@ def upload():
     return render_template_string(UPLOAD_HTML, username=username)
 
 @app.route('/register', methods=['GET', 'POST'])
+@limiter.limit('10/hour', key=client_ip)
 def register():
     if 'username' in session:
         flash('您已登录', 'info')
@@ -161,9 +183,9 @@ def register():
         if password != password2:
             flash('两次密码输入不一致', 'danger')
             return redirect(request.url)
-        password_hash = generate_password_hash(password)
+        password_hash = passwords.hash(password)
         try:
-            with sqlite3.connect('database.db') as conn:
+            with db_pool.connection() as conn:
                 c = conn.cursor()
                 c.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', (username, password_hash))
                 conn.commit()
@@ -179,6 +201,8 @@ def register():
     return render_template_string(REGISTER_HTML, captcha_display=captcha_display)
 
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('20/minute', key=client_ip)
+@limiter.limit('5/minute', key=form_username)
 def login():
     if 'username' in session:
         flash('您已登录', 'info')
@@ -192,11 +216,17 @@ def login():
             flash('验证码错误', 'danger')
             session['captcha_code'] = generate_captcha()
             return redirect(url_for('login'))
-        with sqlite3.connect('database.db') as conn:
+        with db_pool.connection() as conn:
             c = conn.cursor()
             c.execute('SELECT password_hash FROM users WHERE username = ?', (username,))
             row = c.fetchone()
-        if row and check_password_hash(row[0], password):
+        ok, new_hash = passwords.verify_and_update(row[0], password) if row else (False, None)
+        if ok:
+            if new_hash:
+                with db_pool.connection() as conn:
+                    conn.execute('UPDATE users SET password_hash = ? WHERE username = ?', (new_hash, username))
+            # cookie 会话没有服务端 id，登录时丢弃登录前的全部内容
+            session.clear()
             session['username'] = username
             flash('登录成功', 'success')
             next_url = request.args.get('next')
@@ -220,18 +250,18 @@ def logout():
 
 @app.route('/videos/<int:video_id>')
 def video_detail(video_id):
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
-        c.execute('SELECT username, filename FROM videos WHERE id = ?', (video_id,))
+        c.execute('SELECT username, filename, COALESCE(display_name, filename) FROM videos WHERE id = ?', (video_id,))
         row = c.fetchone()
     if not row:
         abort(404)
-    username, filename = row
-    return render_template_string(VIDEO_DETAIL_HTML, username=username, filename=filename)
+    username, filename, name = row
+    return render_template_string(VIDEO_DETAIL_HTML, username=username, filename=filename, display_name=name)
 
 @app.route('/notes/<int:note_id>')
 def note_detail(note_id):
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
         c.execute('SELECT username, content FROM notes WHERE id = ?', (note_id,))
         row = c.fetchone()
@@ -250,7 +280,7 @@ def note_new():
         if not content:
             flash('文本内容不能为空', 'danger')
             return redirect(request.url)
-        with sqlite3.connect('database.db') as conn:
+        with db_pool.connection() as conn:
             c = conn.cursor()
             c.execute('INSERT INTO notes (username, content) VALUES (?, ?)', (username, content))
             conn.commit()
@@ -262,7 +292,7 @@ def note_new():
 @login_required
 def note_edit(note_id):
     username = session['username']
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
         c.execute('SELECT username, content FROM notes WHERE id = ?', (note_id,))
         row = c.fetchone()
@@ -277,7 +307,7 @@ def note_edit(note_id):
         if not content:
             flash('文本内容不能为空', 'danger')
             return redirect(request.url)
-        with sqlite3.connect('database.db') as conn:
+        with db_pool.connection() as conn:
             c = conn.cursor()
             c.execute('UPDATE notes SET content = ? WHERE id = ?', (content, note_id))
             conn.commit()
@@ -289,7 +319,7 @@ def note_edit(note_id):
 @login_required
 def note_delete(note_id):
     username = session['username']
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
         c.execute('SELECT username, content FROM notes WHERE id = ?', (note_id,))
         row = c.fetchone()
@@ -300,7 +330,7 @@ def note_delete(note_id):
         flash('无权删除他人笔记', 'danger')
         return redirect(url_for('search', username=note_owner))
     if request.method == 'POST':
-        with sqlite3.connect('database.db') as conn:
+        with db_pool.connection() as conn:
             c = conn.cursor()
             c.execute('DELETE FROM notes WHERE id = ?', (note_id,))
             conn.commit()
@@ -312,9 +342,9 @@ def note_delete(note_id):
 @login_required
 def videos_manage():
     username = session['username']
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
-        c.execute('SELECT id, filename FROM videos WHERE username = ?', (username,))
+        c.execute('SELECT id, filename, COALESCE(display_name, filename) FROM videos WHERE username = ?', (username,))
         videos = c.fetchall()
     return render_template_string(VIDEOS_MANAGE_HTML, username=username, videos=videos)
 
@@ -322,7 +352,7 @@ def videos_manage():
 @login_required
 def video_delete(video_id):
     username = session['username']
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
         c.execute('SELECT username, filename FROM videos WHERE id = ?', (video_id,))
         row = c.fetchone()
@@ -333,10 +363,11 @@ def video_delete(video_id):
         flash('无权删除他人视频', 'danger')
         return redirect(url_for('videos_manage'))
     try:
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        blobs.unlink(os.path.join(app.config['UPLOAD_FOLDER'], filename))
     except Exception:
         pass
-    with sqlite3.connect('database.db') as conn:
+    thumbnails.remove(app.config['UPLOAD_FOLDER'], filename)
+    with db_pool.connection() as conn:
         c = conn.cursor()
         c.execute('DELETE FROM videos WHERE id = ?', (video_id,))
         conn.commit()
@@ -345,7 +376,22 @@ def video_delete(video_id):
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_video(app.config['UPLOAD_FOLDER'], filename)
+
+# 封面缩略图，URL 带版本号，长期缓存
+@app.route('/thumbs/<name>')
+def thumbnail_file(name):
+    return send_thumbnail(app.config['UPLOAD_FOLDER'], name)
+
+@app.context_processor
+def inject_poster_url():
+    # 缩略图已生成时返回带版本号的 URL，否则返回 None
+    def poster_url(filename, kind='poster'):
+        version = thumbnails.version(app.config['UPLOAD_FOLDER'], filename, kind)
+        if version is None:
+            return None
+        return url_for('thumbnail_file', name=thumbnail_name(filename, kind), v=version)
+    return dict(poster_url=poster_url)
 
 @app.route('/search')
 def search():
@@ -353,25 +399,14 @@ def search():
     videos = []
     notes = []
     if username:
-        with sqlite3.connect('database.db') as conn:
+        with db_pool.connection() as conn:
             c = conn.cursor()
-            c.execute('SELECT id, filename FROM videos WHERE username = ?', (username,))
+            c.execute('SELECT id, COALESCE(display_name, filename) FROM videos WHERE username = ?', (username,))
             videos = c.fetchall()
             c.execute('SELECT id, content FROM notes WHERE username = ?', (username,))
             notes = c.fetchall()
     return render_template_string(SEARCH_HTML, username=username, videos=videos, notes=notes)
 
-def lcs_length(a, b):
-    m, n = len(a), len(b)
-    dp = [[0]*(n+1) for _ in range(m+1)]
-    for i in range(m):
-        for j in range(n):
-            if a[i] == b[j]:
-                dp[i+1][j+1] = dp[i][j] + 1
-            else:
-                dp[i+1][j+1] = max(dp[i][j+1], dp[i+1][j])
-    return dp[m][n]
-
 @app.route('/usersearch', methods=['GET', 'POST'])
 def user_search():
     query = ''
@@ -380,12 +415,11 @@ def user_search():
     if request.method == 'POST':
         query = request.form.get('query', '').strip()
         if query:
-            with sqlite3.connect('database.db') as conn:
+            with db_pool.connection() as conn:
                 c = conn.cursor()
                 c.execute('SELECT DISTINCT username FROM users')
                 all_users = [row[0] for row in c.fetchall()]
-            for user in all_users:
-                score = lcs_length(query, user)
+            for user, score in zip(all_users, lcs_batch(query, all_users)):
                 if score > best_score:
                     best_score = score
                     results = [user]
@@ -398,7 +432,7 @@ def ajax_user_search():
     query = request.args.get('q', '').strip()
     results = []
     if query:
-        with sqlite3.connect('database.db') as conn:
+        with db_pool.connection() as conn:
             c = conn.cursor()
             c.execute("SELECT username FROM users WHERE username LIKE ? LIMIT 10", (f"%{query}%",))
             res = c.fetchall()
@@ -659,7 +693,7 @@ VIDEO_DETAIL_HTML = '''
 <html lang="zh-CN">
 <head>
 <meta charset="utf-8" />
-<title>视频详情 - {{ filename }}</title>
+<title>视频详情 - {{ display_name }}</title>
 <meta name="viewport" content="width=device-width, initial-scale=1" />
 <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet" />
 <!-- Video.js CSS -->
@@ -836,14 +870,16 @@ VIDEOS_MANAGE_HTML = '''
   <table class="table table-striped">
     <thead>
       <tr>
+        <th>封面</th>
         <th>文件名</th>
         <th>操作</th>
       </tr>
     </thead>
     <tbody>
-      {% for vid, fname in videos %}
+      {% for vid, fname, dname in videos %}
       <tr>
-        <td><a href="{{ url_for('video_detail', video_id=vid) }}">{{ fname }}</a></td>
+        <td>{% set poster = poster_url(fname) %}{% if poster %}<img src="{{ poster }}" alt="{{ dname }}" loading="lazy" width="160" height="90" style="object-fit:cover; background:#000;" />{% endif %}</td>
+        <td><a href="{{ url_for('video_detail', video_id=vid) }}">{{ dname }}</a></td>
         <td>
           <form method="post" action="{{ url_for('video_delete', video_id=vid) }}"
                 onsubmit="return confirm('确认删除此视频吗？');" style="display:inline;">
@@ -983,44 +1019,71 @@ from flask import (
     Flask, request, redirect, url_for, render_template_string,
     flash, send_from_directory, abort, session, jsonify
 )
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from lcs import lcs_batch
+from video_stream import send_video
+from sqlite_pool import SQLitePool
+from migrations import run_migrations, add_column
+from storage_names import new_storage_file, display_name
+from chunked_upload import ChunkedUploadStore, register_chunked_upload
+from thumbnails import ThumbnailService, send_thumbnail, thumbnail_name
+from blob_store import BlobStore
+from rate_limit import RateLimiter, open_counter, client_ip, form_username
+from password_service import PasswordService
 
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mkv', 'mov'}
+MAX_UPLOAD_SIZE = 2 * 1024 * 1024 * 1024  # 分片上传单个文件最大2GB
 
 app = Flask(__name__)
+# 登录、注册、验证码和上传限流；多进程部署时把 'memory' 换成数据库文件路径
+limiter = RateLimiter(open_counter('memory'))
+# 密码哈希在进程池里计算，不占用请求线程；修改参数后旧哈希会在用户下次登录时自动更新
+passwords = PasswordService()
 app.secret_key = 'your_secret_key_change_this'  # 改为自己的安全密钥
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
+# 数据库连接池，代替每个路由里单独的 sqlite3.connect
+db_pool = SQLitePool('database.db')
+# 上传后在后台生成封面，管理页只加载封面图片
+thumbnails = ThumbnailService()
+# 相同内容的视频只存一份，上传目录里的文件是指向它的硬链接
+blobs = BlobStore('blobs')
+
+# 数据库结构迁移，版本号记录在 PRAGMA user_version 中，新的变更只能追加在末尾
+MIGRATIONS = [
+    # 1: 初始表结构
+    [
+        '''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS videos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            filename TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS notes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            content TEXT NOT NULL
+        )''',
+    ],
+    # 2: 按用户名查视频、笔记的索引
+    [
+        'CREATE INDEX IF NOT EXISTS idx_videos_username ON videos(username)',
+        'CREATE INDEX IF NOT EXISTS idx_notes_username ON notes(username)',
+    ],
+    # 3: 上传时的文件名单独保存用于显示，磁盘上用不会冲突的存储名；旧记录为空，显示存储名
+    add_column('videos', 'display_name', 'TEXT'),
+]
+
 def init_db():
-    with sqlite3.connect('database.db') as conn:
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL
-            )
-        ''')
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS videos (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                filename TEXT NOT NULL
-            )
-        ''')
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS notes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT NOT NULL,
-                content TEXT NOT NULL
-            )
-        ''')
-        conn.commit()
+    with db_pool.connection() as conn:
+        run_migrations(conn, MIGRATIONS)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -1048,17 +1111,6 @@ def captcha_html(captcha_str):
         )
     return ''.join(spans)
 
-def lcs_length(a, b):
-    m, n = len(a), len(b)
-    dp = [[0]*(n+1) for _ in range(m+1)]
-    for i in range(m):
-        for j in range(n):
-            if a[i] == b[j]:
-                dp[i+1][j+1] = dp[i][j] + 1
-            else:
-                dp[i+1][j+1] = max(dp[i][j+1], dp[i+1][j])
-    return dp[m][n]
-
 TOP_NAVBAR = '''
 <nav class="navbar navbar-expand-lg navbar-dark bg-dark mb-4">
   <div class="container-fluid">
@@ -1095,6 +1147,7 @@ def upload():
     return render_template_string(UPLOAD_HTML, username=username, top_navbar=TOP_NAVBAR)
 
 @app.route('/register', methods=['GET', 'POST'])
+@limiter.limit('10/hour', key=client_ip)
 def register():
     if 'username' in session:
         flash('您已登录', 'info')
@@ -1115,9 +1168,9 @@ def register():
         if password != password2:
             flash('两次密码输入不一致', 'danger')
             return redirect(request.url)
-        password_hash = generate_password_hash(password)
+        password_hash = passwords.hash(password)
         try:
-            with sqlite3.connect('database.db') as conn:
+            with db_pool.connection() as conn:
                 c = conn.cursor()
                 c.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', (username, password_hash))
                 conn.commit()
@@ -1133,6 +1186,8 @@ def register():
     return render_template_string(REGISTER_HTML, captcha_display=captcha_display)
 
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('20/minute', key=client_ip)
+@limiter.limit('5/minute', key=form_username)
 def login():
     if 'username' in session:
         flash('您已登录', 'info')
@@ -1146,11 +1201,17 @@ def login():
             flash('验证码错误', 'danger')
             session['captcha_code'] = generate_captcha()
             return redirect(url_for('login'))
-        with sqlite3.connect('database.db') as conn:
+        with db_pool.connection() as conn:
             c = conn.cursor()
             c.execute('SELECT password_hash FROM users WHERE username = ?', (username,))
             row = c.fetchone()
-        if row and check_password_hash(row[0], password):
+        ok, new_hash = passwords.verify_and_update(row[0], password) if row else (False, None)
+        if ok:
+            if new_hash:
+                with db_pool.connection() as conn:
+                    conn.execute('UPDATE users SET password_hash = ? WHERE username = ?', (new_hash, username))
+            # cookie 会话没有服务端 id，登录时丢弃登录前的全部内容
+            session.clear()
             session['username'] = username
             flash('登录成功', 'success')
             next_url = request.args.get('next')
@@ -1173,6 +1234,7 @@ def logout():
     return redirect(url_for('login'))
 
 @app.route('/ajax_upload_video', methods=['POST'])
+@limiter.limit('60/hour', key=client_ip)
 @login_required
 def ajax_upload_video():
     file = request.files.get('file')
@@ -1181,28 +1243,55 @@ def ajax_upload_video():
         return jsonify(success=False, message='未收到文件')
     if not allowed_file(file.filename):
         return jsonify(success=False, message='不支持的文件格式')
-    filename = secure_filename(file.filename)
-    save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    i = 1
-    base, ext = os.path.splitext(filename)
-    while os.path.exists(save_path):
-        filename = f"{base}_{i}{ext}"
-        save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        i += 1
-    file.save(save_path)
-    with sqlite3.connect('database.db') as conn:
+    # O_EXCL 创建 uuid 存储名，不用逐个探测同名文件
+    filename = blobs.save_new(file, app.config['UPLOAD_FOLDER'], file.filename)
+    name = display_name(file.filename)
+    with db_pool.connection() as conn:
         c = conn.cursor()
-        c.execute('INSERT INTO videos (username, filename) VALUES (?, ?)', (username, filename))
+        c.execute('INSERT INTO videos (username, filename, display_name) VALUES (?, ?, ?)',
+                  (username, filename, name))
         conn.commit()
-    return jsonify(success=True, filename=filename)
+    thumbnails.submit(app.config['UPLOAD_FOLDER'], filename)
+    return jsonify(success=True, filename=filename, display_name=name)
+
+# 大文件分片上传（协议见 chunked_upload.py），分片到齐后再入库
+chunked_store = ChunkedUploadStore(UPLOAD_FOLDER, max_size=MAX_UPLOAD_SIZE, allowed_file=allowed_file)
+
+def finalize_chunked_upload(meta, part_path):
+    username = session['username']
+    filename = new_storage_file(app.config['UPLOAD_FOLDER'], meta['filename'])
+    save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    name = display_name(meta['filename'])
+    # 插入记录与存入文件放在同一个事务里，任一步失败都回滚；
+    # 提交成功后才删除 .part，失败时客户端可以重试
+    try:
+        with db_pool.connection() as conn:
+            c = conn.cursor()
+            c.execute('INSERT INTO videos (username, filename, display_name) VALUES (?, ?, ?)',
+                      (username, filename, name))
+            blobs.save_file(part_path, save_path, remove_source=False)
+    except Exception:
+        # 占位文件或已存入的硬链接
+        blobs.unlink(save_path, missing_ok=True)
+        raise
+    os.remove(part_path)
+    thumbnails.submit(app.config['UPLOAD_FOLDER'], filename)
+    return jsonify(success=True, filename=filename, display_name=name)
+
+register_chunked_upload(
+    app, chunked_store,
+    get_owner=lambda: session.get('username'),
+    finalize=finalize_chunked_upload,
+    decorator=login_required,
+)
 
 @app.route('/videos/manage')
 @login_required
 def videos_manage():
     username = session['username']
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
-        c.execute('SELECT id, filename FROM videos WHERE username = ?', (username,))
+        c.execute('SELECT id, filename, COALESCE(display_name, filename) FROM videos WHERE username = ?', (username,))
         videos = c.fetchall()
     return render_template_string(VIDEOS_MANAGE_UPLOAD_HTML, username=username, videos=videos, top_navbar=TOP_NAVBAR)
 
@@ -1210,7 +1299,7 @@ def videos_manage():
 @login_required
 def video_delete(video_id):
     username = session['username']
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
         c.execute('SELECT username, filename FROM videos WHERE id = ?', (video_id,))
         row = c.fetchone()
@@ -1218,9 +1307,10 @@ def video_delete(video_id):
         flash('无权删除此视频', 'danger')
         return redirect(url_for('videos_manage'))
     try:
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], row[1]))
+        blobs.unlink(os.path.join(app.config['UPLOAD_FOLDER'], row[1]))
     except: pass
-    with sqlite3.connect('database.db') as conn:
+    thumbnails.remove(app.config['UPLOAD_FOLDER'], row[1])
+    with db_pool.connection() as conn:
         c = conn.cursor()
         c.execute('DELETE FROM videos WHERE id = ?', (video_id,))
         conn.commit()
@@ -1231,7 +1321,7 @@ def video_delete(video_id):
 @login_required
 def notes_manage():
     username = session['username']
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
         c.execute('SELECT id, content FROM notes WHERE username = ?', (username,))
         notes = c.fetchall()
@@ -1244,7 +1334,7 @@ def note_api_create():
     username = session['username']
     if not content:
         return jsonify(success=False, message='内容不能为空')
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
         c.execute('INSERT INTO notes (username, content) VALUES (?, ?)', (username, content))
         conn.commit()
@@ -1254,7 +1344,7 @@ def note_api_create():
 @login_required
 def note_edit(note_id):
     username = session['username']
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
         c.execute('SELECT username, content FROM notes WHERE id = ?', (note_id,))
         row = c.fetchone()
@@ -1266,7 +1356,7 @@ def note_edit(note_id):
         if not content:
             flash('笔记内容不能为空', 'danger')
             return redirect(request.url)
-        with sqlite3.connect('database.db') as conn:
+        with db_pool.connection() as conn:
             c = conn.cursor()
             c.execute('UPDATE notes SET content = ? WHERE id = ?', (content, note_id))
             conn.commit()
@@ -1278,7 +1368,7 @@ def note_edit(note_id):
 @login_required
 def note_delete(note_id):
     username = session['username']
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
         c.execute('SELECT username, content FROM notes WHERE id = ?', (note_id,))
         row = c.fetchone()
@@ -1286,7 +1376,7 @@ def note_delete(note_id):
         flash('无权删除此笔记', 'danger')
         return redirect(url_for('notes_manage'))
     if request.method == 'POST':
-        with sqlite3.connect('database.db') as conn:
+        with db_pool.connection() as conn:
             c = conn.cursor()
             c.execute('DELETE FROM notes WHERE id = ?', (note_id,))
             conn.commit()
@@ -1296,7 +1386,7 @@ def note_delete(note_id):
 
 @app.route('/notes/<int:note_id>')
 def note_detail(note_id):
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
         c.execute('SELECT username, content FROM notes WHERE id = ?', (note_id,))
         row = c.fetchone()
@@ -1307,13 +1397,14 @@ def note_detail(note_id):
 
 @app.route('/videos/<int:video_id>')
 def video_detail(video_id):
-    with sqlite3.connect('database.db') as conn:
+    with db_pool.connection() as conn:
         c = conn.cursor()
-        c.execute('SELECT username, filename FROM videos WHERE id = ?', (video_id,))
+        c.execute('SELECT username, filename, COALESCE(display_name, filename) FROM videos WHERE id = ?', (video_id,))
         row = c.fetchone()
     if not row:
         abort(404)
-    return render_template_string(VIDEO_DETAIL_HTML, username=row[0], filename=row[1], top_navbar=TOP_NAVBAR)
+    return render_template_string(VIDEO_DETAIL_HTML, username=row[0], filename=row[1], display_name=row[2],
+                                  top_navbar=TOP_NAVBAR)
 
 @app.route('/search')
 def search():
@@ -1321,9 +1412,9 @@ def search():
     videos = []
     notes = []
     if username:
-        with sqlite3.connect('database.db') as conn:
+        with db_pool.connection() as conn:
             c = conn.cursor()
-            c.execute('SELECT id, filename FROM videos WHERE username = ?', (username,))
+            c.execute('SELECT id, COALESCE(display_name, filename) FROM videos WHERE username = ?', (username,))
             videos = c.fetchall()
             c.execute('SELECT id, content FROM notes WHERE username = ?', (username,))
             notes = c.fetchall()
@@ -1337,12 +1428,11 @@ def user_search():
     if request.method == 'POST':
         query = request.form.get('query', '').strip()
         if query:
-            with sqlite3.connect('database.db') as conn:
+            with db_pool.connection() as conn:
                 c = conn.cursor()
                 c.execute('SELECT DISTINCT username FROM users')
                 users = [row[0] for row in c.fetchall()]
-            for user in users:
-                score = lcs_length(query, user)
+            for user, score in zip(users, lcs_batch(query, users)):
                 if score > best_score:
                     best_score = score
                     results = [user]
@@ -1350,9 +1440,24 @@ def user_search():
                     results.append(user)
     return render_template_string(USER_SEARCH_SIMPLE_HTML, query=query, results=results, top_navbar=TOP_NAVBAR)
 
+# 封面缩略图，URL 带版本号，长期缓存
+@app.route('/thumbs/<name>')
+def thumbnail_file(name):
+    return send_thumbnail(app.config['UPLOAD_FOLDER'], name)
+
+@app.context_processor
+def inject_poster_url():
+    # 缩略图已生成时返回带版本号的 URL，否则返回 None
+    def poster_url(filename, kind='poster'):
+        version = thumbnails.version(app.config['UPLOAD_FOLDER'], filename, kind)
+        if version is None:
+            return None
+        return url_for('thumbnail_file', name=thumbnail_name(filename, kind), v=version)
+    return dict(poster_url=poster_url)
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_video(app.config['UPLOAD_FOLDER'], filename)
 
 # === 以下为各页HTML模板（字数限制此处仅截取部分，复制完整版本时请把所有模板代码一起保存） ===
 
@@ -1471,12 +1576,13 @@ VIDEOS_MANAGE_UPLOAD_HTML = '''<!doctype html>
   {% if videos %}
   <table class="table table-striped">
     <thead>
-      <tr><th>文件名</th><th>操作</th></tr>
+      <tr><th>封面</th><th>文件名</th><th>操作</th></tr>
     </thead>
     <tbody>
-      {% for vid, fname in videos %}
+      {% for vid, fname, dname in videos %}
       <tr>
-        <td><a href="{{ url_for('video_detail', video_id=vid) }}">{{ fname }}</a></td>
+        <td>{% set poster = poster_url(fname) %}{% if poster %}<img src="{{ poster }}" alt="{{ dname }}" loading="lazy" width="160" height="90" style="object-fit:cover; background:#000;" />{% endif %}</td>
+        <td><a href="{{ url_for('video_detail', video_id=vid) }}">{{ dname }}</a></td>
         <td>
           <form method="post" action="{{ url_for('video_delete', video_id=vid) }}" onsubmit="return confirm('确认删除此视频吗？');" style="display:inline;">
             <button type="submit" class="btn btn-danger btn-sm">删除</button>
@@ -1569,7 +1675,7 @@ function uploadFile(file){
     contentType: false,
     success: function(resp){
       if(resp.success){
-        uploadStatus.html('<span class="text-success">上传成功: ' + resp.filename + '</span>');
+        uploadStatus.html('<span class="text-success">上传成功: ' + (resp.display_name || resp.filename) + '</span>');
         setTimeout(() => { location.reload(); }, 1500);
       } else {
         uploadStatus.html('<span class="text-danger">上传失败: ' + resp.message + '</span>');
@@ -1759,7 +1865,7 @@ th, td {
 
 VIDEO_DETAIL_HTML = '''<!doctype html>
 <html lang="zh-CN">
-<head><meta charset="utf-8" /><title>视频详情 - {{ filename }}</title>
+<head><meta charset="utf-8" /><title>视频详情 - {{ display_name }}</title>
 <meta name="viewport" content="width=device-width, initial-scale=1" />
 <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet" />
 <link href="https://vjs.zencdn.net/8.26.1/video-js.css" rel="stylesheet" />
@@ -1859,7 +1965,6 @@ if __name__ == '__main__':
 import os
 import random
 import sqlite3
-from io import BytesIO
 from functools import wraps
 
 from flask import (
@@ -1867,11 +1972,25 @@ from flask import (
     url_for, flash, session, make_response,
     jsonify, send_from_directory, abort
 )
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from PIL import Image, ImageDraw, ImageFilter
+from video_stream import send_video
+from sqlite_pool import SQLitePool
+from migrations import run_migrations, add_column
+from storage_names import display_name
+from thumbnails import ThumbnailService, send_thumbnail, thumbnail_name
+from jobs import on_first_request
+from blob_store import BlobStore
+from captcha_pool import CaptchaPool, to_png
+from fonts import FontRegistry
+from session_store import open_backend, ServerSideSessionInterface, ChallengeStore, regenerate_session
+from rate_limit import RateLimiter, open_counter, client_ip, form_username
+from password_service import PasswordService
 
 app = Flask(__name__)
+# 登录、注册、验证码和上传限流；多进程部署时把 'memory' 换成数据库文件路径
+limiter = RateLimiter(open_counter('memory'))
+# 密码哈希在进程池里计算，不占用请求线程；修改参数后旧哈希会在用户下次登录时自动更新
+passwords = PasswordService()
 app.secret_key = 'your_secret_key_change_me'  # 修改成安全值
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DATABASE = os.path.join(BASE_DIR, 'database.db')
@@ -1884,41 +2003,59 @@ app.config.update(
     ALLOWED_VIDEO_EXTENSIONS=ALLOWED_VIDEO_EXTENSIONS,
     MAX_CONTENT_LENGTH=500 * 1024 * 1024,  # 500MB最大上传限制
 )
+# 会话和验证码保存在服务端，cookie 里只有会话 id；多进程部署时把 'memory' 换成数据库文件路径
+session_backend = open_backend('memory')
+# 验证码和只取过验证码的匿名会话单独存放，不占用已登录会话的 LRU 容量
+captcha_backend = open_backend('memory')
+app.session_interface = ServerSideSessionInterface(session_backend, pending_backend=captcha_backend)
+captcha_store = ChallengeStore(captcha_backend)
 
 # 确保上传目录存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# 上传后在后台生成封面，管理页只加载封面图片
+thumbnails = ThumbnailService()
+# 相同内容的视频只存一份，上传目录里的文件是指向它的硬链接
+blobs = BlobStore(os.path.join(BASE_DIR, 'blobs'))
 
 # --- 数据库 ---
-def get_db_connection():
-    conn = sqlite3.connect(app.config['DATABASE'])
-    conn.row_factory = sqlite3.Row
-    return conn
+db_pool = SQLitePool(app.config['DATABASE'], row_factory=sqlite3.Row)
 
-def init_db():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
+def get_db_connection():
+    # 从连接池取连接，conn.close() 会归还连接池
+    return db_pool.acquire()
+
+# 数据库结构迁移，版本号记录在 PRAGMA user_version 中，新的变更只能追加在末尾
+MIGRATIONS = [
+    # 1: 初始表结构
+    [
+        '''CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
             password_hash TEXT NOT NULL
-        )
-    ''')
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS videos (
+        )''',
+        '''CREATE TABLE IF NOT EXISTS videos (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT NOT NULL,
             filename TEXT NOT NULL
-        )
-    ''')
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS notes (
+        )''',
+        '''CREATE TABLE IF NOT EXISTS notes (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT NOT NULL,
             content TEXT NOT NULL
-        )
-    ''')
-    conn.commit()
+        )''',
+    ],
+    # 2: 按用户名查视频、笔记的索引
+    [
+        'CREATE INDEX IF NOT EXISTS idx_videos_username ON videos(username)',
+        'CREATE INDEX IF NOT EXISTS idx_notes_username ON notes(username)',
+    ],
+    # 3: 上传时的文件名单独保存用于显示，磁盘上用不会冲突的存储名；旧记录为空，显示存储名
+    add_column('videos', 'display_name', 'TEXT'),
+]
+
+def init_db():
+    conn = get_db_connection()
+    run_migrations(conn, MIGRATIONS)
     conn.close()
 
 init_db()
@@ -1942,12 +2079,13 @@ def generate_captcha_text(length=5):
     chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
     return ''.join(random.choices(chars, k=length))
 
+# 启动时查找并加载一次字体，找不到 arial 时使用 Pillow 默认字体
+font_registry = FontRegistry()
+font_registry.register('captcha', ['arial.ttf'])
+font_registry.warm_up(('captcha', 40))
+
 def load_font(size=40):
-    try:
-        # 直接用系统自带字体，若失败加载Pillow默认字体
-        return ImageFont.truetype("arial.ttf", size)
-    except:
-        return ImageFont.load_default()
+    return font_registry.get('captcha', size)
 
 def create_captcha_image(text):
     width, height = 150, 50
@@ -1970,15 +2108,15 @@ def create_captcha_image(text):
     image = image.filter(ImageFilter.EDGE_ENHANCE_MORE)
     return image
 
+# 后台线程预先渲染验证码，请求时直接取出 PNG
+captcha_pool = CaptchaPool(generate_captcha_text, lambda text: to_png(create_captcha_image(text)))
+
 @app.route('/captcha')
+@limiter.limit('30/minute', key=client_ip, methods=None)
 def captcha():
-    text = generate_captcha_text()
-    session['captcha_text'] = text.lower()
-    image = create_captcha_image(text)
-    buf = BytesIO()
-    image.save(buf, 'PNG')
-    buf.seek(0)
-    response = make_response(buf.read())
+    text, png = captcha_pool.get()
+    captcha_store.issue(text.lower())
+    response = make_response(png)
     response.headers['Content-Type'] = 'image/png'
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
@@ -1987,6 +2125,7 @@ def captcha():
 
 # --- 用户注册 ---
 @app.route('/register', methods=['GET', 'POST'])
+@limiter.limit('10/hour', key=client_ip)
 def register():
     if 'username' in session:
         flash('已登录，请登出后再注册新用户', 'info')
@@ -1996,9 +2135,7 @@ def register():
         password = request.form.get('password', '')
         password2 = request.form.get('password2', '')
         captcha_input = request.form.get('captcha', '').strip().lower()
-        captcha_saved = session.get('captcha_text', '').lower()
-
-        if captcha_input != captcha_saved:
+        if not captcha_store.verify(captcha_input):
             flash('验证码错误', 'danger')
             return redirect(url_for('register'))
         if not username or not password:
@@ -2016,7 +2153,7 @@ def register():
             conn.close()
             return redirect(url_for('register'))
 
-        password_hash = generate_password_hash(password)
+        password_hash = passwords.hash(password)
         c.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', (username, password_hash))
         conn.commit()
         conn.close()
@@ -2026,6 +2163,8 @@ def register():
 
 # --- 用户登录 ---
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('20/minute', key=client_ip)
+@limiter.limit('5/minute', key=form_username)
 def login():
     if 'username' in session:
         flash('已登录', 'info')
@@ -2034,9 +2173,7 @@ def login():
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '')
         captcha_input = request.form.get('captcha', '').strip().lower()
-        captcha_saved = session.get('captcha_text', '').lower()
-
-        if captcha_input != captcha_saved:
+        if not captcha_store.verify(captcha_input):
             flash('验证码错误', 'danger')
             return redirect(url_for('login'))
 
@@ -2044,11 +2181,16 @@ def login():
         c = conn.cursor()
         c.execute('SELECT password_hash FROM users WHERE username=?', (username,))
         row = c.fetchone()
+        ok, new_hash = passwords.verify_and_update(row['password_hash'], password) if row else (False, None)
+        if ok and new_hash:
+            c.execute('UPDATE users SET password_hash=? WHERE username=?', (new_hash, username))
+            conn.commit()
         conn.close()
-        if not row or not check_password_hash(row['password_hash'], password):
+        if not ok:
             flash('用户名或密码错误', 'danger')
             return redirect(url_for('login'))
 
+        regenerate_session()
         session['username'] = username
         flash(f'登录成功，欢迎 {username}！', 'success')
         next_url = request.args.get('next')
@@ -2068,6 +2210,7 @@ def logout():
 
 # --- 视频上传 ---
 @app.route('/videos/upload', methods=['GET', 'POST'])
+@limiter.limit('60/hour', key=client_ip)
 @login_required
 def videos_upload():
     username = session['username']
@@ -2080,23 +2223,18 @@ def videos_upload():
             flash('请选择正确格式的视频文件(mp4, avi, mkv, mov)', 'danger')
             return redirect(request.url)
 
-        filename = secure_filename(file.filename)
-        base, ext = os.path.splitext(filename)
-        save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        i = 1
-        while os.path.exists(save_path):
-            filename = f"{base}_{i}{ext}"
-            save_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            i += 1
-
-        file.save(save_path)
+        # O_EXCL 创建 uuid 存储名，不用逐个探测同名文件
+        filename = blobs.save_new(file, app.config['UPLOAD_FOLDER'], file.filename)
+        name = display_name(file.filename)
 
         conn = get_db_connection()
         c = conn.cursor()
-        c.execute('INSERT INTO videos (username, filename) VALUES (?, ?)', (username, filename))
+        c.execute('INSERT INTO videos (username, filename, display_name) VALUES (?, ?, ?)',
+                  (username, filename, name))
         conn.commit()
         conn.close()
-        flash(f'视频 {filename} 上传成功！', 'success')
+        thumbnails.submit(app.config['UPLOAD_FOLDER'], filename)
+        flash(f'视频 {name} 上传成功！', 'success')
         return redirect(url_for('videos_manage'))
 
     return render_template('videos_upload.html', username=username)
@@ -2108,7 +2246,8 @@ def videos_manage():
     username = session['username']
     conn = get_db_connection()
     c = conn.cursor()
-    c.execute('SELECT id, filename FROM videos WHERE username = ?', (username,))
+    c.execute('SELECT id, filename, COALESCE(display_name, filename) AS display_name FROM videos WHERE username = ?',
+              (username,))
     videos = c.fetchall()
     conn.close()
     return render_template('videos_manage.html', videos=videos)
@@ -2128,9 +2267,10 @@ def videos_delete(video_id):
         return redirect(url_for('videos_manage'))
     filepath = os.path.join(app.config['UPLOAD_FOLDER'], row['filename'])
     try:
-        os.remove(filepath)
+        blobs.unlink(filepath)
     except Exception:
         pass
+    thumbnails.remove(app.config['UPLOAD_FOLDER'], row['filename'])
     c.execute('DELETE FROM videos WHERE id = ?', (video_id,))
     conn.commit()
     conn.close()
@@ -2152,11 +2292,37 @@ def videos_watch(video_id):
         return redirect(url_for('videos_manage'))
     return render_template('video_watch.html', filename=row['filename'])
 
+# 封面缩略图，URL 带版本号，长期缓存
+@app.route('/thumbs/<name>')
+@login_required
+def thumbnail_file(name):
+    return send_thumbnail(app.config['UPLOAD_FOLDER'], name)
+
+@app.context_processor
+def inject_poster_url():
+    # 缩略图已生成时返回带版本号的 URL，否则返回 None
+    def poster_url(filename, kind='poster'):
+        version = thumbnails.version(app.config['UPLOAD_FOLDER'], filename, kind)
+        if version is None:
+            return None
+        return url_for('thumbnail_file', name=thumbnail_name(filename, kind), v=version)
+    return dict(poster_url=poster_url)
+
+def backfill_posters():
+    # 加入缩略图功能之前上传的视频补生成封面
+    conn = get_db_connection()
+    filenames = [row['filename'] for row in conn.execute('SELECT filename FROM videos')]
+    conn.close()
+    thumbnails.backfill(app.config['UPLOAD_FOLDER'], filenames)
+
+# 每个服务进程处理第一个请求前执行一次，不依赖 app.run() 和重载器
+on_first_request(app, backfill_posters)
+
 # 视频文件直接访问
 @app.route('/uploads/<filename>')
 @login_required
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_video(app.config['UPLOAD_FOLDER'], filename)
 
 # ----------- 笔记管理 -----------
 
@@ -2377,7 +2543,11 @@ if __name__ == '__main__':
   <ul class="list-group">
   {% for video in videos %}
     <li class="list-group-item d-flex justify-content-between align-items-center">
-      {{ video['filename'] }}
+      <span>
+        {% set poster = poster_url(video['filename']) %}
+        {% if poster %}<img src="{{ poster }}" alt="{{ video['display_name'] }}" loading="lazy" width="160" height="90" class="me-2" style="object-fit:cover; background:#000;" />{% endif %}
+        {{ video['display_name'] }}
+      </span>
       <span>
         <a href="{{ url_for('videos_watch', video_id=video['id']) }}" class="btn btn-primary btn-sm me-2">播放</a>
         <form method="post" action="{{ url_for('videos_delete', video_id=video['id']) }}" style="display:inline;" onsubmit="return confirm('确认删除该视频吗？');">
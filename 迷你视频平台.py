@@ -1,11 +1,13 @@
 import os
 import re
 import random
+import sqlite3
 import string
+from contextlib import closing
 from io import BytesIO
 
 from flask import (
-    Flask, render_template_string, request, redirect, url_for, flash, session,
+    Flask, render_template_string, request, redirect, url_for, flash,
     send_file, jsonify, abort
 )
 from flask_sqlalchemy import SQLAlchemy
@@ -13,20 +15,46 @@ from flask_login import (
     LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 )
 from captcha.image import ImageCaptcha
-from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from lcs import top_k
+from chunked_upload import ChunkedUploadStore, register_chunked_upload
+from transcode import Transcoder
+from thumbnails import ThumbnailService, send_thumbnail, thumbnail_name
+from face_jobs import FaceJobService
+from jobs import on_first_request
+from blob_store import BlobStore
+from pagination import page_args, split_page
+from video_stream import send_video
+from rate_limit import RateLimiter, open_counter, client_ip, form_username
+from password_service import PasswordService
+from migrations import run_migrations, add_column
+from session_store import open_backend, ServerSideSessionInterface, ChallengeStore, regenerate_session
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 app = Flask(__name__)
+# 登录、注册、验证码和上传限流；多进程部署时把 'memory' 换成数据库文件路径
+limiter = RateLimiter(open_counter('memory'))
+# 密码哈希在进程池里计算，不占用请求线程；修改参数后旧哈希会在用户下次登录时自动更新
+passwords = PasswordService()
 app.config['SECRET_KEY'] = '请替换为你的随机密钥'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'app.db')
+# 会话和验证码保存在服务端，cookie 里只有会话 id；多进程部署时把 'memory' 换成数据库文件路径
+session_backend = open_backend('memory')
+# 验证码和只取过验证码的匿名会话单独存放，不占用已登录会话的 LRU 容量
+captcha_backend = open_backend('memory')
+app.session_interface = ServerSideSessionInterface(session_backend, pending_backend=captcha_backend)
+captcha_store = ChallengeStore(captcha_backend)
+DATABASE = os.path.join(basedir, 'app.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DATABASE
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 UPLOAD_FOLDER = os.path.join(basedir, 'static/uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024  # 500MB
+HLS_FOLDER = os.path.join(basedir, 'hls')
+# 相同内容的视频只存一份，上传目录里的文件是指向它的硬链接
+blobs = BlobStore(os.path.join(basedir, 'blobs'))
 
 db = SQLAlchemy(app)
 login_manager = LoginManager(app)
@@ -53,16 +81,51 @@ class User(UserMixin, db.Model):
     videos = db.relationship('Video', backref='owner', lazy=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        ok, new_hash = passwords.verify_and_update(self.password_hash, password)
+        if new_hash:
+            self.password_hash = new_hash  # 随本次登录的提交一起写回
+        return ok
 
 class Video(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(300), nullable=False)
     title = db.Column(db.String(200), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # 转码状态：pending / processing / ready / failed
+    transcode_status = db.Column(db.String(20), nullable=False, default='pending', server_default='pending')
+
+# 旧数据库的结构升级，版本号记录在 PRAGMA user_version 中，新的变更只能追加在末尾。
+# create_all() 只建缺少的表，不会给已有的表加列，所以模型新增的列要在这里补上
+MIGRATIONS = [
+    # 1: 转码状态列
+    add_column('video', 'transcode_status', "VARCHAR(20) NOT NULL DEFAULT 'pending'"),
+    # 2: 按用户分页用的索引（create_all() 只给新建的表建索引）
+    ['CREATE INDEX IF NOT EXISTS ix_video_user_id ON video (user_id)'],
+]
+
+# 导入时就建表和升级，gunicorn、waitress 等不经过 app.run() 的部署也能用上新结构
+with app.app_context():
+    db.create_all()
+with closing(sqlite3.connect(DATABASE)) as conn:
+    run_migrations(conn, MIGRATIONS)
+
+def set_transcode_status(video_id, status, source):
+    # 在转码线程中回调，需要自己的应用上下文；id 已被新视频复用时忽略旧文件的转码状态
+    with app.app_context():
+        video = Video.query.get(video_id)
+        if video and video.filename == os.path.basename(source):
+            video.transcode_status = status
+            db.session.commit()
+
+# 上传完成后在后台把视频转成多码率 HLS，播放页就绪后改用自适应码率播放
+transcoder = Transcoder(HLS_FOLDER, on_status=set_transcode_status)
+# 封面和拖动预览图，列表页只加载封面图片
+thumbnails = ThumbnailService()
+# 后台抽帧识别人脸，可以用一张照片查找出现过这个人的视频
+faces = FaceJobService(os.path.join(basedir, 'faces.db'))
 
 def random_captcha_text(length=4):
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
@@ -76,25 +139,13 @@ def generate_captcha_img(text):
 def load_user(user_id):
     return User.query.get(int(user_id))
 
-def lcs_length(a: str, b: str) -> int:
-    la, lb = len(a), len(b)
-    dp = [[0]*(lb+1) for _ in range(la+1)]
-    a = a.lower()
-    b = b.lower()
-    for i in range(1, la+1):
-        for j in range(1, lb+1):
-            if a[i-1] == b[j-1]:
-                dp[i][j] = dp[i-1][j-1] +1
-            else:
-                dp[i][j] = max(dp[i-1][j], dp[i][j-1])
-    return dp[la][lb]
-
 # ========== 路由 ==========
 
 @app.route('/captcha')
+@limiter.limit('30/minute', key=client_ip, methods=None)
 def captcha():
     text = random_captcha_text()
-    session['captcha_text'] = text
+    captcha_store.issue(text)
     img_data = generate_captcha_img(text)
     return send_file(img_data, mimetype='image/png')
 
@@ -103,24 +154,20 @@ def index():
     query = request.args.get('q', '').strip()
     users = []
     if query:
-        all_users = User.query.all()
-        scored = []
-        for u in all_users:
-            score = lcs_length(query, u.username)
-            if score > 0:
-                scored.append((score, u))
-        scored.sort(key=lambda x: x[0], reverse=True)
-        users = [u for score,u in scored[:10]]
+        # 逐行流式打分，只保留前10名，内存与用户总数无关
+        rows = User.query.with_entities(User.id, User.username).order_by(User.id).yield_per(1000)
+        users = [u for score, u in top_k(query, rows, 10, key=lambda u: u.username, ignore_case=True)]
     return render_template_string(index_html, users=users, query=query)
 
 @app.route('/register', methods=['GET', 'POST'])
+@limiter.limit('10/hour', key=client_ip)
 def register():
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '')
         captcha_input = request.form.get('captcha', '').upper()
 
-        if captcha_input != session.get('captcha_text', ''):
+        if not captcha_store.verify(captcha_input):
             flash('验证码错误', 'danger')
             return redirect(url_for('register'))
 
@@ -142,18 +189,22 @@ def register():
     return render_template_string(register_html)
 
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('20/minute', key=client_ip)
+@limiter.limit('5/minute', key=form_username)
 def login():
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '')
         captcha_input = request.form.get('captcha', '').upper()
 
-        if captcha_input != session.get('captcha_text', ''):
+        if not captcha_store.verify(captcha_input):
             flash('验证码错误', 'danger')
             return redirect(url_for('login'))
 
         user = User.query.filter_by(username=username).first()
         if user and user.check_password(password):
+            db.session.commit()
+            regenerate_session()
             login_user(user)
             flash('登录成功', 'success')
             return redirect(url_for('index'))
@@ -171,6 +222,7 @@ def logout():
     return redirect(url_for('index'))
 
 @app.route('/upload', methods=['POST'])
+@limiter.limit('60/hour', key=client_ip)
 @login_required
 def upload():
     title = request.form.get('title', '').strip()
@@ -186,14 +238,58 @@ def upload():
     filename = sanitize_filename(file.filename)
     filename = f"{current_user.id}_{random.randint(1000, 9999)}_{filename}"
     filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(filepath)
+    blobs.save(file, filepath)
 
     video = Video(filename=filename, title=title, owner=current_user)
     db.session.add(video)
     db.session.commit()
+    transcoder.submit(video.id, filepath)
+    thumbnails.submit(app.config['UPLOAD_FOLDER'], filename)
+    if faces.available():
+        faces.submit(video.id, filepath)
 
     return jsonify({'success': True, 'msg': '上传成功'})
 
+# 大文件分片上传（协议见 chunked_upload.py），完成后与 upload() 一样写入 Video 记录
+chunked_store = ChunkedUploadStore(UPLOAD_FOLDER, max_size=app.config['MAX_CONTENT_LENGTH'],
+                                   allowed_file=allowed_file)
+
+def finalize_chunked_upload(meta, part_path):
+    data = request.get_json(silent=True) or request.form
+    title = data.get('title', '').strip()
+    if not title:
+        return jsonify({'success': False, 'msg': '请输入视频标题'})
+
+    filename = sanitize_filename(meta['filename'])
+    filename = f"{current_user.id}_{random.randint(1000, 9999)}_{filename}"
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+
+    # 先插入记录再存入文件，提交成功后才删除 .part，失败时客户端可以重试
+    video = Video(filename=filename, title=title, owner=current_user)
+    db.session.add(video)
+    try:
+        db.session.flush()
+        blobs.save_file(part_path, filepath, remove_source=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        if os.path.exists(filepath):
+            blobs.unlink(filepath)
+        raise
+    os.remove(part_path)
+    transcoder.submit(video.id, filepath)
+    thumbnails.submit(app.config['UPLOAD_FOLDER'], filename)
+    if faces.available():
+        faces.submit(video.id, filepath)
+    return jsonify({'success': True, 'msg': '上传成功'})
+
+register_chunked_upload(
+    app, chunked_store,
+    get_owner=lambda: current_user.get_id() if current_user.is_authenticated else None,
+    finalize=finalize_chunked_upload,
+    decorator=login_required,
+)
+
 @app.route('/delete_video/<int:video_id>', methods=['POST'])
 @login_required
 def delete_video(video_id):
@@ -202,31 +298,67 @@ def delete_video(video_id):
         return jsonify({'success': False, 'msg': '没有权限删除该视频'})
 
     try:
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], video.filename))
+        blobs.unlink(os.path.join(app.config['UPLOAD_FOLDER'], video.filename))
     except Exception as e:
         print("删除文件异常:", e)
+    transcoder.remove(video.id)
+    thumbnails.remove(app.config['UPLOAD_FOLDER'], video.filename)
+    faces.remove(video.id)
 
     db.session.delete(video)
     db.session.commit()
     return jsonify({'success': True, 'msg': '删除成功'})
 
+# 上传一张照片，返回出现过照片中（第一张）人脸的视频
+@app.route('/faces/search', methods=['POST'])
+@limiter.limit('20/minute', key=client_ip)
+@login_required
+def face_search():
+    if not faces.available():
+        return jsonify({'success': False, 'msg': '服务器未安装人脸识别组件'}), 503
+    file = request.files.get('image')
+    if not file or file.filename == '':
+        return jsonify({'success': False, 'msg': '请选择图片'})
+    try:
+        encodings = faces.encode_image(file.read())
+    except ValueError as e:
+        return jsonify({'success': False, 'msg': str(e)})
+    if not encodings:
+        return jsonify({'success': False, 'msg': '图片中没有检测到人脸'})
+    matches = faces.videos_with_face(encodings[0])
+    videos = {v.id: v for v in Video.query.filter(Video.id.in_([int(key) for key, _, _ in matches]))}
+    results = []
+    for key, distance, start_time in matches:
+        video = videos.get(int(key))
+        if video:
+            results.append({'id': video.id, 'title': video.title, 'start_time': start_time,
+                            'distance': round(distance, 3),
+                            'url': url_for('video_player', video_id=video.id)})
+    return jsonify({'success': True, 'videos': results})
+
 @app.route('/user/<int:user_id>')
 def user_videos(user_id):
     user = User.query.get_or_404(user_id)
-    videos = user.videos
-    return render_template_string(user_videos_html, user=user, videos=videos)
+    # 游标分页：?after=<上一页最后一个视频 id>&limit=N，按 id 顺序只取 limit+1 条
+    after, limit = page_args()
+    query = Video.query.filter_by(user_id=user.id)
+    if after is not None:
+        query = query.filter(Video.id > after)
+    videos, next_after = split_page(query.order_by(Video.id).limit(limit + 1).all(), limit,
+                                    key=lambda v: v.id)
+    return render_template_string(user_videos_html, user=user, videos=videos, next_after=next_after)
 
 @app.route('/video/<int:video_id>')
 def video_player(video_id):
     video = Video.query.get_or_404(video_id)
     search_query = request.args.get('q', '').strip()
 
-    user_videos_sorted = sorted(video.owner.videos, key=lambda v: v.id)
-    current_index = next((i for i,v in enumerate(user_videos_sorted) if v.id == video_id), None)
+    # 同一用户按 id 顺序的下一个视频，走 user_id 索引只取一条
+    next_vid = (Video.query.filter(Video.user_id == video.user_id, Video.id > video.id)
+                .order_by(Video.id).first())
 
     next_video_url = None
-    if current_index is not None and current_index +1 < len(user_videos_sorted):
-        next_vid = user_videos_sorted[current_index+1]
+    if next_vid:
         next_video_url = url_for('video_player', video_id=next_vid.id, q=search_query)
 
     return render_template_string(video_player_html,
@@ -236,6 +368,16 @@ def video_player(video_id):
 
 # ---- 视频文件直接静态访问 -- 通过 static/uploads 目录访问
 
+# HLS 播放列表和分片，由 transcoder 生成
+@app.route('/hls/<int:video_id>/<path:filename>')
+def hls_file(video_id, filename):
+    return send_video(transcoder.output_dir(video_id), filename)
+
+# 封面、雪碧图和 vtt，URL 带版本号，长期缓存
+@app.route('/thumbs/<path:name>')
+def thumbnail_file(name):
+    return send_thumbnail(app.config['UPLOAD_FOLDER'], name)
+
 # ========== 模板 ==========
 
 base_html = '''
@@ -505,11 +647,18 @@ user_videos_html = '''
         <div class="card h-100 shadow-sm">
             <div class="card-body">
                 <h5 class="card-title">{{ video.title }}</h5>
-                <video class="w-100 rounded" controls preload="metadata" style="cursor:pointer;"
+                {% set poster = poster_url(video.filename) %}
+                {% if poster %}
+                <img class="w-100 rounded" src="{{ poster }}" alt="{{ video.title }}" loading="lazy"
+                    style="cursor:pointer; aspect-ratio:16/9; object-fit:cover; background:#000;"
+                    onclick="playVideo({{ video.id }})">
+                {% else %}
+                <div class="w-100 rounded d-flex align-items-center justify-content-center text-white"
+                    style="cursor:pointer; aspect-ratio:16/9; background:#000;"
                     onclick="playVideo({{ video.id }})">
-                    <source src="{{ url_for('static', filename='uploads/' + video.filename) }}" type="video/mp4">
-                    你的浏览器不支持 video 标签。
-                </video>
+                    <i class="fas fa-play"></i>&nbsp;封面生成中
+                </div>
+                {% endif %}
             </div>
             {% if current_user.is_authenticated and current_user.id == user.id %}
             <div class="card-footer bg-transparent border-top-0 p-3 d-flex justify-content-end">
@@ -522,6 +671,13 @@ user_videos_html = '''
     </div>
     {% endfor %}
 </div>
+{% if next_after %}
+<div class="text-center mb-4">
+    <a class="btn btn-outline-primary" href="{{ url_for('user_videos', user_id=user.id, after=next_after, limit=request.args.get('limit')) }}">下一页</a>
+</div>
+{% endif %}
+{% elif request.args.get('after') %}
+<p class="text-muted">没有更多视频了。</p>
 {% else %}
 <p class="text-muted">该用户还没有上传视频。</p>
 {% endif %}
@@ -643,8 +799,11 @@ video_player_html = '''
 
 {% block content %}
 <div class="video-container">
-  <video id="player" controls autoplay playsinline>
+  <video id="player" controls autoplay playsinline{% if poster_url(video.filename) %} poster="{{ poster_url(video.filename) }}"{% endif %}>
     <source src="{{ url_for('static', filename='uploads/' + video.filename) }}" type="video/mp4" />
+    {% if poster_url(video.filename, 'vtt') %}
+    <track kind="metadata" label="thumbnails" src="{{ poster_url(video.filename, 'vtt') }}" />
+    {% endif %}
     你的浏览器不支持 video 标签。
   </video>
   <div class="controls">
@@ -686,16 +845,54 @@ function goNext() {
     {% endif %}
 }
 </script>
+{% if video.transcode_status == 'ready' %}
+<script src="https://cdn.jsdelivr.net/npm/hls.js@1"></script>
+<script>
+// 转码完成的视频改用 HLS 自适应码率播放，不支持时仍播放原文件
+(function() {
+    var player = document.getElementById('player');
+    var src = "{{ url_for('hls_file', video_id=video.id, filename='master.m3u8') }}";
+    if (player.canPlayType('application/vnd.apple.mpegurl')) {
+        player.src = src;
+    } else if (window.Hls && Hls.isSupported()) {
+        var hls = new Hls();
+        hls.loadSource(src);
+        hls.attachMedia(player);
+    }
+})();
+</script>
+{% endif %}
 {% endblock %}
 '''
 
+def resume_background_jobs():
+    # 重启前未完成的转码重新排队
+    for video in Video.query.filter(Video.transcode_status.in_(['pending', 'processing'])):
+        transcoder.submit(video.id, os.path.join(app.config['UPLOAD_FOLDER'], video.filename))
+    # 加入缩略图功能之前上传的视频补生成封面
+    thumbnails.backfill(app.config['UPLOAD_FOLDER'], [video.filename for video in Video.query])
+    # 人脸识别任务从上次提交的进度继续
+    if faces.available():
+        faces.resume_pending()
+
+# 每个服务进程处理第一个请求前执行一次，不依赖 app.run() 和重载器
+on_first_request(app, resume_background_jobs)
+
 @app.context_processor
 def inject_base_html():
     return dict(base_html=base_html)
 
+@app.context_processor
+def inject_poster_url():
+    # 缩略图已生成时返回带版本号的 URL，否则返回 None
+    def poster_url(filename, kind='poster'):
+        version = thumbnails.version(app.config['UPLOAD_FOLDER'], filename, kind)
+        if version is None:
+            return None
+        return url_for('thumbnail_file', name=thumbnail_name(filename, kind), v=version)
+    return dict(poster_url=poster_url)
+
 if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()
     app.run(debug=True)
 
 
@@ -711,46 +908,67 @@ if __name__ == '__main__':
 import os
 import sqlite3
 from flask import Flask, request, redirect, url_for, flash, session, send_from_directory, render_template_string
+from lcs import lcs_batch
+from video_stream import send_video
+from sqlite_pool import SQLitePool
+from migrations import run_migrations
+from rate_limit import RateLimiter, open_counter, client_ip, form_username
+from password_service import PasswordService
+from blob_store import BlobStore
 
 # Flask 和上传配置
 app = Flask(__name__)
+# 登录、注册、验证码和上传限流；多进程部署时把 'memory' 换成数据库文件路径
+limiter = RateLimiter(open_counter('memory'))
+# 密码哈希在进程池里计算，不占用请求线程；修改参数后旧哈希会在用户下次登录时自动更新
+passwords = PasswordService()
 app.secret_key = 'your-secret-key'
 UPLOAD_FOLDER = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'uploads')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
+# 相同内容的视频只存一份，上传目录里的文件是指向它的硬链接
+blobs = BlobStore(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'blobs'))
 
 DATABASE = 'app.db'
+db_pool = SQLitePool(DATABASE, row_factory=sqlite3.Row)  # 数据库连接池
+
+# 数据库结构迁移，版本号记录在 PRAGMA user_version 中，新的变更只能追加在末尾
+MIGRATIONS = [
+    # 1: 用户表和视频表（注意实际项目请对密码进行加密）
+    [
+        '''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS videos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            title TEXT,
+            description TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(id)
+        )''',
+    ],
+    # 2: 我的视频、搜索结果按 user_id 查询
+    [
+        'CREATE INDEX IF NOT EXISTS idx_videos_user_id ON videos(user_id)',
+    ],
+]
 
 # 数据库初始化
 def init_db():
-    with sqlite3.connect(DATABASE) as conn:
-        c = conn.cursor()
-        # 用户表：id, username, password（注意实际项目请对密码进行加密）
-        c.execute('''CREATE TABLE IF NOT EXISTS users (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT UNIQUE NOT NULL,
-                        password TEXT NOT NULL
-                    )''')
-        # 视频表：id, user_id, filename, title, description
-        c.execute('''CREATE TABLE IF NOT EXISTS videos (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        user_id INTEGER NOT NULL,
-                        filename TEXT NOT NULL,
-                        title TEXT,
-                        description TEXT,
-                        FOREIGN KEY(user_id) REFERENCES users(id)
-                    )''')
-        conn.commit()
+    with db_pool.connection() as conn:
+        run_migrations(conn, MIGRATIONS)
 
 init_db()
 
 # 获取数据库连接
 def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+    # conn.close() 会把连接归还连接池
+    return db_pool.acquire()
 
 # 辅助函数：计算两个字符串的最长公共子序列（LCS）长度及返回 LCS 字符串
 def longest_common_subsequence(str1, str2):
@@ -848,6 +1066,7 @@ def index():
 
 # 注册
 @app.route('/register', methods=['GET', 'POST'])
+@limiter.limit('10/hour', key=client_ip)
 def register():
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
@@ -885,6 +1104,8 @@ def register():
 
 # 登录
 @app.route('/login', methods=['GET', 'POST'])
+@limiter.limit('20/minute', key=client_ip)
+@limiter.limit('5/minute', key=form_username)
 def login():
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
@@ -927,6 +1148,7 @@ def logout():
 
 # 上传视频
 @app.route('/upload', methods=['GET', 'POST'])
+@limiter.limit('60/hour', key=client_ip)
 def upload():
     if not session.get('user_id'):
         flash("请先登录")
@@ -944,7 +1166,7 @@ def upload():
             return redirect(request.url)
         # 建议实际项目中对文件名进行安全处理
         filename = file.filename
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        blobs.save(file, os.path.join(app.config['UPLOAD_FOLDER'], filename))
         conn = get_db_connection()
         conn.execute("INSERT INTO videos (user_id, filename, title, description) VALUES (?, ?, ?, ?)",
                      (session.get('user_id'), filename, title, description))
@@ -1021,7 +1243,7 @@ def delete_video(video_id):
     # 删除文件
     video_path = os.path.join(app.config['UPLOAD_FOLDER'], video['filename'])
     if os.path.exists(video_path):
-        os.remove(video_path)
+        blobs.unlink(video_path)
     conn.execute("DELETE FROM videos WHERE id=?", (video_id,))
     conn.commit()
     conn.close()
@@ -1054,7 +1276,7 @@ def play_video(video_id):
 # 用于播放与下载的接口（播放时访问 /uploads/<filename> 也可）
 @app.route('/uploads/<filename>')
 def serve_video(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_video(app.config['UPLOAD_FOLDER'], filename)
 
 # 下载视频
 @app.route('/download/<filename>')
@@ -1113,14 +1335,13 @@ def lcs_find():
             conn = get_db_connection()
             users = conn.execute("SELECT * FROM users").fetchall()
             conn.close()
-            scores = []
-            for user in users:
-                lcs_str, score = longest_common_subsequence(target, user['username'])
-                scores.append({'user': user, 'lcs': lcs_str, 'score': score})
-            # 排序以匹配长度最高的排在前
-            scores = sorted(scores, key=lambda x: x['score'], reverse=True)
-            # 取前 3 个
-            matched_users = scores[:3]
+            # 先用位并行算法批量打分，只对前 3 名回溯出 LCS 字符串
+            scores = lcs_batch(target, [user['username'] for user in users])
+            ranked = sorted(zip(scores, users), key=lambda x: x[0], reverse=True)[:3]
+            matched_users = []
+            for score, user in ranked:
+                lcs_str, _ = longest_common_subsequence(target, user['username'])
+                matched_users.append({'user': user, 'lcs': lcs_str, 'score': score})
     return render_template_string('''
     {% extends "base.html" %}
     {% block body %}
@@ -10,26 +10,54 @@ import re
 import random
 import string
 import sqlite3
-from io import BytesIO
 from flask import (
     Flask, request, redirect, url_for, flash,
     g, send_from_directory, render_template,
-    session, make_response
+    session, make_response, jsonify, abort
 )
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import (
     LoginManager, UserMixin, login_user,
     login_required, logout_user, current_user
 )
 from jinja2 import DictLoader
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from PIL import Image, ImageDraw, ImageFilter
+from lcs import top_k
+from video_stream import send_video
+from sqlite_pool import SQLitePool
+from migrations import run_migrations
+from captcha_pool import CaptchaPool, to_png
+from fonts import FontRegistry
+from session_store import open_backend, ServerSideSessionInterface, ChallengeStore, regenerate_session
+from rate_limit import RateLimiter, open_counter, client_ip, form_username
+from password_service import PasswordService
+from dir_cache import DirCache
+from usage_ledger import UsageLedger, QuotaExceeded
+from blob_store import BlobStore
 
 # 配置
 UPLOAD_ROOT = 'static/uploads'
 ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv'}
+USER_QUOTA = 2 * 1024 * 1024 * 1024  # 每个用户2GB
 
 app = Flask(__name__)
+# 登录、注册、验证码和上传限流；多进程部署时把 'memory' 换成数据库文件路径
+limiter = RateLimiter(open_counter('memory'))
+# 密码哈希在进程池里计算，不占用请求线程；修改参数后旧哈希会在用户下次登录时自动更新
+passwords = PasswordService(method='pbkdf2:sha512', salt_length=16)
 app.config['SECRET_KEY'] = 'your_secret_key_here'
+db_pool = SQLitePool('videos.db')  # 数据库连接池，close() 时归还
+# 会话和验证码保存在服务端，cookie 里只有会话 id；多进程部署时把 'memory' 换成数据库文件路径
+session_backend = open_backend('memory')
+# 验证码和只取过验证码的匿名会话单独存放，不占用已登录会话的 LRU 容量
+captcha_backend = open_backend('memory')
+app.session_interface = ServerSideSessionInterface(session_backend, pending_backend=captcha_backend)
+captcha_store = ChallengeStore(captcha_backend)
+# 用户视频目录列表缓存，上传/删除/重命名后主动失效
+dir_cache = DirCache()
+# 每个用户目录的磁盘用量，上传前按配额检查
+usage_ledger = UsageLedger(UPLOAD_ROOT, user_quota=USER_QUOTA)
+# 相同内容的视频只存一份，用户目录里的文件是指向它的硬链接
+blobs = BlobStore('blobs')
 
 # Flask-Login 初始化
 login_manager = LoginManager()
@@ -39,7 +67,7 @@ login_manager.init_app(app)
 # -------- 数据库辅助函数 --------
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect('videos.db')
+        g.db = db_pool.acquire()
         g.db.row_factory = sqlite3.Row
     return g.db
 
@@ -82,47 +110,28 @@ def random_captcha_text(length=4):
     chars = string.ascii_letters + string.digits
     return ''.join(random.choices(chars, k=length))
 
-import matplotlib.font_manager as fm
-import os
-import random
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
-
-def find_system_font(font_list=None):
-    # 常见中英文字体，Windows和Linux通用优先顺序
-    if not font_list:
-        font_list = [
-            "Arial.ttf",
-            "Arial",
-            "LiberationSans-Regular.ttf",
-            "DejaVuSans.ttf",
-            "NotoSansCJK-Regular.ttc",
-            "PingFang.ttc",          # macOS字体，可以保留无妨
-            "SimHei.ttf",            # Windows 黑体
-            "Microsoft YaHei.ttf",   # Windows 微软雅黑
-            "STHeiti Medium.ttc"     # macOS 字体
-        ]
-    for font_name in font_list:
-        try:
-            # findfont可能返回默认字体路径，如果不想fallback可设置fallback_to_default=False
-            font_path = fm.findfont(font_name, fallback_to_default=False)
-            if os.path.exists(font_path):
-                return font_path
-        except Exception:
-            # continue trying other fonts
-            continue
-    return None
+# 常见中英文字体，Windows和Linux通用优先顺序
+CAPTCHA_FONTS = [
+    "Arial.ttf",
+    "LiberationSans-Regular.ttf",
+    "DejaVuSans.ttf",
+    "NotoSansCJK-Regular.ttc",
+    "PingFang.ttc",          # macOS字体，可以保留无妨
+    "SimHei.ttf",            # Windows 黑体
+    "Microsoft YaHei.ttf",   # Windows 微软雅黑
+    "STHeiti Medium.ttc"     # macOS 字体
+]
+CAPTCHA_FONT_SIZE = 48
+
+# 启动时查找并加载一次字体，之后渲染验证码直接取缓存
+font_registry = FontRegistry()
+font_registry.register('captcha', CAPTCHA_FONTS)
+font_registry.warm_up(('captcha', CAPTCHA_FONT_SIZE))
 
 def create_captcha_image(text):
     width, height = 200, 80  # 较大尺寸
     image = Image.new('RGB', (width, height), (255, 255, 255))
-    font_path = find_system_font()
-    try:
-        if font_path:
-            font = ImageFont.truetype(font_path, 48)
-        else:
-            font = ImageFont.load_default()
-    except Exception:
-        font = ImageFont.load_default()
+    font = font_registry.get('captcha', CAPTCHA_FONT_SIZE)
     draw = ImageDraw.Draw(image)
     # 画多条干扰线
     for _ in range(10):
@@ -140,19 +149,18 @@ def create_captcha_image(text):
     image = image.filter(ImageFilter.EDGE_ENHANCE_MORE)
     return image
 
+# 后台线程预先渲染验证码，请求时直接取出 PNG
+captcha_pool = CaptchaPool(random_captcha_text, lambda text: to_png(create_captcha_image(text)))
 
 
 
 @app.route('/captcha')
+@limiter.limit('30/minute', key=client_ip, methods=None)
 def captcha():
-    text = random_captcha_text()
-    session['captcha_text'] = text.lower()
-    image = create_captcha_image(text)
-    buffer = BytesIO()
-    image.save(buffer, 'PNG')
-    buffer.seek(0)
-
-    response = make_response(buffer.read())
+    text, png = captcha_pool.get()
+    captcha_store.issue(text.lower())
+
+    response = make_response(png)
     response.headers['Content-Type'] = 'image/png'
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     return response
@@ -164,19 +172,6 @@ def captcha():
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def lcs_length(a, b):
-    a = a.lower()
-    b = b.lower()
-    m, n = len(a), len(b)
-    dp = [[0]*(n+1) for _ in range(m+1)]
-    for i in range(1,m+1):
-        for j in range(1,n+1):
-            if a[i-1] == b[j-1]:
-                dp[i][j] = dp[i-1][j-1]+1
-            else:
-                dp[i][j] = max(dp[i-1][j], dp[i][j-1])
-    return dp[m][n]
-
 def user_folder(user_id):
     folder = os.path.join(UPLOAD_ROOT, str(user_id))
     os.makedirs(folder, exist_ok=True)
@@ -681,11 +676,11 @@ def index():
     return render_template('index.html')
 
 @app.route('/register', methods=['GET','POST'])
+@limiter.limit('10/hour', key=client_ip)
 def register():
     if request.method == 'POST':
         captcha_input = request.form.get('captcha','').strip().lower()
-        captcha_session = session.get('captcha_text', '')
-        if not captcha_input or captcha_input != captcha_session:
+        if not captcha_store.verify(captcha_input):
             flash('验证码错误')
             return redirect(request.url)
 
@@ -698,7 +693,7 @@ def register():
         if db.execute('SELECT * FROM users WHERE username=?', (username,)).fetchone():
             flash('用户名已存在')
             return redirect(url_for('register'))
-        pw_hash = generate_password_hash(password, method='pbkdf2:sha512', salt_length=16)
+        pw_hash = passwords.hash(password)
         db.execute('INSERT INTO users (username,password_hash) VALUES (?, ?)', (username,pw_hash))
         db.commit()
         flash('注册成功，请登录')
@@ -706,18 +701,25 @@ def register():
     return render_template('register.html')
 
 @app.route('/login', methods=['GET','POST'])
+@limiter.limit('20/minute', key=client_ip)
+@limiter.limit('5/minute', key=form_username)
 def login():
     if request.method == 'POST':
         captcha_input = request.form.get('captcha','').strip().lower()
-        captcha_session = session.get('captcha_text', '')
-        if not captcha_input or captcha_input != captcha_session:
+        if not captcha_store.verify(captcha_input):
             flash('验证码错误')
             return redirect(request.url)
 
         username = request.form['username'].strip()
         password = request.form['password']
         user = User.get_by_username(username)
-        if user and check_password_hash(user.password_hash, password):
+        ok, new_hash = passwords.verify_and_update(user.password_hash, password) if user else (False, None)
+        if ok:
+            if new_hash:
+                db = get_db()
+                db.execute('UPDATE users SET password_hash=? WHERE id=?', (new_hash, user.id))
+                db.commit()
+            regenerate_session()
             login_user(user)
             flash('登录成功')
             return redirect(url_for('index'))
@@ -734,6 +736,7 @@ def logout():
     return redirect(url_for('index'))
 
 @app.route('/upload', methods=['GET','POST'])
+@limiter.limit('60/hour', key=client_ip)
 @login_required
 def upload():
     if request.method=='POST':
@@ -747,14 +750,24 @@ def upload():
         if file and allowed_file(file.filename):
             filename = secure_filename_keep_chinese(file.filename)
             folder = user_folder(current_user.id)
-            base, ext = os.path.splitext(filename)
-            i = 1
-            unique_name = filename
-            while os.path.exists(os.path.join(folder, unique_name)):
-                unique_name = f"{base}_{i}{ext}"
-                i += 1
-            save_path = os.path.join(folder, unique_name)
-            file.save(save_path)
+            # 分块传输的请求没有 Content-Length，无法在写入前检查配额
+            if request.content_length is None:
+                abort(411)
+            try:
+                reservation = usage_ledger.reserve(folder, request.content_length)
+            except QuotaExceeded:
+                flash('存储空间不足，请先删除部分视频')
+                return redirect(request.url)
+            # 这里没有数据库记录显示名，目录里的文件名就是显示名：
+            # O_EXCL 原子地占用原名，重名时加随机后缀，不再逐个探测 name_1、name_2……
+            try:
+                unique_name = blobs.save_new(file, folder, filename, keep_name=True)
+                save_path = os.path.join(folder, unique_name)
+                dir_cache.invalidate(folder)
+                usage_ledger.add_file(save_path, reservation=reservation)
+            finally:
+                # 写入失败时归还预留的空间，成功时已在 add_file() 里结清
+                usage_ledger.release(reservation)
             flash('上传成功')
             return redirect(url_for('user_videos', user_id=current_user.id))
         else:
@@ -770,16 +783,10 @@ def search_users():
         keyword = request.form.get('keyword','').strip()
         if keyword:
             db = get_db()
-            all_users = db.execute('SELECT * FROM users').fetchall()
-            scored = []
-            for user_item in all_users:
-                score = lcs_length(user_item['username'], keyword)
-                if score > 0:
-                    scored.append((score, user_item))
-            scored.sort(key=lambda item: item[0], reverse=True)
-            users = []
-            for score, user_item in scored[:20]:
-                users.append(user_item)
+            # 游标逐行读取，堆中只保留前20名
+            cursor = db.execute('SELECT id, username FROM users ORDER BY id')
+            ranked = top_k(keyword, cursor, 20, key=lambda user_item: user_item['username'], ignore_case=True)
+            users = [user_item for score, user_item in ranked]
         else:
             flash('请输入搜索关键词')
             return redirect(url_for('search_users'))
@@ -793,14 +800,9 @@ def user_videos(user_id):
         flash('用户不存在')
         return redirect(url_for('index'))
 
-    folder = user_folder(user_id)
-    if not os.path.exists(folder):
-        files = []
-    else:
-        files = []
-        for file_name in os.listdir(folder):
-            if allowed_file(file_name):
-                files.append(file_name)
+    # 列表走缓存，不再每次创建目录和逐个判断
+    folder = os.path.join(UPLOAD_ROOT, str(user_id))
+    files = [file_name for file_name in dir_cache.names(folder) if allowed_file(file_name)]
 
     keyword = ''
     filtered = []
@@ -808,15 +810,7 @@ def user_videos(user_id):
     if request.method == 'POST':
         keyword = request.form.get('keyword','').strip()
         if keyword:
-            scored = []
-            for file_name in files:
-                score = lcs_length(file_name, keyword)
-                if score > 0:
-                    scored.append((score, file_name))
-            scored.sort(key=lambda item: item[0], reverse=True)
-            filtered = []
-            for score, file_name in scored[:20]:
-                filtered.append(file_name)
+            filtered = [file_name for score, file_name in top_k(keyword, files, 20, ignore_case=True)]
         else:
             filtered = files
     else:
@@ -840,7 +834,7 @@ def video_player(user_id, filename):
 def uploaded_file(user_id, filename):
     folder = user_folder(user_id)
     safe_fn = secure_filename_keep_chinese(filename)
-    return send_from_directory(folder, safe_fn)
+    return send_video(folder, safe_fn)
 
 @app.route('/delete_video/<filename>', methods=['POST'])
 @login_required
@@ -849,7 +843,10 @@ def delete_video(filename):
     folder = user_folder(current_user.id)
     path = os.path.join(folder, safe_fn)
     if os.path.exists(path):
-        os.remove(path)
+        size = os.path.getsize(path)
+        blobs.unlink(path)
+        dir_cache.invalidate(folder)
+        usage_ledger.remove_file(path, size)
         flash('删除成功')
     else:
         flash('文件不存在')
@@ -880,9 +877,16 @@ def rename_video(filename):
         return redirect(url_for('user_videos', user_id=current_user.id))
 
     os.rename(old_path, new_path)
+    dir_cache.invalidate(folder)
+    usage_ledger.move(old_path, new_path)
     flash('重命名成功')
     return redirect(url_for('user_videos', user_id=current_user.id))
 
+@app.route('/api/usage')
+@login_required
+def usage():
+    return jsonify(usage_ledger.usage(user_folder(current_user.id)))
+
 @app.route('/change_password', methods=['GET', 'POST'])
 @login_required
 def change_password():
@@ -898,11 +902,11 @@ def change_password():
             return redirect(url_for('change_password'))
         # 验证旧密码
         user = User.get(current_user.id)
-        if not user or not check_password_hash(user.password_hash, old_password):
+        if not user or not passwords.verify(user.password_hash, old_password):
             flash('旧密码错误')
             return redirect(url_for('change_password'))
         # 更新密码哈希
-        new_pw_hash = generate_password_hash(new_password, method='pbkdf2:sha512', salt_length=16)
+        new_pw_hash = passwords.hash(new_password)
         db = get_db()
         db.execute('UPDATE users SET password_hash=? WHERE id=?', (new_pw_hash, current_user.id))
         db.commit()
@@ -912,17 +916,21 @@ def change_password():
     return render_template('change_password.html')
 
 # -------- 初始化DB --------
-def init_db():
-    with app.app_context():
-        db = get_db()
-        db.executescript('''
-        CREATE TABLE IF NOT EXISTS users (
+# 数据库结构迁移，版本号记录在 PRAGMA user_version 中，新的变更只能追加在末尾
+MIGRATIONS = [
+    # 1: 用户表
+    [
+        '''CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
             password_hash TEXT NOT NULL
-        );
-        ''')
-        db.commit()
+        )''',
+    ],
+]
+
+def init_db():
+    with app.app_context():
+        run_migrations(get_db(), MIGRATIONS)
 
 if __name__ == '__main__':
     os.makedirs(UPLOAD_ROOT, exist_ok=True)